@@ -3,6 +3,13 @@ from ARDCube.utils.general import setup_project, isdir_mkdir
 from ARDCube.download_level1 import download_level1
 from ARDCube.generate_ard import generate_ard
 from ARDCube.prepare_odc import prepare_odc
+from ARDCube.export_zarr import export_zarr
+from ARDCube.query_ard import query_ard
+from ARDCube.composite import composite as composite_ard
+from ARDCube.extract_points import extract_points
+from ARDCube.zonal_stats import zonal_stats
+from ARDCube.utils.journal import print_status
+from ARDCube.utils.tasks import print_dead_letters
 
 import click
 
@@ -19,6 +26,7 @@ def cli():
                    'copied over to get things started.')
 @click.option('--build', is_flag=True,
               help="Build all Singularity containers that are provided in the '/singularity/recipe' subdirectory. "
+                   "Containers are built in parallel and only if their recipe changed since the last build. "
                    "NOTE: This requires sudo privileges and will ask for your password!")
 def setup(path, build):
     click.echo('#### Setting up project directory...')
@@ -42,13 +50,98 @@ def download(sensor, debug):
 @click.option('--clean', is_flag=True,
               help='Automatically remove intermediate processing results that are created during processing of SAR '
                    'data. Has no effect when processing optical data.')
-def process(sensor, debug, clean):
-    generate_ard(sensor=sensor, debug=debug, clean=clean)
+@click.option('--force', 'force_all', is_flag=True,
+              help='Ignore the state journal and process all scenes again, even if they have been processed with the '
+                   'same input and settings before. Has no effect when processing optical data.')
+def process(sensor, debug, clean, force_all):
+    generate_ard(sensor=sensor, debug=debug, clean=clean, force_all=force_all)
 
 
 @cli.command()
 @click.option('-s', '--sensor', required=True, type=click.Choice(list(SAT_DICT.keys()), case_sensitive=True))
 @click.option('-o', '--overwrite', default=True,
               help='If set to False, only YAML files for new scenes will be created.')
-def prepare(sensor, overwrite):
-    prepare_odc(sensor=sensor, overwrite=overwrite)
+@click.option('--force', 'force_all', is_flag=True,
+              help='Ignore the state journal and create YAML files for all scenes again, even if neither the scenes '
+                   'nor the product definition changed.')
+def prepare(sensor, overwrite, force_all):
+    prepare_odc(sensor=sensor, overwrite=overwrite, force_all=force_all)
+
+
+@cli.command()
+@click.option('-s', '--sensor', required=True, type=click.Choice(list(SAT_DICT.keys()), case_sensitive=True))
+@click.option('-c', '--chunks', default=(64, 256, 256), type=(int, int, int), show_default=True,
+              help='Chunk shape (time, y, x) of the band arrays.')
+def export(sensor, chunks):
+    export_zarr(sensor=sensor, chunks=chunks)
+
+
+@cli.command()
+@click.option('-s', '--sensor', required=True, type=click.Choice(list(SAT_DICT.keys()), case_sensitive=True))
+@click.option('-b', '--bounds', required=True, type=(float, float, float, float),
+              help='Bounding box (left bottom right top) of the query.')
+@click.option('--start', default=None, help="Start of the time range in the format 'YYYY-mm-dd'.")
+@click.option('--end', default=None, help="End of the time range in the format 'YYYY-mm-dd'.")
+@click.option('--crs', default='EPSG:4326', show_default=True,
+              help='Coordinate reference system of the bounding box.')
+@click.option('-p', '--pattern', default='.tif', show_default=True,
+              help="Only return files ending with this pattern, e.g. 'BOA.tif'.")
+def query(sensor, bounds, start, end, crs, pattern):
+    for file in query_ard(sensor=sensor, bounds=bounds, start=start, end=end, crs=crs, pattern=pattern):
+        click.echo(file)
+
+
+@cli.command()
+@click.option('-s', '--sensor', required=True, type=click.Choice(list(SAT_DICT.keys()), case_sensitive=True))
+@click.option('-m', '--methods', default=None,
+              help="Comma-separated list of compositing methods, e.g. 'median,p10,p90'. If not provided, the "
+                   "'Methods' field in 'settings.prm' is used.")
+@click.option('--start', default=None, help="Start of the time range in the format 'YYYY-mm-dd'.")
+@click.option('--end', default=None, help="End of the time range in the format 'YYYY-mm-dd'.")
+def composite(sensor, methods, start, end):
+    if methods is not None:
+        methods = [m.strip() for m in methods.split(',') if len(m.strip()) > 0]
+    composite_ard(sensor=sensor, methods=methods, start=start, end=end)
+
+
+@cli.command()
+@click.option('-s', '--sensor', required=True, type=click.Choice(list(SAT_DICT.keys()), case_sensitive=True))
+@click.option('-p', '--points', required=True, type=click.Path(exists=True, dir_okay=False),
+              help='Vector file (e.g. GeoJSON, GPKG or Shapefile) containing point geometries.')
+@click.option('-i', '--id-field', default=None,
+              help='Attribute that is used as point ID. If not provided, the index of each feature is used.')
+@click.option('-o', '--out', default=None,
+              help="Output file ('.parquet' or '.nc'). If not provided, a Parquet file is written to "
+                   "/ProjectDirectory/data/extract.")
+@click.option('--start', default=None, help="Start of the time range in the format 'YYYY-mm-dd'.")
+@click.option('--end', default=None, help="End of the time range in the format 'YYYY-mm-dd'.")
+def extract(sensor, points, id_field, out, start, end):
+    extract_points(sensor=sensor, points=points, id_field=id_field, out_path=out, start=start, end=end)
+
+
+@cli.command()
+@click.option('-s', '--sensor', required=True, type=click.Choice(list(SAT_DICT.keys()), case_sensitive=True))
+@click.option('-p', '--polygons', required=True, type=click.Path(exists=True, dir_okay=False),
+              help='Vector file (e.g. GeoJSON, GPKG or Shapefile) containing polygon geometries.')
+@click.option('-i', '--id-field', default=None,
+              help='Attribute that is used as polygon ID. If not provided, the index of each feature is used.')
+@click.option('--stats', default=None,
+              help="Comma-separated list of statistics, e.g. 'count,mean,p90'. If not provided, the 'Stats' field in "
+                   "'settings.prm' is used.")
+@click.option('-o', '--out', default=None,
+              help="Output Parquet file. If not provided, it is written to /ProjectDirectory/data/zonal.")
+@click.option('--start', default=None, help="Start of the time range in the format 'YYYY-mm-dd'.")
+@click.option('--end', default=None, help="End of the time range in the format 'YYYY-mm-dd'.")
+def zonal(sensor, polygons, id_field, stats, out, start, end):
+    if stats is not None:
+        stats = [s.strip() for s in stats.split(',') if len(s.strip()) > 0]
+    zonal_stats(sensor=sensor, polygons=polygons, id_field=id_field, stats=stats, out_path=out, start=start, end=end)
+
+
+@cli.command()
+@click.option('-s', '--sensor', required=False, default=None, type=click.Choice(list(SAT_DICT.keys()),
+                                                                                 case_sensitive=True),
+              help='Only show the processing state of this sensor.')
+def status(sensor):
+    print_status(sensor=sensor)
+    print_dead_letters(sensor=sensor)
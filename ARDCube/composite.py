@@ -0,0 +1,309 @@
+from ARDCube.config import get_settings, SAT_DICT, get_setting
+from ARDCube.prepare_odc import create_file_dict
+import ARDCube.utils.general as utils
+import ARDCube.utils.datacube as datacube
+import ARDCube.utils.raster as raster
+import ARDCube.utils.force as force
+
+import os
+import re
+import shutil
+import warnings
+import multiprocessing as mp
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+## Reductions that can be used in the 'Methods' field. Percentiles are selected with 'p' + percentile, e.g. 'p10'.
+METHODS = ['median', 'mean', 'min', 'max', 'count', 'best']
+
+## QAI flags that add to the quality score of an observation for the 'best' method (lower is better)
+BEST_PIXEL_FLAGS = ['aerosol_state', 'illumination_state', 'high_sun_zenith', 'slope', 'water_vapor']
+
+
+def composite(sensor, methods=None, start=None, end=None, nproc=None):
+    """Main function of this module, which creates temporal composites of the level-2 tiles of a dataset. Each tile is
+    processed independently and in parallel: all dates of a tile within the time range are read in windows of full rows
+    (as many rows as fit into 'MemoryLimit' of the [COMPOSITE] section in 'settings.prm'), observations flagged in
+    the QAI band (optical only, see 'MaskFlags') or containing no data are masked and all methods are computed from
+    the same windows. Outputs are written per tile to /{ProjectDirectory}/data/composite/{product}/X*_Y*/ using the
+    output profile defined in the [OUTPUT] section, e.g. '20200101-20201231_MEDIAN.tif' with the same bands as the
+    level-2 product. A mosaic (VRT file) of each composite is created in the subdirectory /mosaic afterwards.
+
+    Parameters
+    ----------
+    sensor: string
+        Name of the sensor/dataset that should be composited.
+        Example: 'landsat8'
+    methods: list of strings (optional)
+        Reductions that should be computed. If not provided, the 'Methods' field in 'settings.prm' is used.
+        Valid options: 'median', 'mean', 'min', 'max', 'count' (number of valid observations), 'best' (observation
+        with the best QAI score, optical only) and percentiles, e.g. 'p10' or 'p90'.
+    start: string (optional)
+        Start of the time range in the format 'YYYY-mm-dd' (inclusive). If not provided, the time range is open.
+    end: string (optional)
+        End of the time range in the format 'YYYY-mm-dd' (inclusive). If not provided, the time range is open.
+    nproc: int (optional)
+        Number of processes. If not provided, the 'NPROC' field in 'settings.prm' is used.
+    """
+
+    settings = get_settings()
+
+    if sensor not in list(SAT_DICT.keys()):
+        raise ValueError(f"{sensor} is not supported!")
+
+    if nproc is None:
+        nproc = int(settings['PROCESSING']['NPROC'])
+    if methods is None:
+        methods = get_setting(settings=settings, section='COMPOSITE', field='Methods')
+        methods = [m.strip() for m in methods.split(',') if len(m.strip()) > 0]
+    _check_methods(methods=methods, sensor=sensor)
+
+    mask_flags = get_setting(settings=settings, section='COMPOSITE', field='MaskFlags')
+    mask_flags = [f.strip() for f in mask_flags.split(',') if len(f.strip()) > 0]
+    for flag in mask_flags:
+        if flag not in force.QAI_FLAGS:
+            raise ValueError(f"{flag} not recognized. "
+                             f"Valid options for 'MaskFlags' are: {list(force.QAI_FLAGS.keys())}")
+
+    memory_limit = int(get_setting(settings=settings, section='COMPOSITE', field='MemoryLimit'))
+    profile = raster.get_output_profile(settings=settings)
+
+    start = utils.date_key(date=start, default='00000000')
+    end = utils.date_key(date=end, default='99999999')
+
+    data_dir = os.path.join(settings['GENERAL']['ProjectDirectory'], 'data')
+    level2_dir = os.path.join(data_dir, 'level2', sensor)
+    prj_path = os.path.join(datacube._get_datacubeprj_dir(directory=level2_dir), 'datacube-definition.prj')
+
+    file_dict = create_file_dict(sensor=sensor, overwrite=True)
+    product_dict = utils.read_product_yaml(sensor=sensor)
+
+    ## Sort file dictionary entries by product and tile: {product: {tile: [(date, paths), ...]}}
+    products = {}
+    for key, paths in file_dict.items():
+        tile, date = key.split('__')
+        if not start <= date[:8] <= end:
+            continue
+        if sensor == 'sentinel1':
+            prod_key = f"{sensor}_{utils.s1_is_asc_or_desc(file_path=paths[0])}.yaml"
+        else:
+            prod_key = f"{sensor}.yaml"
+        products.setdefault(prod_key, {}).setdefault(tile, []).append((date, paths))
+
+    if len(products) == 0:
+        print(f"No level-2 files of {sensor} found between {start} and {end}.")
+        return
+
+    composite_dir = os.path.join(data_dir, 'composite')
+    utils.isdir_mkdir(directory=composite_dir)
+
+    for prod_key, tiles in products.items():
+        out_dir = os.path.join(composite_dir, product_dict[prod_key]['name'])
+        utils.isdir_mkdir(directory=out_dir)
+        shutil.copy2(prj_path, out_dir)
+
+        ## The time range is part of the filename, so it needs to be the same for all tiles of a product
+        dates = sorted([date[:8] for entries in tiles.values() for date, _ in entries])
+        prefix = f"{dates[0]}-{dates[-1]}"
+
+        print(f"\n#### Compositing {len(tiles)} tiles of {product_dict[prod_key]['name']} ({prefix}): "
+              f"{', '.join(methods)}")
+        pool = mp.Pool(nproc)
+        result_objects = [pool.apply_async(_composite_tile, args=(os.path.join(out_dir, tile), sorted(entries), sensor,
+                                                                  product_dict[prod_key]['band_names'], methods,
+                                                                  prefix, mask_flags, memory_limit, profile))
+                          for tile, entries in tiles.items()]
+
+        total = len(result_objects)
+        for i, r in enumerate(result_objects):
+            tile, n_dates = r.get()
+            utils.progress(i + 1, total, status=f"{tile}: {n_dates} dates")
+
+        pool.close()
+        pool.join()
+
+        print('')
+        datacube.create_mosaics(directory=out_dir)
+
+
+def _check_methods(methods, sensor):
+    """Helper function for composite() to check if all methods are valid for the sensor."""
+
+    if len(methods) == 0:
+        raise ValueError("No compositing method selected!")
+
+    for method in methods:
+        rs = re.fullmatch(r'p(\d{1,3}(\.\d+)?)', method)
+        if method not in METHODS and (rs is None or float(rs.group(1)) > 100):
+            raise ValueError(f"{method} not recognized. Valid options are: {METHODS} or percentiles, e.g. 'p10'")
+        if method == 'best' and sensor == 'sentinel1':
+            raise ValueError("The 'best' method is based on the QAI band and can only be used for optical data.")
+
+
+def _composite_tile(tile_dir, entries, sensor, band_names, methods, prefix, mask_flags, memory_limit, profile):
+    """Helper function executed in composite() which computes all composites of a single tile. The files of the tile
+    are read in windows of full rows, so that the time series of all dates and bands fit into 'memory_limit' (MB). For
+    each window, the files are opened one date at a time, so the number of open files does not grow with the length
+    of the time series. Masked observations are set to NaN, so the reductions can be computed with nan-aware NumPy
+    functions. Outputs are written window by window."""
+
+    utils.isdir_mkdir(directory=tile_dir)
+    bands = [band for band in band_names if band != 'pixel_qa']
+    use_qai = 'pixel_qa' in band_names
+
+    sources = raster.open_band_sources(paths=entries[0][1], sensor=sensor, band_names=band_names)
+    try:
+        dataset, index = sources[bands[0]]
+        height, width = dataset.shape
+        dtype = dataset.dtypes[index - 1]
+        nodata = dataset.nodatavals[index - 1]
+        meta = dataset.meta.copy()
+    finally:
+        raster.close_band_sources(sources=sources)
+    if nodata is None:
+        nodata = np.nan if np.issubdtype(np.dtype(dtype), np.floating) else 0
+
+    outputs = {}
+    try:
+        for method in methods:
+            out_tif = os.path.join(tile_dir, f"{prefix}_{method.upper()}.tif")
+            out_dtype = 'int16' if method == 'count' else dtype
+            out_meta = meta.copy()
+            out_meta.update({'driver': 'GTiff',
+                             'count': len(bands),
+                             'dtype': out_dtype,
+                             'nodata': None if method == 'count' else nodata})
+            out_meta.update(raster.gtiff_options(profile=profile, dtype=out_dtype))
+            if profile['format'] == 'COG':
+                outputs[method] = (out_tif, rasterio.open(out_tif.replace('.tif', '_tmp.tif'), 'w', **out_meta))
+            else:
+                outputs[method] = (out_tif, rasterio.open(out_tif, 'w', **out_meta))
+
+        ## Time series of all bands (float32) and the QAI band, plus the mask and the temporary copies made by the
+        ## reductions of a single band
+        n_rows = raster.rows_per_window(bytes_per_row=width * len(entries) * (4 * len(bands) + 2 + 16),
+                                        memory_limit=memory_limit, block_size=profile['block_size'])
+
+        for row in range(0, height, n_rows):
+            window = Window(0, row, width, min(n_rows, height - row))
+            stack, qai = _read_window(entries=entries, sensor=sensor, band_names=band_names, window=window)
+
+            ## Observations flagged in the QAI band are masked for all bands
+            masked, score = None, None
+            if use_qai:
+                masked = np.zeros(qai.shape, dtype=bool)
+                for flag in mask_flags:
+                    masked |= force.decode_qai(qai=qai, flag=flag) > 0
+                if 'best' in methods:
+                    score = sum([force.decode_qai(qai=qai, flag=flag) for flag in BEST_PIXEL_FLAGS])
+                del qai
+
+            for b, band in enumerate(bands):
+                data = stack[b]
+                invalid = ~np.isfinite(data)
+                if not np.isnan(nodata):
+                    invalid |= data == nodata
+                if masked is not None:
+                    invalid |= masked
+                data[invalid] = np.nan
+                del invalid
+
+                for method, out in _reduce(data=data, methods=methods, score=score).items():
+                    dst = outputs[method][1]
+                    dst.write(_cast(data=out, dtype=dst.dtypes[0], nodata=nodata), b + 1, window=window)
+            del stack
+    finally:
+        for dst in [out[1] for out in outputs.values()]:
+            dst.close()
+
+    if profile['format'] == 'COG':
+        for out_tif, _ in outputs.values():
+            raster.convert_raster(src_path=out_tif.replace('.tif', '_tmp.tif'), dst_path=out_tif, profile=profile)
+            os.remove(out_tif.replace('.tif', '_tmp.tif'))
+
+    return os.path.basename(tile_dir), len(entries)
+
+
+def _read_window(entries, sensor, band_names, window):
+    """Helper function for _composite_tile() to read a window of all dates of a tile. The files of each date are
+    opened, read and closed before the next date is read. Returns the time series of all bands except the QAI band as
+    float32 array of shape (bands, dates, rows, cols) and the QAI band of shape (dates, rows, cols) (or None)."""
+
+    bands = [band for band in band_names if band != 'pixel_qa']
+    stack = np.empty((len(bands), len(entries), int(window.height), int(window.width)), dtype='float32')
+    qai = None
+
+    for d, (_, paths) in enumerate(entries):
+        sources = raster.open_band_sources(paths=paths, sensor=sensor, band_names=band_names)
+        try:
+            for b, band in enumerate(bands):
+                dataset, index = sources[band]
+                stack[b, d] = dataset.read(index, window=window)
+            if 'pixel_qa' in sources:
+                dataset, index = sources['pixel_qa']
+                data = dataset.read(index, window=window)
+                if qai is None:
+                    qai = np.empty((len(entries),) + data.shape, dtype=data.dtype)
+                qai[d] = data
+        finally:
+            raster.close_band_sources(sources=sources)
+
+    return stack, qai
+
+
+def _reduce(data, methods, score=None):
+    """Helper function for _composite_tile() to compute all methods from an array of the shape (time, rows, cols) in
+    which masked observations are NaN. Returns a dictionary of the form {'median': array, ...}. The median and all
+    percentiles are computed with a single call, so the time series only needs to be sorted once."""
+
+    out = {}
+    with warnings.catch_warnings():
+        ## Pixels without any valid observation ('All-NaN slice') are expected and result in NaN
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        quantiles = {method: 50.0 if method == 'median' else float(method[1:])
+                     for method in methods if method == 'median' or method.startswith('p')}
+        if len(quantiles) > 0:
+            result = np.nanpercentile(data, list(quantiles.values()), axis=0)
+            for i, method in enumerate(quantiles.keys()):
+                out[method] = result[i]
+
+        for method in methods:
+            if method == 'mean':
+                out[method] = np.nanmean(data, axis=0)
+            elif method == 'min':
+                out[method] = np.nanmin(data, axis=0)
+            elif method == 'max':
+                out[method] = np.nanmax(data, axis=0)
+            elif method == 'count':
+                out[method] = np.count_nonzero(~np.isnan(data), axis=0)
+            elif method == 'best':
+                out[method] = _best_pixel(data=data, score=score)
+
+    return out
+
+
+def _best_pixel(data, score):
+    """Helper function for _reduce() to select the valid observation with the lowest QAI score per pixel. If several
+    observations have the same score, the most recent one is selected."""
+
+    n_dates = data.shape[0]
+    key = score.astype('float32') * n_dates + np.arange(n_dates - 1, -1, -1, dtype='float32')[:, None, None]
+    key[np.isnan(data)] = np.inf
+    index = np.argmin(key, axis=0)
+
+    return np.take_along_axis(data, index[None, :, :], axis=0)[0]
+
+
+def _cast(data, dtype, nodata):
+    """Helper function for _composite_tile() to convert a composite into the output data type. NaN is replaced with the
+    no data value and values are rounded for integer data types."""
+
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        if np.issubdtype(data.dtype, np.integer):
+            return data.astype(dtype)
+        data = np.round(data)
+
+    return np.where(np.isnan(data), nodata, data).astype(dtype)
+
@@ -24,6 +24,23 @@ def get_settings():
     return settings
 
 
+def get_setting(settings, section, field):
+    """Returns the value of a field in 'settings.prm' as a string. If the field (or its section) is missing, e.g. in a
+    settings file created with an older version of ARDCube, its default value defined in DEFAULTS is returned."""
+
+    return settings.get(section, field, fallback=DEFAULTS[section][field])
+
+
+def get_setting_bool(settings, section, field):
+    """Same as get_setting(), but returns the value as a boolean (e.g. 'True', 'yes' or '1')."""
+
+    value = get_setting(settings=settings, section=section, field=field)
+    if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+        raise ValueError(f"Field '{field}': {value} is not a boolean!")
+
+    return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+
+
 settings = get_settings()
 PROJ_DIR = settings['GENERAL']['ProjectDirectory']
 FORCE_PATH = os.path.join(PROJ_DIR, 'management', 'singularity', 'force.sif')
@@ -45,3 +62,42 @@ SAT_DICT = {'sentinel1': None,
 ## Note that some sources might require authentication, which can be added to the parameters listed in the script
 ## '/settings/pyrosar/dem.py' if necessary.
 DEM_TYPES = ['AW3D30', 'SRTM 1Sec HGT', 'SRTM 3Sec', 'TDX90m']
+
+## Default values of fields that were added to 'settings.prm' over time (see get_setting()). They are identical to the
+## values in /resources/settings/settings.prm.
+DEFAULTS = {'PROCESSING': {'AssembleSlices': 'True',
+                           'MinOverlap': '5',
+                           'LowOverlap': 'skip',
+                           'CropMode': 'full',
+                           'CropMemoryLimit': '256',
+                           'CubeEngine': 'native',
+                           'EmptyTiles': 'quarantine',
+                           'DiskBudget': '0',
+                           'ColdStorage': ''},
+            'OUTPUT': {'Format': 'COG',
+                       'Compression': 'ZSTD',
+                       'Predictor': 'auto',
+                       'BlockSize': '512',
+                       'Overviews': 'True',
+                       'OverviewResampling': 'average',
+                       'NumThreads': 'ALL_CPUS'},
+            'SNAP': {'Memory': 'auto',
+                     'Cache': 'auto',
+                     'Threads': 'auto',
+                     'TmpDir': 'auto',
+                     'GroupSize': 'auto',
+                     'Worker': 'gpt',
+                     'OSVPrefetch': 'True',
+                     'OSVServer': 'https://step.esa.int/auxdata/orbits/Sentinel-1'},
+            'EXECUTION': {'Backend': 'singularity',
+                          'Record': 'False',
+                          'RecordFile': '',
+                          'Timeout': '0',
+                          'Retries': '2',
+                          'Backoff': '30',
+                          'Cluster': 'local',
+                          'Scheduler': ''},
+            'COMPOSITE': {'Methods': 'median',
+                          'MaskFlags': 'valid_data, cloud_state, cloud_shadow, snow, subzero, saturation',
+                          'MemoryLimit': '512'},
+            'ZONAL': {'Stats': 'count, mean, median, p10, p90'}}
@@ -1,13 +1,14 @@
-from ARDCube.config import get_settings, FORCE_PATH, SAT_DICT
+from ARDCube.config import get_settings, SAT_DICT
 import ARDCube.utils.general as utils
 import ARDCube.utils.force as force
+import ARDCube.utils.journal as journal
+import ARDCube.utils.executor as executor
 
 import os
 import logging
 import json
 from datetime import datetime
 from sentinelsat import SentinelAPI, geojson_to_wkt, SentinelAPIError
-from spython.main import Client
 import geopandas as gpd
 
 
@@ -90,11 +91,19 @@ def download_sar(query):
         if answer in ['y', 'yes']:
             print("\n#### Starting download...")
             try:
-                api.download_all(api_query, directory_path=query['out_dir'])
+                downloaded = api.download_all(api_query, directory_path=query['out_dir'])[0]
             except Exception as e:
                 raise RuntimeError(f"Failed to download because of error: {e} \n"
                                    f"Please check log file for more information!\n"
                                    f"The log file is located at: {query['log_dir']}")
+
+            ## Record downloaded scenes in the state journal
+            conn = journal.connect()
+            for product in downloaded.values():
+                journal.record(conn=conn, sensor='sentinel1', scene=journal.s1_scene_id(product['path']),
+                               stage='downloaded', input_hash=journal.file_fingerprint(product['path']),
+                               settings_hash=None)
+            conn.close()
             break
         elif answer in ['n', 'no']:
             print("\n#### Download cancelled!")
@@ -119,7 +128,6 @@ def download_optical(query, debug):
         Singularity debugging information is printed if set to True.
     """
 
-    Client.debug = debug
     if debug:
         quiet = False
     else:
@@ -133,10 +141,11 @@ def download_optical(query, debug):
     timespan = f"{query['timespan'][0]},{query['timespan'][1]}"
 
     ## Send query to FORCE Singularity container as dry run first ("--no-act") and print output
-    output = Client.execute(FORCE_PATH, ["force-level1-csd", "--no-act", "-s", query['force_abbr'], "-d", timespan,
-                                         "-c", query['cloudcover'], meta_dir, query['out_dir'],
-                                         query['queue_file'], query['aoi_path']],
-                            options=["--cleanenv"])
+    output = executor.execute(tool='force',
+                              args=["force-level1-csd", "--no-act", "-s", query['force_abbr'], "-d", timespan,
+                                    "-c", query['cloudcover'], meta_dir, query['out_dir'],
+                                    query['queue_file'], query['aoi_path']],
+                              debug=debug)
 
     if isinstance(output, list):
         for line in output:
@@ -155,10 +164,11 @@ def download_optical(query, debug):
                   "and start it again at a later time using the same settings. \n"
                   "Only incomplete and new scenes will be downloaded!\n")
 
-            out = Client.execute(FORCE_PATH, ["force-level1-csd", "-s", query['force_abbr'], "-d", timespan,
-                                              "-c", query['cloudcover'], meta_dir, query['out_dir'],
-                                              query['queue_file'], query['aoi_path']],
-                                 options=["--cleanenv"], quiet=quiet, stream=True)
+            out = executor.execute(tool='force',
+                                   args=["force-level1-csd", "-s", query['force_abbr'], "-d", timespan,
+                                         "-c", query['cloudcover'], meta_dir, query['out_dir'],
+                                         query['queue_file'], query['aoi_path']],
+                                   quiet=quiet, stream=True, debug=debug)
             for line in out:
                 print(line, end='')
             break
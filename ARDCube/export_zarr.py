@@ -0,0 +1,165 @@
+from ARDCube.config import get_settings, SAT_DICT
+from ARDCube.prepare_odc import create_file_dict
+import ARDCube.utils.general as utils
+import ARDCube.utils.raster as raster
+
+import os
+import multiprocessing as mp
+import numpy as np
+import rasterio
+import zarr
+from numcodecs import Blosc
+
+
+def export_zarr(sensor, chunks=(64, 256, 256), nproc=None):
+    """Main function of this module, which exports the level-2 tiles of a dataset into a Zarr store per product
+    (e.g. /{ProjectDirectory}/data/zarr/l8_ARD.zarr). Each store contains one group per tile (e.g. 'X0001_Y0001') with
+    one array per band of the shape (time, y, x), as well as the coordinate arrays 'time', 'y' and 'x'. The arrays
+    follow the xarray conventions, so a tile can be opened with xarray.open_zarr(store, group='X0001_Y0001').
+    Files are discovered in the same way as for prepare_odc() and only dates that do not exist in a store yet are
+    appended, so the function can be executed after each processing run. Tiles are processed in parallel.
+    Note that dates are appended in chronological order per run, so the time axis is only guaranteed to be sorted if
+    new data is more recent than the data that was exported previously.
+
+    Parameters
+    ----------
+    sensor: string
+        Name of the sensor/dataset that should be exported.
+        Example: 'landsat8'
+    chunks: tuple (optional)
+        Chunk shape (time, y, x) of the band arrays. The default favours reading pixel time series over reading single
+        dates.
+    nproc: int (optional)
+        Number of processes. If not provided, the 'NPROC' field in 'settings.prm' is used.
+    """
+
+    settings = get_settings()
+
+    if sensor not in list(SAT_DICT.keys()):
+        raise ValueError(f"{sensor} is not supported!")
+
+    if nproc is None:
+        nproc = int(settings['PROCESSING']['NPROC'])
+
+    zarr_dir = os.path.join(settings['GENERAL']['ProjectDirectory'], 'data', 'zarr')
+    utils.isdir_mkdir(directory=zarr_dir)
+
+    file_dict = create_file_dict(sensor=sensor, overwrite=True)
+    product_dict = utils.read_product_yaml(sensor=sensor)
+
+    ## Sort file dictionary entries by product and tile: {product: {tile: [(date, paths), ...]}}
+    products = {}
+    for key, paths in file_dict.items():
+        tile, date = key.split('__')
+        if sensor == 'sentinel1':
+            prod_key = f"{sensor}_{utils.s1_is_asc_or_desc(file_path=paths[0])}.yaml"
+        else:
+            prod_key = f"{sensor}.yaml"
+        products.setdefault(prod_key, {}).setdefault(tile, []).append((date, paths))
+
+    for prod_key, tiles in products.items():
+        store_path = os.path.join(zarr_dir, f"{product_dict[prod_key]['name']}.zarr")
+        band_names = product_dict[prod_key]['band_names']
+
+        root = zarr.open_group(store_path, mode='a')
+        root.attrs.update({'product': product_dict[prod_key]['name'],
+                           'crs': product_dict[prod_key]['crs'],
+                           'bands': band_names})
+
+        print(f"\n#### Exporting {len(tiles)} tiles to {store_path}")
+        pool = mp.Pool(nproc)
+        result_objects = [pool.apply_async(_export_tile, args=(store_path, tile, sorted(entries), sensor,
+                                                               band_names, chunks))
+                          for tile, entries in tiles.items()]
+
+        total = len(result_objects)
+        for i, r in enumerate(result_objects):
+            tile, n_new = r.get()
+            utils.progress(i + 1, total, status=f"{tile}: {n_new} new dates")
+
+        pool.close()
+        pool.join()
+
+
+def _export_tile(store_path, tile, entries, sensor, band_names, chunks):
+    """Helper function executed in export_zarr() which appends all new dates of a single tile to the Zarr store. Dates
+    are written in batches of the chunk length along the time axis. Each batch is read and written in row windows of
+    the chunk height, which keeps the memory usage bounded independent of the tile size."""
+
+    group = zarr.open_group(store_path, mode='a').require_group(tile)
+
+    existing = group.attrs.get('dates', [])
+    entries = [(date, paths) for date, paths in entries if date not in existing]
+    if len(entries) == 0:
+        return tile, 0
+
+    ## Create arrays based on the first entry, if the tile doesn't exist in the store yet
+    if 'time' not in group:
+        sources = raster.open_band_sources(paths=entries[0][1], sensor=sensor, band_names=band_names)
+        dataset = sources[band_names[0]][0]
+        height, width = dataset.shape
+        transform = dataset.transform
+
+        compressor = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+        for band in band_names:
+            dataset, index = sources[band]
+            nodata = dataset.nodatavals[index - 1]
+            arr = group.create_dataset(band, shape=(0, height, width), chunks=chunks, dtype=dataset.dtypes[index - 1],
+                                       fill_value=nodata, compressor=compressor)
+            arr.attrs['_ARRAY_DIMENSIONS'] = ['time', 'y', 'x']
+            if nodata is not None:
+                arr.attrs['_FillValue'] = nodata
+        raster.close_band_sources(sources=sources)
+
+        time = group.create_dataset('time', shape=(0,), chunks=(chunks[0] * 16,), dtype='M8[s]')
+        time.attrs['_ARRAY_DIMENSIONS'] = ['time']
+        y = group.array('y', transform.f + (np.arange(height) + 0.5) * transform.e)
+        y.attrs['_ARRAY_DIMENSIONS'] = ['y']
+        x = group.array('x', transform.c + (np.arange(width) + 0.5) * transform.a)
+        x.attrs['_ARRAY_DIMENSIONS'] = ['x']
+        group.attrs['transform'] = list(transform)
+
+    _, height, width = group[band_names[0]].shape
+
+    ## The 'dates' attribute is updated last for each batch and marks the dates that were written completely. Arrays
+    ## that are longer (e.g. because a previous run crashed in the middle of a batch) are cut back to this length.
+    t_committed = len(existing)
+    if group['time'].shape[0] != t_committed:
+        _resize_time(group=group, band_names=band_names, length=t_committed)
+
+    for i in range(0, len(entries), chunks[0]):
+        batch = entries[i:i + chunks[0]]
+        t0 = t_committed
+        t1 = t0 + len(batch)
+
+        ## Coordinates are written before the band data, so time and band arrays always have the same length
+        _resize_time(group=group, band_names=band_names, length=t1)
+        group['time'][t0:t1] = np.array([utils.format_date_string(date=date, sensor=sensor).replace('.000Z', '')
+                                         for date, _ in batch], dtype='M8[s]')
+
+        ## Open all files of the batch once and read them in row windows
+        sources = [raster.open_band_sources(paths=paths, sensor=sensor, band_names=band_names) for _, paths in batch]
+        try:
+            for row in range(0, height, chunks[1]):
+                window = rasterio.windows.Window(0, row, width, min(chunks[1], height - row))
+                for band in band_names:
+                    data = np.stack([src[band][0].read(src[band][1], window=window) for src in sources])
+                    group[band][t0:t1, row:row + window.height, :] = data
+        finally:
+            for src in sources:
+                raster.close_band_sources(sources=src)
+
+        group.attrs['dates'] = group.attrs.get('dates', []) + [date for date, _ in batch]
+        t_committed = t1
+
+    return tile, len(entries)
+
+
+def _resize_time(group, band_names, length):
+    """Helper function for _export_tile() to resize the time axis of the coordinate array and all band arrays of a
+    tile group to the same length."""
+
+    _, height, width = group[band_names[0]].shape
+    group['time'].resize(length)
+    for band in band_names:
+        group[band].resize(length, height, width)
@@ -0,0 +1,251 @@
+from ARDCube.config import get_settings, SAT_DICT
+from ARDCube.prepare_odc import create_file_dict
+import ARDCube.utils.general as utils
+import ARDCube.utils.datacube as datacube
+import ARDCube.utils.raster as raster
+
+import os
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+from rasterio.windows import Window
+
+
+def extract_points(sensor, points, id_field=None, out_path=None, start=None, end=None, nproc=None):
+    """Main function of this module, which extracts the pixel time series of all level-2 bands for a set of points.
+    Points are assigned to datacube tiles and, within each tile, grouped by the internal blocks of the GeoTIFF files.
+    Each block that contains at least one point is then read once per date and the values of all points in it are
+    gathered with vectorized indexing. Tiles are processed in parallel.
+    The result is a table with one row per point and date and the columns 'point_id', 'product', 'tile', 'date' and
+    one column per band. No data values are converted to NaN and rows without any valid band value are dropped.
+
+    Parameters
+    ----------
+    sensor: string
+        Name of the sensor/dataset that should be extracted.
+        Example: 'sentinel1'
+    points: string
+        Path to a vector file (e.g. GeoJSON, GPKG or Shapefile) containing point geometries.
+    id_field: string (optional)
+        Attribute of the vector file that is used as 'point_id'. If not provided, the index of each feature is used.
+    out_path: string (optional)
+        Path of the output file. Parquet ('.parquet') and NetCDF ('.nc') are supported. Parquet files are written
+        tile by tile, while the NetCDF file is written once all tiles are finished. The NetCDF file has a single
+        dimension 'obs' (one per row of the table) and one variable per column. If not provided, the table is
+        written to /{ProjectDirectory}/data/extract/{points}__{sensor}.parquet
+    start: string (optional)
+        Start of the time range in the format 'YYYY-mm-dd' (inclusive). If not provided, the time range is open.
+    end: string (optional)
+        End of the time range in the format 'YYYY-mm-dd' (inclusive). If not provided, the time range is open.
+    nproc: int (optional)
+        Number of processes. If not provided, the 'NPROC' field in 'settings.prm' is used.
+    """
+
+    settings = get_settings()
+
+    if sensor not in list(SAT_DICT.keys()):
+        raise ValueError(f"{sensor} is not supported!")
+
+    if nproc is None:
+        nproc = int(settings['PROCESSING']['NPROC'])
+
+    data_dir = os.path.join(settings['GENERAL']['ProjectDirectory'], 'data')
+    if out_path is None:
+        utils.isdir_mkdir(directory=os.path.join(data_dir, 'extract'))
+        out_path = os.path.join(data_dir, 'extract',
+                                f"{os.path.splitext(os.path.basename(points))[0]}__{sensor}.parquet")
+    if os.path.splitext(out_path)[1] not in ['.parquet', '.nc']:
+        raise ValueError(f"{out_path} has an unsupported format. Valid options are: '.parquet' or '.nc'")
+
+    start = utils.date_key(date=start, default='00000000')
+    end = utils.date_key(date=end, default='99999999')
+
+    level2_dir = os.path.join(data_dir, 'level2', sensor)
+    prj = datacube.read_datacube_prj(prj_path=os.path.join(datacube._get_datacubeprj_dir(directory=level2_dir),
+                                                           'datacube-definition.prj'))
+
+    tile_points = _get_tile_points(points=points, id_field=id_field, prj=prj)
+
+    file_dict = create_file_dict(sensor=sensor, overwrite=True)
+    product_dict = utils.read_product_yaml(sensor=sensor)
+
+    ## Sort file dictionary entries by product and tile, skipping tiles without points: {product: {tile: [...]}}
+    products = {}
+    for key, paths in file_dict.items():
+        tile, date = key.split('__')
+        if tile not in tile_points or not start <= date[:8] <= end:
+            continue
+        if sensor == 'sentinel1':
+            prod_key = f"{sensor}_{utils.s1_is_asc_or_desc(file_path=paths[0])}.yaml"
+        else:
+            prod_key = f"{sensor}.yaml"
+        products.setdefault(prod_key, {}).setdefault(tile, []).append((date, paths))
+
+    if len(products) == 0:
+        print(f"No level-2 files of {sensor} found for the points in {points} between {start} and {end}.")
+        return
+
+    writer = None
+    frames = []
+    n_rows = 0
+    try:
+        for prod_key, tiles in products.items():
+            name = product_dict[prod_key]['name']
+            print(f"\n#### Extracting {name} for {sum([len(tile_points[t][0]) for t in tiles])} points "
+                  f"in {len(tiles)} tiles")
+
+            pool = mp.Pool(nproc)
+            result_objects = [pool.apply_async(_extract_tile, args=(tile, sorted(entries), sensor,
+                                                                    product_dict[prod_key]['band_names'], name,
+                                                                    *tile_points[tile]))
+                              for tile, entries in tiles.items()]
+
+            total = len(result_objects)
+            for i, r in enumerate(result_objects):
+                tile, frame = r.get()
+                utils.progress(i + 1, total, status=f"{tile}: {len(frame)} rows")
+                if len(frame) == 0:
+                    continue
+                n_rows += len(frame)
+
+                ## Parquet files are written tile by tile (one row group per tile), so the complete table never needs
+                ## to be kept in memory
+                if out_path.endswith('.parquet'):
+                    writer = utils.write_parquet(writer=writer, out_path=out_path, frame=frame)
+                else:
+                    frames.append(frame)
+
+            pool.close()
+            pool.join()
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if len(frames) > 0:
+        ## One-dimensional 'obs' dimension with 'point_id' and 'date' as variables, as points of different tiles and
+        ## orbits have different dates and a (point_id, date) grid would mostly contain NaN
+        table = pd.concat(frames, ignore_index=True)
+        table.rename_axis('obs').to_xarray().to_netcdf(out_path)
+
+    print(f"\n{n_rows} rows written to {out_path}")
+
+
+def _get_tile_points(points, id_field, prj):
+    """Helper function for extract_points() to read the points, transform them into the projection of the data cube
+    and assign them to tiles. Returns a dictionary of the form {'X0001_Y0001': (ids, xs, ys)} with one array of point
+    IDs and coordinates (projection units) per tile."""
+
+    gdf = gpd.read_file(points)
+    if not all(gdf.geometry.geom_type == 'Point'):
+        raise ValueError(f"{points} may only contain point geometries.")
+
+    gdf = gdf.to_crs(prj['wkt'])
+    ids = gdf[id_field].values if id_field is not None else gdf.index.values
+    xs = gdf.geometry.x.values
+    ys = gdf.geometry.y.values
+
+    tile_x = np.floor((xs - prj['origin_x']) / prj['tile_size']).astype(int)
+    tile_y = np.floor((prj['origin_y'] - ys) / prj['tile_size']).astype(int)
+
+    tile_points = {}
+    tiles, inverse = np.unique(np.stack([tile_x, tile_y], axis=1), axis=0, return_inverse=True)
+    for i, (tx, ty) in enumerate(tiles):
+        selection = inverse.ravel() == i
+        tile_points[datacube.tile_name(tile_x=tx, tile_y=ty)] = (ids[selection], xs[selection], ys[selection])
+
+    return tile_points
+
+
+def _extract_tile(tile, entries, sensor, band_names, product, ids, xs, ys):
+    """Helper function executed in extract_points() which extracts the values of all points of a single tile. Points
+    are sorted by the internal block of the files they are located in, so that each block is read once per date (all
+    bands of a file at once) and the values of all points in it are gathered with a single indexing operation.
+    Returns the tile ID and a DataFrame with one row per point and date."""
+
+    blocks = None
+    columns = {band: [] for band in band_names}
+    dates = []
+    nodata = {}
+    for date, paths in entries:
+        sources = raster.open_band_sources(paths=paths, sensor=sensor, band_names=band_names)
+        try:
+            if blocks is None:
+                ids, rows, cols, blocks = _get_point_blocks(dataset=sources[band_names[0]][0], ids=ids, xs=xs, ys=ys)
+                nodata = {band: dataset.nodatavals[index - 1] for band, (dataset, index) in sources.items()}
+            if len(ids) == 0:
+                break
+
+            ## Group bands by file, so that multiband files are read once per block
+            readers = {}
+            for band, (dataset, index) in sources.items():
+                readers.setdefault(dataset, []).append((band, index))
+
+            for dataset, bands in readers.items():
+                values = np.empty((len(bands), len(ids)), dtype=dataset.dtypes[bands[0][1] - 1])
+                for window, i0, i1 in blocks:
+                    data = dataset.read([index for _, index in bands], window=window)
+                    values[:, i0:i1] = data[:, rows[i0:i1] - window.row_off, cols[i0:i1] - window.col_off]
+                for i, (band, _) in enumerate(bands):
+                    columns[band].append(values[i])
+        finally:
+            raster.close_band_sources(sources=sources)
+
+        dates.append(pd.to_datetime(date, format='%Y%m%dT%H%M%S' if 'T' in date else '%Y%m%d'))
+
+    if blocks is None or len(ids) == 0 or len(dates) == 0:
+        return tile, pd.DataFrame()
+
+    frame = pd.DataFrame({'point_id': np.tile(ids, len(dates)),
+                          'product': product,
+                          'tile': tile,
+                          'date': np.repeat(np.array(dates, dtype='datetime64[ns]'), len(ids))})
+
+    ## No data is converted to NaN for all bands except the quality band, whose values are bit flags
+    valid = np.zeros(len(frame), dtype=bool)
+    for band in band_names:
+        values = np.concatenate(columns[band])
+        if band != 'pixel_qa':
+            values = values.astype('float32')
+            if nodata[band] is not None:
+                values[values == nodata[band]] = np.nan
+            valid |= np.isfinite(values)
+        frame[band] = values
+
+    return tile, frame[valid].reset_index(drop=True)
+
+
+def _get_point_blocks(dataset, ids, xs, ys):
+    """Helper function for _extract_tile() to convert the point coordinates into pixel indices of a tile and sort the
+    points by the internal block of the file they are located in. Points outside of the tile are dropped.
+    Returns the sorted point IDs, rows and columns, as well as a list of (window, start, stop) tuples with the window
+    of each block and the range of points located in it."""
+
+    rows, cols = rasterio.transform.rowcol(dataset.transform, xs, ys)
+    rows = np.asarray(rows, dtype=int)
+    cols = np.asarray(cols, dtype=int)
+
+    inside = (rows >= 0) & (rows < dataset.height) & (cols >= 0) & (cols < dataset.width)
+    ids, rows, cols = ids[inside], rows[inside], cols[inside]
+
+    block_height, block_width = dataset.block_shapes[0]
+    block_row = rows // block_height
+    block_col = cols // block_width
+    order = np.lexsort((block_col, block_row))
+    ids, rows, cols = ids[order], rows[order], cols[order]
+    keys = block_row[order] * (dataset.width // block_width + 1) + block_col[order]
+
+    _, starts = np.unique(keys, return_index=True)
+    stops = np.append(starts[1:], len(keys))
+
+    blocks = []
+    for i0, i1 in zip(starts, stops):
+        row_off = rows[i0] // block_height * block_height
+        col_off = cols[i0] // block_width * block_width
+        window = Window(col_off, row_off, min(block_width, dataset.width - col_off),
+                        min(block_height, dataset.height - row_off))
+        blocks.append((window, i0, i1))
+
+    return ids, rows, cols, blocks
+
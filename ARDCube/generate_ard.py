@@ -1,20 +1,35 @@
-from ARDCube.config import get_settings, PROJ_DIR, FORCE_PATH, PYROSAR_PATH, SAT_DICT
+from ARDCube.config import get_settings, PROJ_DIR, SAT_DICT, get_setting, get_setting_bool
 import ARDCube.utils.general as utils
 import ARDCube.utils.force as force
+import ARDCube.utils.raster as raster
+import ARDCube.utils.datacube as datacube
+import ARDCube.utils.journal as journal
+import ARDCube.utils.sentinel1 as sentinel1
+import ARDCube.utils.executor as executor
+import ARDCube.utils.scheduler as scheduler
+import ARDCube.utils.tasks as tasks
+import ARDCube.utils.cluster as cluster
 
 import os
 import glob
+import json
+import time
+import hashlib
+import shutil
+import tempfile
 import multiprocessing as mp
 from datetime import datetime
-from spython.main import Client
 import fiona
 import geopandas as gpd
+import numpy as np
 import rasterio
 import rasterio.mask
-from rasterio.windows import get_data_window
+from rasterio.errors import WindowError
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.windows import Window, get_data_window
 
 
-def generate_ard(sensor, debug=False, clean=False):
+def generate_ard(sensor, debug=False, clean=False, force_all=False):
     """Main function of this module. Will either run process_sar() or process_optical(), depending on chosen sensor.
 
     Parameters
@@ -27,6 +42,8 @@ def generate_ard(sensor, debug=False, clean=False):
         Optional parameter to print Singularity debugging information.
     clean: boolean (optional)
         Optional parameter to automatically delete intermediate files. Only passed to process_sar()!
+    force_all: boolean (optional)
+        Optional parameter to ignore the state journal and process all scenes again. Only passed to process_sar()!
     """
 
     settings = get_settings()
@@ -43,22 +60,37 @@ def generate_ard(sensor, debug=False, clean=False):
     if sensor == 'sentinel1':
         process_sar(settings=settings,
                     debug=debug,
-                    clean=clean)
+                    clean=clean,
+                    force_all=force_all)
     else:
         process_optical(settings=settings,
                         sensor=sensor,
                         debug=debug)
 
 
-def process_sar(settings, debug=False, clean=False):
+def process_sar(settings, debug=False, clean=False, force_all=False):
     """Process SAR satellite data to an ARD format.
     First, radiometrically terrain-corrected gamma nought backscatter is produced via the pyroSAR Singularity container.
     This is achieved by executing the script /settings/pyrosar/snap.py inside the container and passing all necessary
     parameters as additional arguments. The script itself uses pyroSAR's snap.geocode module.
     As a second step, the processed scenes are clipped to the AOI using _crop_by_aoi(), while also excluding any rasters
     that only have no data values located inside the AOI.
-    Finally, force.cube_dataset() is used to bring the dataset into the same data cube format (projection &
-    non-overlapping grid) as already processed optical datasets.
+    Finally, the dataset is brought into the same data cube format (projection & non-overlapping grid) as already
+    processed optical datasets, either in-process with datacube.cube_dataset() or with force.cube_dataset(), depending
+    on the 'CubeEngine' field in 'settings.prm'.
+    If multiple AOIs are provided in 'settings.prm', scenes are downloaded and geocoded once for the union of all AOIs
+    and then cropped and tiled separately for each AOI into /level2/sentinel1__{aoi_name} (see _get_sar_aois()).
+    SNAP always geocodes in linear scale. All scalings defined in the 'Scaling' field (e.g. dB, amplitude) are derived
+    while cropping, the first one into /level2/sentinel1 and all others into /level2/sentinel1_{scaling} .
+    Consecutive slices of the same datatake are assembled and geocoded together if 'AssembleSlices' is True.
+    Orbit files for all scenes are prefetched into /{ProjectDirectory}/data/misc/osv , which is bind-mounted as the
+    orbit directory of SNAP inside the container.
+    Scenes whose footprint only covers a small fraction of the AOI are skipped or deferred before geocoding, depending
+    on the 'MinOverlap' and 'LowOverlap' fields in 'settings.prm'.
+    Completed stages are recorded per scene in the state journal (see ARDCube.utils.journal), so that only scenes
+    whose input or relevant settings changed are geocoded and cropped again when the processing is repeated.
+    If a 'DiskBudget' is defined in 'settings.prm', scenes are geocoded, cropped and tiled in batches that fit into
+    the budget (see _process_sar_batches()).
 
     Parameters
     ----------
@@ -67,34 +99,58 @@ def process_sar(settings, debug=False, clean=False):
     debug: boolean (optional)
         Optional parameter to print Singularity debugging information.
     clean: boolean (optional)
-        If True, _crop_by_aoi() will delete each source GeoTIFF after cropping automatically and remove the empty
+        If True, _crop_by_aoi() will delete each source GeoTIFF after it was cropped to all AOIs and remove the empty
         intermediate directory ('sentinel1_pyrosar') afterwards as well.
+    force_all: boolean (optional)
+        If True, the state journal is ignored and all scenes are processed again.
     """
 
-    Client.debug = debug
     if debug:
         quiet = False
     else:
         quiet = True
 
     p = _collect_params(settings=settings)
-    utils.isdir_mkdir(directory=[p['out_dir_tmp'], p['out_dir']])
+    out_dirs = [directory for _, out_dir in p['aois']
+                for _, directory in _get_scaling_dirs(directory=out_dir, scalings=_get_scalings(settings=settings))]
+    utils.isdir_mkdir(directory=[p['out_dir_tmp'], p['osv_dir']] + out_dirs)
 
-    n_scenes = len(glob.glob1(p['in_dir'], 'S1*zip'))
+    conn = journal.connect()
+    scenes = sorted(glob.glob(os.path.join(p['in_dir'], 'S1*zip')))
+    scenes, low_overlap = _prefilter_scenes(settings=settings, conn=conn, scenes=scenes)
+    queue = _get_sar_queue(settings=settings, conn=conn, scenes=scenes, force_all=force_all)
 
-    while True:
-        answer = input(f"{n_scenes} level-1 scenes were found in {p['in_dir']}\n"
-                       f"Do you want to proceed with the batch processing of all {n_scenes} scenes? (y/n)")
+    geocoded = []
+    while len(queue) > 0:
+        answer = input(f"{len(scenes)} level-1 scenes were found in {p['in_dir']}\n"
+                       f"{len(queue)} of them have not been processed yet or their input or settings changed.\n"
+                       f"Do you want to proceed with the batch processing of {len(queue)} scenes? (y/n)")
 
         if answer in ['y', 'yes']:
-            ## Execute snap.py inside pyroSAR Singularity container
-            out = Client.execute(PYROSAR_PATH, ["python", p['snap_py'],
-                                                p['in_dir'], p['out_dir_tmp'], p['tr'], p['pol'], p['aoi_path'],
-                                                p['scaling'],
-                                                p['dem_path'], p['dem_nodata'], p['speckle'], p['refarea']],
-                                 options=["--cleanenv"], quiet=quiet, stream=True)
-            for line in out:
-                print(line, end='')
+            _defer_scenes(settings=settings, scenes=low_overlap, directory=p['in_dir'])
+
+            if get_setting_bool(settings=settings, section='PROCESSING', field='AssembleSlices'):
+                groups = sentinel1.group_slices(scenes=list(queue.keys()))
+                print(f"{len(queue)} scenes were grouped into {len(groups)} groups of consecutive slices.")
+            else:
+                groups = [[scene] for scene in queue.keys()]
+
+            if get_setting_bool(settings=settings, section='SNAP', field='OSVPrefetch'):
+                print("\n#### Prefetching orbit files...")
+                server = get_setting(settings=settings, section='SNAP', field='OSVServer')
+                osv = sentinel1.prefetch_osv(scenes=list(queue.keys()), osv_dir=p['osv_dir'], server=server)
+                missing = [scene for scene, osv_file in osv.items() if osv_file is None]
+                print(f"Orbit files available for {len(osv) - len(missing)} of {len(osv)} scenes in {p['osv_dir']}")
+                for scene in missing:
+                    print(f"No orbit file found for {os.path.basename(scene)}")
+
+            if float(get_setting(settings=settings, section='PROCESSING', field='DiskBudget')) > 0:
+                _process_sar_batches(settings=settings, p=p, conn=conn, queue=queue, groups=groups, out_dirs=out_dirs,
+                                     quiet=quiet, debug=debug, force_all=force_all)
+            else:
+                geocoded = _geocode_groups(settings=settings, p=p, conn=conn, queue=queue, groups=groups, quiet=quiet,
+                                           debug=debug)
+            break
 
         elif answer in ['n', 'no']:
             print("\n#### Processing cancelled...")
@@ -104,18 +160,219 @@ def process_sar(settings, debug=False, clean=False):
             continue
 
     print("\n#### Cropping rasters to AOI...")
-    _crop_by_aoi(settings=settings, directory_src=p['out_dir_tmp'], directory_dst=p['out_dir'], clean=clean)
+    failed = _crop_by_aoi(settings=settings, directory_src=p['out_dir_tmp'], aois=p['aois'], clean=clean,
+                          conn=conn, force_all=force_all)
+    _release_level1(settings=settings, groups=geocoded, failed=failed)
 
-    print("\n#### Reprojecting rasters and creating non-overlapping tiles...")
-    force.cube_dataset(directory=p['out_dir'])
+    for out_dir in out_dirs:
+        if len(out_dirs) > 1:
+            print(f"\n#### Processing {os.path.basename(out_dir)}...")
+        _cube_sar(settings=settings, directory=out_dir, conn=conn)
 
-    print("\n#### Finished processing! Creating additional outputs...\n")
-    force.create_mosaics(directory=p['out_dir'])
-    force.create_kml_grid(directory=p['out_dir'])
+    conn.close()
 
     print("Done!")
 
 
+def _process_sar_batches(settings, p, conn, queue, groups, out_dirs, quiet, debug, force_all):
+    """Helper function for process_sar() to process the groups of level-1 scenes in batches, so that the intermediate
+    files in the pyroSAR output directory don't exceed the 'DiskBudget' (GB) defined in 'settings.prm'. Groups are only
+    admitted into geocoding if their estimated space fits into the budget and the free space of the volume (see
+    ARDCube.utils.scheduler.next_batch()). The estimate is based on the size of the level-1 scenes and corrected with
+    the space actually used by each batch. After each batch, the geocoded files are cropped (and deleted afterwards)
+    and the cropped files are tiled (and deleted afterwards as well), before the next batch is admitted. Level-1
+    scenes of finished groups are moved to 'ColdStorage' if it is defined."""
+
+    budget = float(get_setting(settings=settings, section='PROCESSING', field='DiskBudget')) * 1024 ** 3
+    ratio = scheduler.DEFAULT_RATIO
+
+    pending = groups
+    n_batch = 0
+    while len(pending) > 0:
+        utils.isdir_mkdir(directory=p['out_dir_tmp'])
+        batch, pending, estimate = scheduler.next_batch(groups=pending, directory=p['out_dir_tmp'], budget=budget,
+                                                        ratio=ratio)
+        if len(batch) == 0:
+            raise RuntimeError(f"Not enough space left for geocoding in {p['out_dir_tmp']}. Remove the files that "
+                               f"could not be cropped or increase 'DiskBudget'.")
+
+        n_batch += 1
+        print(f"\n#### Batch {n_batch}: Geocoding {len(batch)} groups (~{estimate / 1024 ** 3:.1f} GB), "
+              f"{len(pending)} groups pending...")
+        size_before = scheduler.dir_size(directory=p['out_dir_tmp'])
+        geocoded = _geocode_groups(settings=settings, p=p, conn=conn, queue=queue, groups=batch, quiet=quiet,
+                                   debug=debug)
+        ratio = scheduler.update_ratio(ratio=ratio, groups=batch,
+                                       used=scheduler.dir_size(directory=p['out_dir_tmp']) - size_before)
+
+        print(f"\n#### Batch {n_batch}: Cropping rasters to AOI...")
+        failed = _crop_by_aoi(settings=settings, directory_src=p['out_dir_tmp'], aois=p['aois'], clean=True,
+                              conn=conn, force_all=force_all)
+        _release_level1(settings=settings, groups=geocoded, failed=failed)
+
+        for out_dir in out_dirs:
+            _cube_sar(settings=settings, directory=out_dir, conn=conn, finish=False)
+
+
+def _geocode_groups(settings, p, conn, queue, groups, quiet, debug):
+    """Helper function for process_sar() to geocode groups of level-1 scenes by executing snap.py inside the pyroSAR
+    Singularity container. Each line of the queue file is a group of slices, which is assembled before geocoding.
+    Groups that fail are written to a failures file by snap.py, so that the remaining groups are processed anyway.
+    Failed groups are classified (see ARDCube.utils.tasks.classify()) and 'transient' or 'unknown' failures are
+    geocoded again based on the retry policy of the [EXECUTION] section in 'settings.prm'. Groups that still fail are
+    added to the dead-letter list. The same applies to groups without output or failure entry, e.g. if snap.py crashed
+    or was killed. Returns the list of groups that were geocoded successfully (see _record_geocoded())."""
+
+    retries, backoff = tasks.get_retry_policy(settings=settings)
+    timeout = tasks.get_timeout(settings=settings) or 0
+
+    utils.isdir_mkdir(directory=[p['out_dir_tmp'], os.path.dirname(p['failures_file'])])
+
+    pending = groups
+    attempt = 0
+    while len(pending) > 0:
+        attempt += 1
+        with open(p['queue_file'], 'w') as f:
+            f.writelines(["\t".join(group) + "\n" for group in pending])
+        open(p['failures_file'], 'w').close()
+
+        ## Execute snap.py inside pyroSAR Singularity container. The exit status is checked, so that a crash of snap.py
+        ## is noticed as well.
+        run_error = None
+        try:
+            out = executor.execute(tool='pyrosar',
+                                   args=["python", p['snap_py'],
+                                         p['in_dir'], p['out_dir_tmp'], p['tr'], p['pol'], p['aoi_path'],
+                                         p['scaling'],
+                                         p['dem_path'], p['dem_nodata'], p['speckle'], p['refarea'],
+                                         p['queue_file'],
+                                         p['snap']['memory'], p['snap']['cache'], p['snap']['threads'],
+                                         p['snap']['tmpdir'], p['snap']['groupsize'], p['snap']['worker'],
+                                         p['failures_file'], str(timeout)],
+                                   binds=[f"{p['snap']['tmpdir']}:{p['snap']['tmpdir']}",
+                                          f"{p['osv_dir']}:{p['osv_dir_snap']}"],
+                                   quiet=quiet, stream=True, debug=debug, check=True)
+            for line in out:
+                print(line, end='')
+        except Exception as e:
+            run_error = f"{type(e).__name__}: {e}"
+            print(f"\nsnap.py did not finish: {run_error}")
+
+        ## Groups of this attempt without output and without entry in the failures file are handled as failed groups
+        failures = _read_snap_failures(failures_file=p['failures_file'], groups=groups)
+        accounted = _get_geocoded_scenes(directory=p['out_dir_tmp'])
+        accounted.update([journal.s1_scene_id(group[0]) for group, _ in failures])
+        for group in pending:
+            if journal.s1_scene_id(group[0]) not in accounted:
+                failures.append((group, run_error or "snap.py finished without output or failure entry"))
+
+        pending = []
+        for group, message in failures:
+            error_class = tasks.classify(message=message)
+            if error_class in tasks.RETRY_CLASSES and attempt <= retries:
+                pending.append(group)
+                continue
+
+            for scene in group:
+                tasks.dead_letter(sensor='sentinel1', stage='geocoded', scene=journal.s1_scene_id(scene),
+                                  error_class=error_class, message=message, attempts=attempt,
+                                  input_hash=queue.get(scene))
+            print(f"\n{journal.s1_scene_id(group[0])} failed at stage 'geocoded' ({error_class}, {attempt} "
+                  f"attempts): {message}")
+
+        if len(pending) > 0:
+            wait = backoff * 2 ** (attempt - 1)
+            print(f"\n#### Retrying {len(pending)} failed groups in {wait:.0f} s...")
+            time.sleep(wait)
+
+    return _record_geocoded(settings=settings, conn=conn, queue=queue, groups=groups, directory=p['out_dir_tmp'])
+
+
+def _read_snap_failures(failures_file, groups):
+    """Helper function for _geocode_groups() to read the failures file written by snap.py. Returns a list of
+    (group, error_message) tuples, where group is the matching entry of 'groups'. Scenes of entries that don't match
+    a group are replaced by the matching paths of 'groups' if possible."""
+
+    if not os.path.isfile(failures_file):
+        return []
+
+    by_first = {os.path.basename(group[0]): group for group in groups}
+    by_name = {os.path.basename(scene): scene for group in groups for scene in group}
+    failures = []
+    with open(failures_file, 'r') as f:
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+            entry = json.loads(line)
+            group = by_first.get(os.path.basename(entry['scenes'][0]))
+            if group is None:
+                group = [by_name.get(os.path.basename(scene), scene) for scene in entry['scenes']]
+            failures.append((group, entry['error']))
+
+    return failures
+
+
+def _release_level1(settings, groups, failed):
+    """Helper function for process_sar() to move the level-1 scenes of geocoded groups to the directory defined in the
+    'ColdStorage' field of 'settings.prm', once their outputs were cropped without errors. Nothing is moved if the field
+    is empty."""
+
+    cold_dir = get_setting(settings=settings, section='PROCESSING', field='ColdStorage')
+    if len(cold_dir) == 0 or len(groups) == 0:
+        return
+
+    finished = [group for group in groups if journal.s1_scene_id(group[0]) not in failed]
+    n_moved = scheduler.release_level1(groups=finished, cold_dir=cold_dir)
+    print(f"{n_moved} level-1 scenes were moved to {cold_dir}")
+
+
+def _cube_sar(settings, directory, conn, finish=True):
+    """Helper function for process_sar() to bring the cropped scenes of one output directory into the data cube format
+    and create additional outputs (mosaics, KML grid). Tiled scenes are recorded in the state journal using the name of
+    the output directory (e.g. 'sentinel1' or 'sentinel1__my_aoi') as sensor. If 'finish' is False, only the cropped
+    scenes are tiled, which is used to release them between batches (see _process_sar_batches())."""
+
+    ## Cropped files that are still located in the output directory will be tiled next
+    to_cube = _group_by_scene(file_list=glob.glob(os.path.join(directory, '*.tif')))
+    to_cube = {scene: journal.file_fingerprint(files, quick=True) for scene, files in to_cube.items()}
+
+    print("\n#### Reprojecting rasters and creating non-overlapping tiles...")
+    if get_setting(settings=settings, section='PROCESSING', field='CubeEngine') == 'force':
+        force.cube_dataset(directory=directory, settings=settings)
+    else:
+        datacube.cube_dataset(directory=directory, resolution=int(settings['PROCESSING']['TargetResolution']),
+                              nproc=settings['PROCESSING']['NPROC'],
+                              profile=raster.get_output_profile(settings=settings),
+                              env=raster.get_gdal_env(settings=settings, stage='write'))
+
+    ## Input files are removed after tiling, so any scene without remaining files has been tiled successfully
+    remaining = _group_by_scene(file_list=glob.glob(os.path.join(directory, '*.tif')))
+    settings_hash = journal.settings_fingerprint(settings=settings, stage='cubed')
+    for scene, input_hash in to_cube.items():
+        if scene not in remaining:
+            journal.record(conn=conn, sensor=os.path.basename(directory), scene=scene, stage='cubed',
+                           input_hash=input_hash, settings_hash=settings_hash)
+
+    if not finish:
+        return
+
+    print("\n#### Checking for empty tiles...")
+    action = get_setting(settings=settings, section='PROCESSING', field='EmptyTiles')
+    raster.handle_empty_tiles(directory=directory, action=action,
+                              nproc=settings['PROCESSING']['NPROC'],
+                              env=raster.get_gdal_env(settings=settings, stage='headerscan'))
+
+    print("\n#### Applying output profile to level-2 tiles...")
+    raster.optimize_tiles(directory=directory, profile=raster.get_output_profile(settings=settings),
+                          nproc=settings['PROCESSING']['NPROC'],
+                          env=raster.get_gdal_env(settings=settings, stage='write'))
+
+    print("\n#### Finished processing! Creating additional outputs...\n")
+    tiles = datacube.walk_tiles(directory=directory)
+    datacube.create_mosaics(directory=directory, tiles=tiles)
+    datacube.create_kml_grid(directory=directory, tiles=tiles)
+
+
 def process_optical(settings, sensor, debug=False):
     """Process optical satellite data to an ARD format.
     The module 'force-level2' will be executed inside the FORCE Singularity container.
@@ -135,7 +392,6 @@ def process_optical(settings, sensor, debug=False):
         Optional parameter to print Singularity debugging information.
     """
 
-    Client.debug = debug
     if debug:
         quiet = False
     else:
@@ -150,12 +406,17 @@ def process_optical(settings, sensor, debug=False):
               "you cannot track the progress in here. However, you can regularly check the queue file mentioned \n"
               "above to see if the processing continues as expected.")
 
-        Client.execute(FORCE_PATH, ["force-level2", prm_file],
-                       options=["--cleanenv"], quiet=quiet)
+        executor.execute(tool='force', args=["force-level2", prm_file], quiet=quiet, debug=debug)
+
+        print("\n#### Applying output profile to level-2 tiles...")
+        raster.optimize_tiles(directory=out_dir, profile=raster.get_output_profile(settings=settings),
+                              nproc=settings['PROCESSING']['NPROC'],
+                              env=raster.get_gdal_env(settings=settings, stage='write'))
 
         print("\n#### Finished processing! Creating additional outputs...\n")
-        force.create_mosaics(directory=out_dir)
-        force.create_kml_grid(directory=out_dir)
+        tiles = datacube.walk_tiles(directory=out_dir)
+        datacube.create_mosaics(directory=out_dir, tiles=tiles)
+        datacube.create_kml_grid(directory=out_dir, tiles=tiles)
 
         print("Done!")
 
@@ -170,21 +431,292 @@ def _collect_params(settings):
         'snap_py': os.path.join(PROJ_DIR, 'management', 'settings', 'pyrosar', 'snap.py'),
         'in_dir': os.path.join(data_dir, 'level1', 'sentinel1'),
         'out_dir_tmp': os.path.join(data_dir, 'level2', 'sentinel1_pyrosar'),
-        'out_dir': os.path.join(data_dir, 'level2', 'sentinel1'),
+        'aois': _get_sar_aois(settings=settings, level2_dir=os.path.join(data_dir, 'level2')),
+        'queue_file': os.path.join(data_dir, 'temp', 'sentinel1__snap_queue.txt'),
+        'failures_file': os.path.join(data_dir, 'temp', 'sentinel1__snap_failures.jsonl'),
+        'osv_dir': os.path.join(data_dir, 'misc', 'osv'),
+        'osv_dir_snap': os.path.join(os.path.expanduser('~'), '.snap', 'auxdata', 'Orbits', 'Sentinel-1'),
         'aoi_path': utils.get_aoi_path(settings=settings),
         'dem_path': utils.get_dem_path(settings=settings)[0],
         'dem_nodata': utils.get_dem_path(settings=settings)[1],
         'tr': settings['PROCESSING']['TargetResolution'],
         'pol': settings['PROCESSING']['Polarizations'],
-        'scaling': settings['PROCESSING']['Scaling'],
+        'scaling': 'linear',
         'speckle': settings['PROCESSING']['SpeckleFilter'],
-        'refarea': settings['PROCESSING']['RefArea']
+        'refarea': settings['PROCESSING']['RefArea'],
+        'snap': _get_snap_profile(settings=settings)
     }
 
 
-def _crop_by_aoi(settings, directory_src, directory_dst, clean):
-    """Helper function for process_sar() to crop SAR scenes to the AOI. Sets up a multiprocessing pool and calls the
-    helper function _do_crop() with Pool.apply_async()."""
+def _get_sar_aois(settings, level2_dir):
+    """Helper function for _collect_params() to return a list of (aoi_path, output_directory) tuples. If only a single
+    AOI is provided in 'settings.prm', the output directory is /level2/sentinel1 . Otherwise each AOI gets its own
+    output directory /level2/sentinel1__{aoi_name} ."""
+
+    aoi_paths = utils.get_aoi_paths(settings=settings)
+
+    if len(aoi_paths) == 1:
+        return [(aoi_paths[0], os.path.join(level2_dir, 'sentinel1'))]
+    else:
+        return [(aoi_path, os.path.join(level2_dir, f"sentinel1__{utils.get_aoi_name(aoi_path=aoi_path)}"))
+                for aoi_path in aoi_paths]
+
+
+def _get_scalings(settings):
+    """Helper function to return the list of scalings defined (comma-separated) in the 'Scaling' field of
+    'settings.prm', e.g. ['dB', 'linear']. See sentinel1.SCALINGS for valid options."""
+
+    scalings = [s.strip() for s in settings['PROCESSING']['Scaling'].split(',') if len(s.strip()) > 0]
+
+    ## pyroSAR uses lowercase 'db'
+    scalings = ['dB' if s.lower() == 'db' else s for s in scalings]
+
+    for scaling in scalings:
+        if scaling not in sentinel1.SCALINGS:
+            raise ValueError(f"{scaling} not recognized. Valid options for 'Scaling' are: "
+                             f"{list(sentinel1.SCALINGS.keys())}")
+    if len(scalings) == 0:
+        raise RuntimeError("Field 'Scaling': Input missing!")
+
+    return scalings
+
+
+def _get_scaling_dirs(directory, scalings):
+    """Helper function to return a list of (scaling, output_directory) tuples for an output directory. The first
+    scaling is written to the output directory itself (e.g. /level2/sentinel1), all others to sibling directories
+    (e.g. /level2/sentinel1_linear)."""
+
+    return [(scaling, directory if i == 0 else f"{directory}_{scaling}") for i, scaling in enumerate(scalings)]
+
+
+def _get_snap_profile(settings):
+    """Helper function for _collect_params() to get the resources used by SNAP gpt from the section [SNAP] of
+    'settings.prm'. Each field set to 'auto' is derived from the machine:
+    - Memory: 75 % of the physical memory (JVM heap, passed as -J-Xmx)
+    - Cache: 65 % of Memory (tile cache, passed as -c)
+    - Threads: number of CPUs (passed as -q)
+    - TmpDir: /dev/shm if it has at least 'Memory' free space, otherwise the temporary directory of the system
+    - GroupSize: 1 if Memory is below 32 GB, otherwise 2 (number of nodes pyroSAR executes per gpt call)
+    'Worker' is either 'gpt' (a new gpt process per workflow) or 'persistent' (all workflows are executed in a single
+    JVM, see /settings/pyrosar/snap_worker.py).
+    Returns a dictionary with memory and cache in GB as strings (e.g. '24G')."""
+
+    snap = {field: get_setting(settings=settings, section='SNAP', field=field)
+            for field in ['Memory', 'Cache', 'Threads', 'TmpDir', 'GroupSize', 'Worker']}
+    total_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+
+    if snap['Memory'] == 'auto':
+        memory = max(2, int(total_gb * 0.75))
+    else:
+        memory = int(snap['Memory'].upper().rstrip('G'))
+
+    if snap['Cache'] == 'auto':
+        cache = max(1, int(memory * 0.65))
+    else:
+        cache = int(snap['Cache'].upper().rstrip('G'))
+
+    if cache >= memory:
+        raise ValueError(f"The SNAP tile cache ({cache}G) needs to be smaller than the JVM heap ({memory}G)!")
+
+    if snap['Threads'] == 'auto':
+        threads = os.cpu_count()
+    else:
+        threads = int(snap['Threads'])
+
+    if snap['TmpDir'] == 'auto':
+        if os.path.isdir('/dev/shm') and shutil.disk_usage('/dev/shm').free / 1024 ** 3 >= memory:
+            tmpdir = os.path.join('/dev/shm', 'ardcube_snap')
+        else:
+            tmpdir = os.path.join(tempfile.gettempdir(), 'ardcube_snap')
+    else:
+        tmpdir = snap['TmpDir']
+    os.makedirs(tmpdir, exist_ok=True)
+
+    if snap['GroupSize'] == 'auto':
+        groupsize = 1 if memory < 32 else 2
+    else:
+        groupsize = int(snap['GroupSize'])
+
+    if snap['Worker'] not in ['gpt', 'persistent']:
+        raise ValueError(f"{snap['Worker']} not recognized. Valid options for 'Worker' are: ['gpt', 'persistent']")
+
+    return {'memory': f"{memory}G",
+            'cache': f"{cache}G",
+            'threads': str(threads),
+            'tmpdir': tmpdir,
+            'groupsize': str(groupsize),
+            'worker': snap['Worker']}
+
+
+def _prefilter_scenes(settings, conn, scenes):
+    """Helper function for process_sar() to exclude level-1 scenes that cover less than 'MinOverlap' percent of the AOI
+    before geocoding them. Footprints are read from the zip files in parallel (see sentinel1.aoi_overlap()) and the
+    overlap is cached in the state journal per file fingerprint and AOI, so each scene is only read once. Scenes whose
+    footprint can't be read are kept. All decisions are logged. Nothing is moved here, see _defer_scenes().
+    Returns a tuple of the list of scenes that should be geocoded and the list of excluded scenes."""
+
+    min_overlap = float(get_setting(settings=settings, section='PROCESSING', field='MinOverlap'))
+    action = get_setting(settings=settings, section='PROCESSING', field='LowOverlap')
+    if action not in ['skip', 'defer']:
+        raise ValueError(f"{action} not recognized. Valid options for 'LowOverlap' are: ['skip', 'defer']")
+
+    if min_overlap <= 0 or len(scenes) == 0:
+        return scenes, []
+
+    aoi = gpd.read_file(utils.get_aoi_path(settings=settings)).to_crs(4326).unary_union
+    aoi_hash = hashlib.sha1(aoi.wkb).hexdigest()
+
+    ## Only scenes without cached overlap are read
+    results = []
+    to_read = {}
+    for scene in scenes:
+        input_hash = journal.file_fingerprint(scene)
+        overlap = journal.get_overlap(conn=conn, scene=journal.s1_scene_id(scene), input_hash=input_hash,
+                                      aoi_hash=aoi_hash)
+        if overlap is None:
+            to_read[scene] = input_hash
+        else:
+            results.append((scene, overlap))
+
+    if len(to_read) > 0:
+        pool = mp.Pool(int(settings['PROCESSING']['NPROC']))
+        result_objects = [pool.apply_async(sentinel1.aoi_overlap, args=(scene, aoi)) for scene in to_read.keys()]
+        read = [r.get() for r in result_objects]
+        pool.close()
+        pool.join()
+
+        for scene, overlap in read:
+            if overlap is not None:
+                journal.record_overlap(conn=conn, scene=journal.s1_scene_id(scene), input_hash=to_read[scene],
+                                       aoi_hash=aoi_hash, overlap=overlap)
+        results.extend(read)
+
+    log_dir = os.path.join(settings['GENERAL']['ProjectDirectory'], 'data', 'log')
+    utils.isdir_mkdir(directory=log_dir)
+    log_file = os.path.join(log_dir,
+                            f"{datetime.now().strftime('%Y%m%dT%H%M%S__sentinel1__prefilter')}.log")
+
+    keep = []
+    low = []
+    log = []
+    for scene, overlap in sorted(results):
+        if overlap is None:
+            keep.append(scene)
+            log.append(f"{scene} - footprint could not be read - keep")
+        elif overlap * 100 >= min_overlap:
+            keep.append(scene)
+            log.append(f"{scene} - {overlap * 100:.2f} % of AOI - keep")
+        else:
+            low.append(scene)
+            log.append(f"{scene} - {overlap * 100:.2f} % of AOI - {action}")
+
+    with open(log_file, 'w') as f:
+        for item in log:
+            f.write("%s\n" % item)
+
+    if len(low) > 0:
+        print(f"{len(low)} level-1 scenes cover less than {min_overlap} % of the AOI and will not be "
+              f"processed ({action}). See {log_file} for details.")
+
+    return keep, low
+
+
+def _defer_scenes(settings, scenes, directory):
+    """Helper function for process_sar() to move the level-1 scenes excluded by _prefilter_scenes() to the
+    subdirectory 'deferred' of the level-1 directory, if 'LowOverlap' is set to 'defer'. Otherwise they are left in
+    place (skipped)."""
+
+    if len(scenes) == 0 or get_setting(settings=settings, section='PROCESSING', field='LowOverlap') != 'defer':
+        return
+
+    deferred_dir = os.path.join(directory, 'deferred')
+    utils.isdir_mkdir(directory=deferred_dir)
+    for scene in scenes:
+        shutil.move(scene, os.path.join(deferred_dir, os.path.basename(scene)))
+    print(f"{len(scenes)} level-1 scenes were moved to {deferred_dir}")
+
+
+def _get_sar_queue(settings, conn, scenes, force_all=False):
+    """Helper function for process_sar() to select the level-1 scenes that need to be geocoded, based on the state
+    journal. Scenes that are listed in the dead-letter list with the same input are skipped as well (unless 'force_all'
+    is True), so they are only geocoded again after they were replaced (e.g. downloaded again).
+    Returns a dictionary of the form {'path_to_scene.zip': 'input_hash'}."""
+
+    settings_hash = journal.settings_fingerprint(settings=settings, stage='geocoded')
+    dead = {e['scene']: e['input_hash'] for e in tasks.read_dead_letters(sensor='sentinel1', stage='geocoded')}
+
+    queue = {}
+    n_dead = 0
+    for scene in scenes:
+        scene_id = journal.s1_scene_id(scene)
+        input_hash = journal.file_fingerprint(scene)
+        if not force_all and dead.get(scene_id) == input_hash:
+            n_dead += 1
+            continue
+        if force_all or journal.needs_update(conn=conn, sensor='sentinel1', scene=scene_id,
+                                             stage='geocoded', input_hash=input_hash, settings_hash=settings_hash):
+            queue[scene] = input_hash
+
+    if n_dead > 0:
+        print(f"{n_dead} scenes were skipped, because they failed before with the same input (see "
+              f"{tasks.get_dead_letter_path()}).")
+
+    return queue
+
+
+def _record_geocoded(settings, conn, queue, groups, directory):
+    """Helper function for process_sar() to record all scenes of the queue as geocoded, for which output files exist in
+    the pyroSAR output directory. The output of an assembled group of slices is named after its first slice, so all
+    slices of a group are recorded if it exists. Earlier dead-letter entries of recorded scenes are resolved. Returns
+    the list of groups that were recorded."""
+
+    settings_hash = journal.settings_fingerprint(settings=settings, stage='geocoded')
+    geocoded = _get_geocoded_scenes(directory=directory)
+
+    recorded = []
+    for group in groups:
+        if journal.s1_scene_id(group[0]) in geocoded:
+            for scene in group:
+                journal.record(conn=conn, sensor='sentinel1', scene=journal.s1_scene_id(scene), stage='geocoded',
+                               input_hash=queue[scene], settings_hash=settings_hash)
+            recorded.append(group)
+
+    tasks.resolve_dead_letters(sensor='sentinel1', stage='geocoded',
+                               scenes=[journal.s1_scene_id(scene) for group in recorded for scene in group])
+
+    return recorded
+
+
+def _get_geocoded_scenes(directory):
+    """Helper function to return the set of scene IDs of which output files exist in the pyroSAR output directory."""
+
+    return set(_group_by_scene(file_list=glob.glob(os.path.join(directory, '**/*.tif'), recursive=True)).keys())
+
+
+def _group_by_scene(file_list):
+    """Helper function to group a list of files processed with pyroSAR by scene. Returns a dictionary of the form
+    {'S1A_20200501T171519': ['path_to_VH_band', 'path_to_VV_band']}."""
+
+    scenes = {}
+    for file in file_list:
+        scenes.setdefault(journal.s1_scene_id(file_path=file), []).append(file)
+
+    return scenes
+
+
+def _crop_by_aoi(settings, directory_src, aois, clean, conn=None, force_all=False):
+    """Helper function for process_sar() to crop SAR scenes to one or more AOIs. 'aois' is a list of (aoi_path,
+    output_directory) tuples created by _get_sar_aois(). Calls the helper function _do_crop() or _do_crop_windowed()
+    (depending on the 'CropMode' field in 'settings.prm') for each combination of file and AOI, either in a
+    multiprocessing pool or on a Dask cluster (see ARDCube.utils.cluster.map_tasks()). If 'clean' is True, a source
+    file is only deleted after it was cropped to all AOIs without errors. If a state journal connection is provided,
+    scenes that were already cropped with the same input and settings are skipped (unless 'force_all' is True; their
+    files are still deleted if 'clean' is True) and successfully cropped scenes are recorded. Scenes are expected to
+    be geocoded in linear scale. All scalings defined in the 'Scaling' field are derived while cropping (see
+    _get_scaling_dirs()). Returns the set of scene IDs with at least one file that failed because of an error
+    (fail 3)."""
+
+    scalings = _get_scalings(settings=settings)
 
     log_dir = os.path.join(settings['GENERAL']['ProjectDirectory'], 'data', 'log')
     utils.isdir_mkdir(directory=log_dir)
@@ -195,38 +727,90 @@ def _crop_by_aoi(settings, directory_src, directory_dst, clean):
     for file in glob.iglob(os.path.join(directory_src, '**/*.tif'), recursive=True):
         file_list.append(file)
 
+    ## Skip scenes that were already cropped with the same input and settings
+    if conn is not None:
+        settings_hash = journal.settings_fingerprint(settings=settings, stage='cropped')
+        scenes = {scene: journal.file_fingerprint(files, quick=True)
+                  for scene, files in _group_by_scene(file_list=file_list).items()}
+        if not force_all:
+            scenes = {scene: input_hash for scene, input_hash in scenes.items()
+                      if journal.needs_update(conn=conn, sensor='sentinel1', scene=scene, stage='cropped',
+                                              input_hash=input_hash, settings_hash=settings_hash)}
+        skipped = [file for file in file_list if journal.s1_scene_id(file_path=file) not in scenes]
+        file_list = [file for file in file_list if journal.s1_scene_id(file_path=file) in scenes]
+
+        ## Files of skipped scenes were already cropped to all AOIs and are not needed anymore
+        if clean:
+            for file in skipped:
+                os.remove(file)
+
+    if len(file_list) == 0:
+        print("No scenes need to be cropped.")
+        if clean and os.path.isdir(directory_src) and len(os.listdir(directory_src)) == 0:
+            os.removedirs(directory_src)
+        return set()
+
     ## Get CRS from first file. All other files of the dataset are assumed to be in the same CRS
-    with rasterio.open(file_list[0]) as raster:
-        dst_crs = raster.crs
+    with rasterio.open(file_list[0]) as src:
+        dst_crs = src.crs
 
-    ## Get AOI path and reprojected features
-    aoi_path = utils.get_aoi_path(settings=settings)
-    features = _get_aoi_features(aoi_path=aoi_path, crs=dst_crs)
+    ## Get reprojected features of each AOI
+    features = [_get_aoi_features(aoi_path=aoi_path, crs=dst_crs) for aoi_path, _ in aois]
 
-    ## Set multiprocessing pool
-    nproc = settings['PROCESSING']['NPROC']
-    pool = mp.Pool(nproc)
+    ## Output profile (format, compression, overviews) of the cropped rasters
+    profile = raster.get_output_profile(settings=settings)
+
+    ## GDAL configuration options applied in each process
+    env = raster.get_gdal_env(settings=settings, stage='crop')
 
-    ## Apply function _do_crop() to each file
-    result_objects = [pool.apply_async(_do_crop, args=(file, features, directory_dst, clean)) for file in file_list]
-    results = [f"{r.get()[0]} - {r.get()[1]}" for r in result_objects]
+    ## Apply function _do_crop() or _do_crop_windowed() to each file and AOI
+    if get_setting(settings=settings, section='PROCESSING', field='CropMode') == 'windowed':
+        memory_limit = int(get_setting(settings=settings, section='PROCESSING', field='CropMemoryLimit'))
+        args_list = [(env, _do_crop_windowed, file, features[i], directory_dst, profile, memory_limit, scalings)
+                     for file in file_list for i, (_, directory_dst) in enumerate(aois)]
+    else:
+        args_list = [(env, _do_crop, file, features[i], directory_dst, profile, scalings)
+                     for file in file_list for i, (_, directory_dst) in enumerate(aois)]
+    results = cluster.map_tasks(func=raster.run_with_env, args_list=args_list,
+                                nproc=int(settings['PROCESSING']['NPROC']), settings=settings)
 
-    pool.close()
-    pool.join()
+    ## Files that failed for at least one AOI because of an error (fail 3) are kept
+    failed_files = set([file for file, _, result in results if result.startswith('fail 3')])
+    if clean:
+        for file in file_list:
+            if file not in failed_files:
+                os.remove(file)
+
+    ## Record scenes of which all files were cropped, or excluded because they are outside the AOI / only contain no
+    ## data inside the AOI (fail 1 & 2)
+    failed = set([journal.s1_scene_id(file_path=file) for file in failed_files])
+    if conn is not None:
+        for scene, input_hash in scenes.items():
+            if scene not in failed:
+                journal.record(conn=conn, sensor='sentinel1', scene=scene, stage='cropped', input_hash=input_hash,
+                               settings_hash=settings_hash)
+
+    if len(aois) > 1:
+        results = [f"{file} - {os.path.basename(directory_dst)} - {result}" for file, directory_dst, result in results]
+    else:
+        results = [f"{file} - {result}" for file, _, result in results]
 
     with open(log_file, 'w') as f:
         for item in results:
             f.write("%s\n" % item)
 
-    if clean:
+    if clean and len(os.listdir(directory_src)) == 0:
         os.removedirs(directory_src)
     ## TODO: I need to know which files exactly are left after intermediate GeoTIFF files are removed.
     ## Any metadata files need to be moved to the metadata directory anyway, as otherwise the next step (force.cube)
     ## will have problems!
 
+    return failed
+
 
-def _do_crop(file, features, directory_dst, clean):
-    """Helper function executed in _crop_by_aoi() which does the actual cropping per file."""
+def _do_crop(file, features, directory_dst, profile, scalings):
+    """Helper function executed in _crop_by_aoi() which does the actual cropping per file and AOI. An output is written
+    for each scaling (see _get_scaling_dirs())."""
 
     ## TODO: Rewrite this without writing to a temporary file?
     ## Getting the data window and cropping the output file works without writing to a
@@ -258,16 +842,16 @@ def _do_crop(file, features, directory_dst, clean):
 
                     kwargs = src2.meta.copy()
                     kwargs.update({
-                        'height': window.height,
-                        'width': window.width,
                         'transform': rasterio.windows.transform(window, src2.transform)})
-
-                    out_name = os.path.basename(tmp_tif.replace('_tmp.tif', '.tif'))
-                    out_tif = os.path.join(directory_dst, out_name)
+                    data = src2.read(window=window)
 
                     try:
-                        with rasterio.open(out_tif, 'w', **kwargs) as dst:
-                            dst.write(src2.read(window=window))
+                        for scaling, out_tif in _get_scaled_outputs(file=file, directory_dst=directory_dst,
+                                                                    scalings=scalings):
+                            out_data, out_nodata, out_dtype = sentinel1.convert_scaling(data=data, scaling=scaling,
+                                                                                        nodata=src_nodata)
+                            kwargs.update({'dtype': out_dtype, 'nodata': out_nodata})
+                            raster.write_raster(path=out_tif, array=out_data, meta=kwargs, profile=profile)
                         result = "success"
                     except Exception as e:
                         result = f"fail 3: {e}"
@@ -280,10 +864,129 @@ def _do_crop(file, features, directory_dst, clean):
         except ValueError:
             result = "fail 1: Raster completely outside AOI"
 
-    if clean:
-        os.remove(file)
+    return (file, directory_dst, result)  # Logging information
 
-    return (file, result)  # Logging information
+
+def _do_crop_windowed(file, features, directory_dst, profile, memory_limit, scalings):
+    """Memory-bounded alternative to _do_crop(). The output is processed in windows of full rows, with the number of
+    rows chosen so that a window of all bands (and its conversion to each scaling) does not exceed 'memory_limit' (MB).
+    The AOI mask is rasterized per window. A first pass determines the extent of valid data inside the AOI and a second
+    pass writes the outputs of all scalings incrementally from the same windows, so memory usage stays flat regardless
+    of the scene size."""
+
+    with rasterio.open(file) as src:
+        try:
+            aoi_window = geometry_window(src, features)
+        except (ValueError, WindowError):
+            aoi_window = None
+
+        if aoi_window is None or aoi_window.width < 1 or aoi_window.height < 1:
+            result = "fail 1: Raster completely outside AOI"
+        else:
+            nodata = src.nodata if src.nodata is not None else 0
+            ## All bands of a window plus the AOI mask
+            bytes_per_row = aoi_window.width * (src.count * np.dtype(src.dtypes[0]).itemsize + 1)
+            n_rows = raster.rows_per_window(bytes_per_row=bytes_per_row,
+                                            memory_limit=memory_limit / (1 + len(scalings)),
+                                            block_size=profile['block_size'])
+
+            ## First pass: Extent of valid data (first band) inside the AOI
+            row_min, row_max, col_min, col_max = None, None, None, None
+            for window, data in _iter_masked_windows(src=src, features=features, aoi_window=aoi_window,
+                                                     n_rows=n_rows, nodata=nodata, indexes=1):
+                valid = data != nodata
+                if np.issubdtype(data.dtype, np.floating):
+                    valid &= np.isfinite(data)
+                rows = np.flatnonzero(valid.any(axis=1))
+                if len(rows) == 0:
+                    continue
+                cols = np.flatnonzero(valid.any(axis=0))
+                if row_min is None:
+                    row_min = window.row_off + rows[0]
+                row_max = window.row_off + rows[-1]
+                col_min = min(col_min, window.col_off + cols[0]) if col_min is not None else window.col_off + cols[0]
+                col_max = max(col_max, window.col_off + cols[-1]) if col_max is not None else window.col_off + cols[-1]
+
+            if row_min is None:
+                result = "fail 2: Only nodata of raster inside AOI"
+            else:
+                ## Second pass: Write masked data window by window, converted to each scaling
+                data_window = Window(col_min, row_min, col_max - col_min + 1, row_max - row_min + 1)
+                outputs = _get_scaled_outputs(file=file, directory_dst=directory_dst, scalings=scalings)
+
+                dsts = []
+                try:
+                    for scaling, out_tif in outputs:
+                        out_dtype = sentinel1.SCALINGS[scaling]['dtype']
+                        out_nodata = sentinel1.SCALINGS[scaling]['nodata']
+                        if out_nodata is None:
+                            out_nodata = nodata
+                        meta = src.meta.copy()
+                        meta.update({'driver': 'GTiff',
+                                     'height': data_window.height,
+                                     'width': data_window.width,
+                                     'transform': rasterio.windows.transform(data_window, src.transform),
+                                     'dtype': out_dtype,
+                                     'nodata': out_nodata})
+                        meta.update(raster.gtiff_options(profile=profile, dtype=out_dtype))
+                        if profile['format'] == 'COG':
+                            dsts.append(rasterio.open(out_tif.replace('.tif', '_tmp.tif'), 'w', **meta))
+                        else:
+                            dsts.append(rasterio.open(out_tif, 'w', **meta))
+
+                    for window, data in _iter_masked_windows(src=src, features=features, aoi_window=data_window,
+                                                             n_rows=n_rows, nodata=nodata):
+                        for (scaling, _), dst in zip(outputs, dsts):
+                            out_data = sentinel1.convert_scaling(data=data, scaling=scaling, nodata=nodata)[0]
+                            dst.write(out_data, window=Window(0, window.row_off - data_window.row_off,
+                                                              window.width, window.height))
+
+                    for dst in dsts:
+                        dst.close()
+
+                    if profile['format'] == 'COG':
+                        for _, out_tif in outputs:
+                            raster.convert_raster(src_path=out_tif.replace('.tif', '_tmp.tif'), dst_path=out_tif,
+                                                  profile=profile)
+                            os.remove(out_tif.replace('.tif', '_tmp.tif'))
+                    result = "success"
+                except Exception as e:
+                    for dst in dsts:
+                        dst.close()
+                    ## Remove temporary and incomplete outputs. The source file is kept, so it is cropped again later.
+                    for _, out_tif in outputs:
+                        for path in [out_tif.replace('.tif', '_tmp.tif'), out_tif]:
+                            if os.path.isfile(path):
+                                os.remove(path)
+                    result = f"fail 3: {e}"
+
+    return (file, directory_dst, result)  # Logging information
+
+
+def _get_scaled_outputs(file, directory_dst, scalings):
+    """Helper function for _do_crop()/_do_crop_windowed() to return a list of (scaling, output_path) tuples for a file
+    geocoded in linear scale. See _get_scaling_dirs() for the output directories and sentinel1.SCALINGS for the
+    filename suffixes."""
+
+    f_base = os.path.splitext(os.path.basename(file))[0]
+
+    return [(scaling, os.path.join(directory, f"{f_base}{sentinel1.SCALINGS[scaling]['suffix']}.tif"))
+            for scaling, directory in _get_scaling_dirs(directory=directory_dst, scalings=scalings)]
+
+
+def _iter_masked_windows(src, features, aoi_window, n_rows, nodata, indexes=None):
+    """Helper function for _do_crop_windowed() to iterate over full-width windows of 'n_rows' rows inside
+    'aoi_window'. Yields each window and the data read from it, with all pixels outside the AOI set to no data."""
+
+    for row in range(aoi_window.row_off, aoi_window.row_off + aoi_window.height, n_rows):
+        window = Window(aoi_window.col_off, row, aoi_window.width,
+                        min(n_rows, aoi_window.row_off + aoi_window.height - row))
+        outside = geometry_mask(features, out_shape=(window.height, window.width),
+                                transform=rasterio.windows.transform(window, src.transform), all_touched=True)
+        data = src.read(indexes, window=window)
+        data[..., outside] = nodata
+
+        yield window, data
 
 
 def _get_aoi_features(aoi_path, crs):
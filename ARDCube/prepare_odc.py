@@ -1,16 +1,21 @@
-from ARDCube.config import get_settings, PROJ_DIR
+from ARDCube.config import get_settings
+import ARDCube.utils.general as utils
+import ARDCube.utils.force as force
+import ARDCube.utils.raster as raster
+import ARDCube.utils.journal as journal
+import ARDCube.utils.cluster as cluster
 
 import os
-import re
 import glob
 import yaml
 import uuid
 import logging
 from datetime import datetime
+import numpy as np
 import rasterio
 
 
-def prepare_odc(sensor, overwrite=True):
+def prepare_odc(sensor, overwrite=True, force_all=False):
     """Main function of this module, which creates 'Dataset Documents' to index each GeoTIFF file of a given dataset
     into an Open Data Cube (ODC) instance. The documents are saved alongside each source file and stored in the YAML
     format and in the ODC EO3 schema. More information can be found here:
@@ -25,12 +30,31 @@ def prepare_odc(sensor, overwrite=True):
         Example: 'landsat8'
     overwrite: boolean (optional)
         If set to False, only Dataset Documents for new files will be created.
+    force_all: boolean (optional)
+        If set to True, the state journal is ignored and Dataset Documents are created again for all files, even if
+        neither the files nor the Product Definition changed since the last run.
     """
 
+    settings = get_settings()
     file_dict = create_file_dict(sensor=sensor, overwrite=overwrite)
 
+    ## Skip entries that were already documented with the same files and the same Product Definition
+    conn = journal.connect()
+    settings_hash = journal.settings_fingerprint(settings=settings, stage='documented',
+                                                 extra=utils.read_product_yaml(sensor=sensor))
+    hashes = {key: journal.file_fingerprint(paths, quick=True) for key, paths in file_dict.items()}
+    if not force_all:
+        file_dict = {key: paths for key, paths in file_dict.items()
+                     if journal.needs_update(conn=conn, sensor=sensor, scene=key, stage='documented',
+                                             input_hash=hashes[key], settings_hash=settings_hash)}
+
     print(f"\n#### Creating ODC YAML files for {len(file_dict)} {sensor} files.")
-    create_eo3_yaml(sensor=sensor, file_dict=file_dict)
+    create_eo3_yaml(sensor=sensor, file_dict=file_dict, settings=settings)
+
+    for key in file_dict.keys():
+        journal.record(conn=conn, sensor=sensor, scene=key, stage='documented', input_hash=hashes[key],
+                       settings_hash=settings_hash)
+    conn.close()
 
     # Index into ODC instance
 
@@ -53,20 +77,20 @@ def create_file_dict(sensor, overwrite):
     log_dir = os.path.join(data_dir, 'log')
     log_path = os.path.join(log_dir, f'{timestamp}__{sensor}__prepare_odc.log')
 
+    file_list = glob.glob(os.path.join(level2_dir, f_pattern), recursive=True)
+
+    ## Skip files that only contain no data values, which has been observed for Sentinel-1 data after tiling it using
+    ## 'force-cube'. The verdicts are cached, so this is only slow the first time a file is checked.
+    ## The log file can be used to check which files were skipped.
+    empty_files = set(raster.find_empty_tiles(directory=level2_dir, file_list=file_list,
+                                              nproc=settings['PROCESSING']['NPROC'],
+                                              env=raster.get_gdal_env(settings=settings, stage='headerscan')))
+
     file_dict = {}
-    for file in glob.iglob(os.path.join(level2_dir, f_pattern), recursive=True):
-
-        ## Skip files that are very small as they probably only contain no data values and are therefore not valid.
-        ## This bug has been observed for Sentinel-1 data after tiling it using 'force-cube'.
-        ## The log file can be used to check which files were skipped. If you notice that any valid files have been
-        ## skipped as well, you can adjust the threshold here and run prepare_odc() again with overwrite=False.
-        ## This will create YAML files for any files that were skipped previously.
-        ## TODO: Better to just check the grid & AOI. Also not here but already in generate_ard.py!
-        ## 2021-05-26: Leaving this for now as it's a 'force-cube' bug and should be fixed there.
-        size_mb = os.path.getsize(file) / 10e5
-        if size_mb < 0.42:
+    for file in file_list:
+        if file in empty_files:
             logging.basicConfig(filename=log_path, filemode='a', format='%(message)s', level='INFO')
-            logging.info(f"{file} - {size_mb} MB")
+            logging.info(f"{file} - only no data")
             continue
         else:
             ## Create identity key for each file based on date string and tile ID
@@ -86,54 +110,64 @@ def create_file_dict(sensor, overwrite):
         return _update_file_dict(level2_dir=level2_dir, file_dict=file_dict)
 
 
-def create_eo3_yaml(sensor, file_dict):
-    """Creates a YAML file in the EO3 schema for each entry of the provided file dictionary."""
+def create_eo3_yaml(sensor, file_dict, settings=None):
+    """Creates a YAML file in the EO3 schema for each entry of the provided file dictionary. The entries are processed
+    in a multiprocessing pool or on a Dask cluster (see ARDCube.utils.cluster.map_tasks())."""
 
-    product_dict = _read_product_yaml(sensor=sensor)
+    if settings is None:
+        settings = get_settings()
 
-    for key in list(file_dict.keys()):
+    product_dict = utils.read_product_yaml(sensor=sensor)
+    env = raster.get_gdal_env(settings=settings, stage='headerscan')
 
-        file_dict_entry = file_dict[key]
+    cluster.map_tasks(func=raster.run_with_env,
+                      args_list=[(env, _create_eo3_entry, sensor, file_dict_entry, product_dict)
+                                 for file_dict_entry in file_dict.values()],
+                      nproc=int(settings['PROCESSING']['NPROC']), settings=settings)
 
-        if sensor == 'sentinel1':
-            orbit = _s1_is_asc_or_desc(file_path=file_dict_entry[0])
-            prod_key = f"{sensor}_{orbit}.yaml"
-        else:
-            prod_key = f"{sensor}.yaml"
 
-        shape, transform, crs_wkt = _get_grid_info(file_path=file_dict_entry[0])
-        measurements = _get_measurements(sensor=sensor, file_dict_entry=file_dict_entry,
-                                         band_names=product_dict[prod_key]['band_names'])
-        properties = _get_properties(sensor=sensor, file_path=file_dict_entry[0])
+def _create_eo3_entry(sensor, file_dict_entry, product_dict):
+    """Helper function executed in create_eo3_yaml() which creates the YAML file of a single file dictionary entry."""
 
-        if product_dict[prod_key]['crs'] != crs_wkt:
-            raise RuntimeError(f"The CRS specified in the product YAML {product_dict[prod_key]['name']} "
-                               f"does not match the CRS of {file_dict_entry[0]}")
+    if sensor == 'sentinel1':
+        orbit = utils.s1_is_asc_or_desc(file_path=file_dict_entry[0])
+        prod_key = f"{sensor}_{orbit}.yaml"
+    else:
+        prod_key = f"{sensor}.yaml"
+
+    shape, transform, crs_wkt = _get_grid_info(file_path=file_dict_entry[0])
+    measurements = _get_measurements(sensor=sensor, file_dict_entry=file_dict_entry,
+                                     band_names=product_dict[prod_key]['band_names'])
+    properties = _get_properties(sensor=sensor, file_dict_entry=file_dict_entry)
 
-        yaml_content = {
-            'id': str(uuid.uuid4()),
-            '$schema': 'https://schemas.opendatacube.org/dataset',
-            'product': {'name': product_dict[prod_key]['name']},
-            'crs': crs_wkt,
-            'grids': {'default': {'shape': shape,
-                                  'transform': transform}
-                      },
-            'measurements': measurements,
-            'properties': properties
-        }
+    if product_dict[prod_key]['crs'] != crs_wkt:
+        raise RuntimeError(f"The CRS specified in the product YAML {product_dict[prod_key]['name']} "
+                           f"does not match the CRS of {file_dict_entry[0]}")
 
-        yaml_dir = os.path.dirname(file_dict_entry[0])
-        yaml_name = _format_yaml_name(sensor=sensor, file_path=file_dict_entry[0])
+    yaml_content = {
+        'id': str(uuid.uuid4()),
+        '$schema': 'https://schemas.opendatacube.org/dataset',
+        'product': {'name': product_dict[prod_key]['name']},
+        'crs': crs_wkt,
+        'grids': {'default': {'shape': shape,
+                              'transform': transform}
+                  },
+        'measurements': measurements,
+        'properties': properties
+    }
 
-        with open(os.path.join(yaml_dir, yaml_name), 'w') as stream:
-            yaml.safe_dump(yaml_content, stream, sort_keys=False)
+    yaml_dir = os.path.dirname(file_dict_entry[0])
+    yaml_name = _format_yaml_name(sensor=sensor, file_path=file_dict_entry[0])
+
+    with open(os.path.join(yaml_dir, yaml_name), 'w') as stream:
+        yaml.safe_dump(yaml_content, stream, sort_keys=False)
 
 
 def _create_identity_string(file_path):
     """Helper function for create_file_dict() to create an identifiable string for a given file based on its tile ID and
     acquisition date."""
 
-    date = _get_date_string(file_path=file_path)
+    date = utils.get_date_string(file_path=file_path)
     tile_id = os.path.basename(os.path.dirname(file_path))
 
     return f"{tile_id}__{date}"
@@ -162,81 +196,6 @@ def _update_file_dict(level2_dir, file_dict):
         return file_dict
 
 
-def _get_date_string(file_path, sensor=None, do_format=False):
-    """Helper function to extract the date from a file name."""
-
-    f_base = os.path.basename(file_path)
-
-    ## Search either for the 8 digit pattern (YYYYmmdd) used in files that were processed with FORCE.
-    ## Or the 15 digit pattern (YYYYmmddTHHMMSS) used in files that were processed with pyroSAR. The underscore is
-    ## necessary, because otherwise only the former pattern is found.
-    rs = re.search(r'\d{8}|_\d{8}T\d{6}', f_base)
-    date = rs.group()
-    date = date.replace("_", "")
-
-    if do_format:
-        return _format_date_string(date=date, sensor=sensor)
-    else:
-        return date
-
-
-def _format_date_string(date, sensor):
-    """Helper function to format a date string from either YYYYmmdd or YYYYmmddTHHMMSS to YYYY-mm-ddTHH:MM:SS.000Z."""
-
-    if len(date) == 8:
-        if sensor.startswith('landsat'):
-            date = datetime.strptime(date, '%Y%m%d').strftime('%Y-%m-%dT10:00:00.000Z')  # Landsat
-        else:
-            date = datetime.strptime(date, '%Y%m%d').strftime('%Y-%m-%dT10:30:00.000Z')  # Sentinel-2
-    elif len(date) == 15:
-        date = datetime.strptime(date, '%Y%m%dT%H%M%S').strftime('%Y-%m-%dT%H:%M:%S.000Z')  # Sentinel-1
-    else:
-        raise RuntimeError("Length of date string is expected to be of length 8 or 15 based on existing file naming "
-                           "conventions used by pyroSAR and FORCE.")
-
-    return date
-
-
-def _read_product_yaml(sensor):
-    """Helper function for create_eo3_yaml() to return information from Product Definition YAML."""
-
-    odc_dir = os.path.join(PROJ_DIR, 'management', 'settings', 'odc')
-
-    if sensor == 'sentinel1':
-        product_path = [os.path.join(odc_dir,  f"{sensor}_asc.yaml"),
-                        os.path.join(odc_dir, f"{sensor}_desc.yaml")]
-    else:
-        product_path = [os.path.join(odc_dir, f"{sensor}.yaml")]
-
-    dict_out = {}
-    for path in product_path:
-        with open(path) as f:
-            yaml_dict = yaml.safe_load(f)
-
-            name = yaml_dict['name']
-            crs = yaml_dict['storage']['crs']
-            res = yaml_dict['storage']['resolution']['x']
-            band_names = [yaml_dict['measurements'][i]['name'] for i in range(len(yaml_dict['measurements']))]
-
-        dict_out[os.path.basename(path)] = {'name': name, 'crs': crs, 'res': res, 'band_names': band_names}
-
-    return dict_out
-
-
-def _s1_is_asc_or_desc(file_path):
-    """Helper function for create_eo3_yaml() to get information on SAR orbit from filename based on pyroSAR's naming
-    convention."""
-
-    file = os.path.basename(file_path)
-
-    if file[10:11] == 'A':
-        return 'asc'
-    elif file[10:11] == 'D':
-        return 'desc'
-    else:
-        raise RuntimeError(f"Can't determine orbit direction of {file_path}")
-
-
 def _get_grid_info(file_path):
     """Helper function for create_eo3_yaml() to get necessary shape and transform information from a raster file."""
 
@@ -281,19 +240,79 @@ def _get_measurements(sensor, file_dict_entry, band_names):
     return dict_out
 
 
-def _get_properties(sensor, file_path):
+def _get_properties(sensor, file_dict_entry):
     """Helper function for create_eo3_yaml() to create a dictionary for the properties section of the Dataset Document.
     Datetime is the only compulsory field and orbit state is used to create two separate datasets for ascending and
-    descending Sentinel-1 orbit. Other useful properties can be added later on if needed."""
+    descending Sentinel-1 orbit. Valid data, cloud, cloud shadow and snow cover are added by _get_quality_properties(),
+    so that datasets can be filtered without reading any pixels."""
+
+    file_path = file_dict_entry[0]
+    date = utils.get_date_string(file_path=file_path, sensor=sensor, do_format=True)
+
+    if sensor == 'sentinel1':
+        orbit = utils.s1_is_asc_or_desc(file_path=file_path)
+        properties = {'datetime': date,
+                      'sat:orbit_state': orbit}
+    else:
+        properties = {'datetime': date}
+
+    properties.update(_get_quality_properties(sensor=sensor, file_dict_entry=file_dict_entry))
+
+    return properties
 
-    date = _get_date_string(file_path=file_path, sensor=sensor, do_format=True)
+
+def _get_quality_properties(sensor, file_dict_entry):
+    """Helper function for _get_properties() to calculate the percentage of valid pixels of a tile
+    ('ardcube:valid_data'). For optical datasets, the percentage of valid pixels flagged as cloud ('eo:cloud_cover'),
+    cloud shadow ('ardcube:cloud_shadow_cover') and snow ('eo:snow_cover') is calculated from the QAI band as well.
+    All rasters are read block by block. For Sentinel-1, a pixel is valid if none of the bands contains no data."""
 
     if sensor == 'sentinel1':
-        orbit = _s1_is_asc_or_desc(file_path=file_path)
-        return {'datetime': date,
-                'sat:orbit_state': orbit}
+        sources = [rasterio.open(path) for path in file_dict_entry]
+        n_total = 0
+        n_valid = 0
+        try:
+            for _, window in sources[0].block_windows(1):
+                valid = np.ones((window.height, window.width), dtype=bool)
+                for src in sources:
+                    data = src.read(1, window=window)
+                    valid &= np.isfinite(data)
+                    if src.nodata is not None:
+                        valid &= data != src.nodata
+                n_total += valid.size
+                n_valid += np.count_nonzero(valid)
+        finally:
+            for src in sources:
+                src.close()
+
+        return {'ardcube:valid_data': _percent(n_valid, n_total)}
+
+    else:
+        qai_path = file_dict_entry[0].replace('BOA', 'QAI')
+        counts = {'total': 0, 'valid': 0, 'cloud': 0, 'shadow': 0, 'snow': 0}
+        with rasterio.open(qai_path) as src:
+            for _, window in src.block_windows(1):
+                qai = src.read(1, window=window)
+                valid = force.decode_qai(qai=qai, flag='valid_data') == 0
+                counts['total'] += qai.size
+                counts['valid'] += np.count_nonzero(valid)
+                counts['cloud'] += np.count_nonzero(valid & (force.decode_qai(qai=qai, flag='cloud_state') > 0))
+                counts['shadow'] += np.count_nonzero(valid & (force.decode_qai(qai=qai, flag='cloud_shadow') == 1))
+                counts['snow'] += np.count_nonzero(valid & (force.decode_qai(qai=qai, flag='snow') == 1))
+
+        return {'ardcube:valid_data': _percent(counts['valid'], counts['total']),
+                'eo:cloud_cover': _percent(counts['cloud'], counts['valid']),
+                'ardcube:cloud_shadow_cover': _percent(counts['shadow'], counts['valid']),
+                'eo:snow_cover': _percent(counts['snow'], counts['valid'])}
+
+
+def _percent(count, total):
+    """Helper function for _get_quality_properties() to return a percentage rounded to two decimals."""
+
+    if total == 0:
+        return 0.0
     else:
-        return {'datetime': date}
+        return round(100 * count / total, 2)
 
 
 def _format_yaml_name(sensor, file_path):
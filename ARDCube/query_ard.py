@@ -0,0 +1,155 @@
+from ARDCube.config import get_settings, SAT_DICT
+import ARDCube.utils.general as utils
+import ARDCube.utils.datacube as datacube
+
+import os
+import json
+import bisect
+from rtree import index
+from rasterio.warp import transform_bounds
+
+
+def query_ard(sensor, bounds, start=None, end=None, crs='EPSG:4326', pattern='.tif'):
+    """Main function of this module, which returns the paths of all level-2 files of a dataset that intersect a bounding
+    box and were acquired within a time range. The query is answered from a catalogue of tiles and dates, which is
+    stored in /{ProjectDirectory}/data/meta/catalogue__{sensor}.json and updated before each query. Only tile
+    directories that changed since the last update are scanned again (see update_catalogue()). Tiles are looked up with
+    an R-tree built from the tile grid defined in 'datacube-definition.prj', and dates with a binary search per tile.
+
+    Parameters
+    ----------
+    sensor: string
+        Name of the sensor/dataset that should be queried.
+        Example: 'sentinel1'
+    bounds: tuple
+        Bounding box (left, bottom, right, top) in the coordinate reference system 'crs'.
+    start: string (optional)
+        Start of the time range in the format 'YYYY-mm-dd' (inclusive). If not provided, the time range is open.
+    end: string (optional)
+        End of the time range in the format 'YYYY-mm-dd' (inclusive). If not provided, the time range is open.
+    crs: string (optional)
+        Coordinate reference system of 'bounds'. Default is 'EPSG:4326' (longitude/latitude).
+    pattern: string (optional)
+        Only files ending with this pattern are returned.
+        Example: 'BOA.tif'
+
+    Returns
+    -------
+    list of strings
+        Paths of all matching files, sorted by tile and date.
+    """
+
+    catalogue = update_catalogue(sensor=sensor)
+    prj = datacube.read_datacube_prj(prj_path=catalogue['prj'])
+    tile_dir = os.path.dirname(catalogue['prj'])
+
+    ## Transform bounding box into the projection of the data cube
+    bounds = transform_bounds(crs, prj['wkt'], *bounds, densify_pts=21)
+
+    start = utils.date_key(date=start, default='00000000')
+    end = utils.date_key(date=end, default='99999999')
+
+    rtree = _build_rtree(prj=prj, tiles=list(catalogue['tiles'].keys()))
+    tiles = sorted([obj.object for obj in rtree.intersection(bounds, objects=True)])
+
+    files = []
+    for tile in tiles:
+        entries = catalogue['tiles'][tile]['files']
+        dates = [entry[0] for entry in entries]
+
+        ## Entries are sorted by date, so the time range can be found with a binary search
+        i0 = bisect.bisect_left(dates, start)
+        i1 = bisect.bisect_right(dates, end)
+        files.extend([os.path.join(tile_dir, tile, file) for _, file in entries[i0:i1] if file.endswith(pattern)])
+
+    return files
+
+
+def update_catalogue(sensor):
+    """Creates or updates the catalogue of a level-2 dataset and returns it as a dictionary of the form
+    {'prj': 'path_to_datacube-definition.prj', 'tiles': {'X0001_Y0001': {'mtime': 1620000000000000000,
+    'files': [['20200501', 'file_1.tif'], ...]}}}. Files of each tile are sorted by date (YYYYmmdd).
+    A tile directory is only scanned again if its modification time changed, which is the case whenever files are
+    added to or removed from it."""
+
+    settings = get_settings()
+
+    if sensor not in list(SAT_DICT.keys()):
+        raise ValueError(f"{sensor} is not supported!")
+
+    data_dir = os.path.join(settings['GENERAL']['ProjectDirectory'], 'data')
+    level2_dir = os.path.join(data_dir, 'level2', sensor)
+    catalogue_path = os.path.join(data_dir, 'meta', f"catalogue__{sensor}.json")
+
+    if not os.path.isdir(level2_dir):
+        raise FileNotFoundError(f"{level2_dir} does not exist!")
+
+    tile_dir = str(datacube._get_datacubeprj_dir(directory=level2_dir))
+    prj_path = os.path.join(tile_dir, 'datacube-definition.prj')
+
+    catalogue = {'prj': prj_path, 'tiles': {}}
+    if os.path.isfile(catalogue_path):
+        with open(catalogue_path, 'r') as f:
+            cached = json.load(f)
+        if cached['prj'] == prj_path:
+            catalogue = cached
+
+    changed = False
+    found = set()
+    with os.scandir(tile_dir) as entries:
+        for entry in entries:
+            if not entry.is_dir() or datacube.parse_tile_name(entry.name) is None:
+                continue
+
+            found.add(entry.name)
+            mtime = entry.stat().st_mtime_ns
+            if entry.name in catalogue['tiles'] and catalogue['tiles'][entry.name]['mtime'] == mtime:
+                continue
+
+            catalogue['tiles'][entry.name] = {'mtime': mtime, 'files': _scan_tile(directory=entry.path)}
+            changed = True
+
+    ## Remove tiles that don't exist anymore (e.g. quarantined empty tiles)
+    for tile in set(catalogue['tiles'].keys()) - found:
+        del catalogue['tiles'][tile]
+        changed = True
+
+    if changed or not os.path.isfile(catalogue_path):
+        with open(catalogue_path, 'w') as f:
+            json.dump(catalogue, f)
+
+    return catalogue
+
+
+def _scan_tile(directory):
+    """Helper function for update_catalogue() to list all GeoTIFF files of a tile directory together with their
+    acquisition date. Returns a list of [date, filename] pairs sorted by date."""
+
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith('.tif'):
+                try:
+                    date = utils.get_date_string(file_path=entry.name)[:8]
+                except AttributeError:
+                    ## No date in the file name
+                    continue
+                files.append([date, entry.name])
+
+    return sorted(files)
+
+
+def _build_rtree(prj, tiles):
+    """Helper function for query_ard() to build an R-tree of the bounds of all tiles in the catalogue. The tree is
+    bulk loaded, which only takes a few milliseconds even for several thousand tiles."""
+
+    def _stream():
+        for i, tile in enumerate(tiles):
+            tile_x, tile_y = datacube.parse_tile_name(tile)
+            yield i, datacube.tile_bounds(prj=prj, tile_x=tile_x, tile_y=tile_y), tile
+
+    if len(tiles) == 0:
+        return index.Index()
+    else:
+        return index.Index(_stream())
+
@@ -1,6 +1,9 @@
 import sys
 import os
 import glob
+import json
+import signal
+import traceback
 from pyroSAR import snap
 
 in_dir = sys.argv[1]
@@ -20,25 +23,116 @@ else:
 
 snap_gpt = '/opt/snap/bin/gpt'
 
-list_scenes = []
-for file in glob.iglob(os.path.join(in_dir, 'S1*zip'), recursive=True):
-    list_scenes.append(file)
+## Optional SNAP resource profile (JVM heap, tile cache, parallelism, directory for intermediate files, groupsize).
+## If it is not provided, SNAP defaults are used.
+if len(sys.argv) > 16:
+    gpt_args = [f"-J-Xmx{sys.argv[12]}", '-c', sys.argv[13], '-q', sys.argv[14]]
+    tmpdir = sys.argv[15]
+    groupsize = int(sys.argv[16])
+else:
+    gpt_args = None
+    tmpdir = None
+    groupsize = 1
+
+## Optional worker mode. 'persistent' executes all workflows in a single JVM (see snap_worker.py) instead of starting
+## gpt for each of them.
+persistent = False
+if len(sys.argv) > 17 and sys.argv[17] == 'persistent':
+    import snap_worker
+    persistent = snap_worker.start(cache=sys.argv[13], threads=sys.argv[14], gpt=snap_gpt)
+
+## An optional queue file lists the scenes that should be processed. Each line contains one or more (tab-separated)
+## paths. Multiple paths are consecutive slices of the same datatake, which pyroSAR assembles before geocoding.
+## If it is not provided, all scenes found in the input directory are processed.
+if len(sys.argv) > 11:
+    with open(sys.argv[11], 'r') as f:
+        list_scenes = [line.strip().split('\t') for line in f if line.strip() != '']
+        list_scenes = [group[0] if len(group) == 1 else group for group in list_scenes]
+else:
+    list_scenes = []
+    for file in glob.iglob(os.path.join(in_dir, 'S1*zip'), recursive=True):
+        list_scenes.append(file)
+
+## Optional failure handling. A scene (or group of slices) that fails is appended to the failures file (JSON lines)
+## and the remaining scenes are processed. If no failures file is provided, the first failure aborts the batch.
+## Scenes that take longer than the timeout (seconds, 0: none) are aborted and all processes started for them (e.g.
+## gpt) are killed. The timeout can't interrupt workflows executed by the persistent worker.
+failures_file = sys.argv[18] if len(sys.argv) > 18 else None
+timeout = int(float(sys.argv[19])) if len(sys.argv) > 19 else 0
+
+
+def _on_timeout(signum, frame):
+    raise TimeoutError(f"Scene timed out after {timeout} s")
+
+
+def _kill_descendants():
+    """Kills all processes started by this script, based on the parent process IDs listed in /proc."""
+
+    children = {}
+    for stat in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat, 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat.split('/')[2]))
+
+    pids = list(children.get(os.getpid(), []))
+    while len(pids) > 0:
+        pid = pids.pop()
+        pids.extend(children.get(pid, []))
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+if timeout > 0:
+    signal.signal(signal.SIGALRM, _on_timeout)
 
 print(f"Number of scenes found: {len(list_scenes)}")
 
 for scene in list_scenes:
-    print(os.path.basename(scene))
-
-    ## All parameters (except the ones that are filled by variables obviously) are left as default based on the
-    ## pyroSAR v0.12 docs: https://pyrosar.readthedocs.io/en/v0.12/pyroSAR.html#module-pyroSAR.snap.util
-    snap.geocode(infile=scene, outdir=out_dir, t_srs=4326, tr=tr, polarizations=polarizations, shapefile=aoi_path,
-                 scaling=scaling, geocoding_type='Range-Doppler', removeS1BorderNoise=True,
-                 removeS1BorderNoiseMethod='pyroSAR', removeS1ThermalNoise=True, offset=None, allow_RES_OSV=False,
-                 externalDEMFile=dem_path, externalDEMNoDataValue=dem_nodata, externalDEMApplyEGM=True,
-                 terrainFlattening=True, basename_extensions=None, test=False, export_extra=None, groupsize=1,
-                 cleanup=True, tmpdir=None, gpt_exceptions=None, gpt_args=None, returnWF=False, nodataValueAtSea=True,
-                 demResamplingMethod='BILINEAR_INTERPOLATION', imgResamplingMethod='BILINEAR_INTERPOLATION',
-                 alignToStandardGrid=False, standardGridOriginX=0, standardGridOriginY=0,
-                 speckleFilter=speckle, refarea=refarea)
+    if isinstance(scene, list):
+        print(f"{len(scene)} slices: {', '.join([os.path.basename(s) for s in scene])}")
+    else:
+        print(os.path.basename(scene))
+    if persistent:
+        scene_start = snap_worker.report()
+
+    try:
+        if timeout > 0:
+            signal.alarm(timeout)
+        ## All parameters (except the ones that are filled by variables obviously) are left as default based on the
+        ## pyroSAR v0.12 docs: https://pyrosar.readthedocs.io/en/v0.12/pyroSAR.html#module-pyroSAR.snap.util
+        snap.geocode(infile=scene, outdir=out_dir, t_srs=4326, tr=tr, polarizations=polarizations,
+                     shapefile=aoi_path, scaling=scaling, geocoding_type='Range-Doppler', removeS1BorderNoise=True,
+                     removeS1BorderNoiseMethod='pyroSAR', removeS1ThermalNoise=True, offset=None,
+                     allow_RES_OSV=False, externalDEMFile=dem_path, externalDEMNoDataValue=dem_nodata,
+                     externalDEMApplyEGM=True, terrainFlattening=True, basename_extensions=None, test=False,
+                     export_extra=None, groupsize=groupsize, cleanup=True, tmpdir=tmpdir, gpt_exceptions=None,
+                     gpt_args=gpt_args, returnWF=False, nodataValueAtSea=True,
+                     demResamplingMethod='BILINEAR_INTERPOLATION', imgResamplingMethod='BILINEAR_INTERPOLATION',
+                     alignToStandardGrid=False, standardGridOriginX=0, standardGridOriginY=0,
+                     speckleFilter=speckle, refarea=refarea)
+    except Exception as e:
+        if failures_file is None:
+            raise
+        if isinstance(e, TimeoutError):
+            _kill_descendants()
+        traceback.print_exc()
+        with open(failures_file, 'a') as f:
+            f.write(json.dumps({'scenes': scene if isinstance(scene, list) else [scene],
+                                'error': f"{type(e).__name__}: {e}"}) + '\n')
+        print(f"FAILED: {type(e).__name__}: {e}")
+    finally:
+        if timeout > 0:
+            signal.alarm(0)
+
+    if persistent:
+        print(snap_worker.report(scene_start=scene_start)['message'])
 
     print('-' * 10)
+
+if persistent:
+    print(f"Total: {snap_worker.report()['message']}")
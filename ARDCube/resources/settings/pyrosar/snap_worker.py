@@ -0,0 +1,128 @@
+"""Persistent SNAP worker used by snap.py.
+
+pyroSAR executes each (sub-)workflow with a new gpt process, which starts a new JVM and loads all operators every
+time. start() loads the SNAP engine once via the Python bindings of SNAP (esa_snappy or snappy) and replaces
+pyroSAR.snap.auxil.execute, so that all workflows created by snap.geocode() are executed with the GraphProcessor of
+the already running JVM. The workflow XML files are the same as with gpt, so are the outputs.
+Workflows that can't be executed this way (e.g. because of 'gpt_exceptions') are passed to the original function.
+"""
+import os
+import time
+import shutil
+import subprocess as sp
+import pyroSAR.snap.auxil as auxil
+
+_state = {'engine': None, 'execute': None, 'gpt_startup': 0.0, 'calls': 0, 'fallbacks': 0}
+
+
+def start(cache=None, threads=None, gpt='/opt/snap/bin/gpt'):
+    """Starts the SNAP engine and patches pyroSAR. Returns False if no Python bindings of SNAP are available, in which
+    case pyroSAR is left unchanged and gpt is used as usual.
+    The startup time of a single gpt process is measured once (gpt -h), which is used to estimate the time that is
+    saved per workflow."""
+
+    try:
+        import esa_snappy as snappy
+    except ImportError:
+        try:
+            import snappy
+        except ImportError:
+            print("Persistent SNAP worker not available (esa_snappy/snappy not found). Falling back to gpt.")
+            return False
+
+    t0 = time.time()
+    sp.run([gpt, '-h'], stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+    _state['gpt_startup'] = time.time() - t0
+
+    t0 = time.time()
+    snappy.GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
+    jai = snappy.jpy.get_type('javax.media.jai.JAI').getDefaultInstance()
+    if cache is not None:
+        jai.getTileCache().setMemoryCapacity(_to_bytes(cache))
+    if threads is not None:
+        jai.getTileScheduler().setParallelism(int(threads))
+
+    _state['engine'] = {'GraphIO': snappy.jpy.get_type('org.esa.snap.core.gpf.graph.GraphIO'),
+                        'GraphProcessor': snappy.jpy.get_type('org.esa.snap.core.gpf.graph.GraphProcessor'),
+                        'FileReader': snappy.jpy.get_type('java.io.FileReader'),
+                        'ProgressMonitor': snappy.jpy.get_type('com.bc.ceres.core.ProgressMonitor')}
+    _state['execute'] = auxil.execute
+    auxil.execute = _execute
+
+    print(f"Persistent SNAP worker started in {time.time() - t0:.1f} s "
+          f"(startup of a single gpt process: {_state['gpt_startup']:.1f} s)")
+    return True
+
+
+def report(scene_start=None):
+    """Returns a summary of the workflows executed by the worker and the estimated time saved compared to starting gpt
+    for each of them. If 'scene_start' (a dictionary previously returned by report()) is provided, only the workflows
+    executed since then are considered."""
+
+    calls = _state['calls']
+    fallbacks = _state['fallbacks']
+    if scene_start is not None:
+        calls -= scene_start['calls']
+        fallbacks -= scene_start['fallbacks']
+
+    return {'calls': calls, 'fallbacks': fallbacks, 'saved': calls * _state['gpt_startup'],
+            'message': f"{calls} workflows executed by the persistent worker ({fallbacks} with gpt), "
+                       f"~{calls * _state['gpt_startup']:.1f} s of gpt startup time saved"}
+
+
+def _execute(xmlfile, cleanup=True, gpt_exceptions=None, gpt_args=None, verbose=True):
+    """Replacement of pyroSAR.snap.auxil.execute, which runs a workflow XML file with the GraphProcessor of the running
+    JVM. Falls back to the original function if a workflow fails or needs to be executed with a different gpt. As with
+    the original function, the (partial) output of a failed workflow is removed if 'cleanup' is True. Intermediate
+    products of successful sub-workflows are removed by pyroSAR.snap.auxil.gpt, which calls this function."""
+
+    if gpt_exceptions is not None:
+        _state['fallbacks'] += 1
+        return _state['execute'](xmlfile, cleanup=cleanup, gpt_exceptions=gpt_exceptions, gpt_args=gpt_args,
+                                 verbose=verbose)
+
+    engine = _state['engine']
+    if verbose:
+        workflow = auxil.Workflow(xmlfile)
+        print(' -> '.join([x.id for x in workflow if x.operator not in ['Read', 'Write']]) + ' (persistent worker)')
+
+    reader = engine['FileReader'](xmlfile)
+    try:
+        graph = engine['GraphIO'].read(reader)
+        engine['GraphProcessor']().executeGraph(graph, engine['ProgressMonitor'].NULL)
+    except Exception as e:
+        print(f"Persistent worker failed ({e}). Executing workflow with gpt instead.")
+        if cleanup:
+            _remove_output(xmlfile=xmlfile)
+        _state['fallbacks'] += 1
+        return _state['execute'](xmlfile, cleanup=cleanup, gpt_exceptions=gpt_exceptions, gpt_args=gpt_args,
+                                 verbose=verbose)
+    finally:
+        reader.close()
+
+    _state['calls'] += 1
+
+
+def _remove_output(xmlfile):
+    """Removes the output of a workflow (a GeoTIFF file or BEAM-DIMAP product), the same way as
+    pyroSAR.snap.auxil.execute does if a workflow fails."""
+
+    outname = auxil.Workflow(xmlfile)['Write'].parameters['file']
+    if os.path.isfile(outname + '.tif'):
+        os.remove(outname + '.tif')
+    elif os.path.isfile(outname + '.dim'):
+        os.remove(outname + '.dim')
+        shutil.rmtree(outname + '.data', ignore_errors=True)
+    elif os.path.isdir(outname):
+        shutil.rmtree(outname)
+
+
+def _to_bytes(size):
+    """Converts a size string like '16G' or '512M' into bytes."""
+
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = size.upper()
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    else:
+        return int(size)
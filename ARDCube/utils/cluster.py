@@ -0,0 +1,79 @@
+from ARDCube.config import get_settings, get_setting
+
+import multiprocessing as mp
+
+## Supported backends of map_tasks()
+BACKENDS = ['local', 'dask']
+
+
+def map_tasks(func, args_list, nproc=1, settings=None, backend=None):
+    """Executes func(*args) for each tuple of arguments in 'args_list' with the backend defined in the 'Cluster' field
+    of 'settings.prm' and returns the results in the same order.
+
+    Parameters
+    ----------
+    func: function
+        Function to execute. It needs to be importable by the workers (i.e. defined at the top level of a module), as
+        it is pickled and sent to them.
+    args_list: list of tuples
+        Arguments of each call.
+    nproc: int (optional)
+        Number of processes of the local multiprocessing pool, or number of workers of the Dask LocalCluster that is
+        started if no 'Scheduler' is defined in 'settings.prm'.
+    settings: ConfigParser (optional)
+        Settings read from 'settings.prm'. If not provided, they are read with ARDCube.config.get_settings().
+    backend: string (optional)
+        Overrides the 'Cluster' field in 'settings.prm'. Valid options:
+        'local' (multiprocessing pool on this machine),
+        'dask' (Dask cluster, which needs access to the same file system under the same paths)
+    """
+
+    if settings is None:
+        settings = get_settings()
+    if backend is None:
+        backend = get_setting(settings=settings, section='EXECUTION', field='Cluster')
+    if backend not in BACKENDS:
+        raise ValueError(f"{backend} not recognized. Valid options for 'Cluster' are: {BACKENDS}")
+
+    if len(args_list) == 0:
+        return []
+
+    if backend == 'local':
+        pool = mp.Pool(int(nproc))
+        try:
+            result_objects = [pool.apply_async(func, args=args) for args in args_list]
+            return [r.get() for r in result_objects]
+        finally:
+            pool.close()
+            pool.join()
+
+    return _map_dask(func=func, args_list=args_list, nproc=int(nproc),
+                     scheduler=get_setting(settings=settings, section='EXECUTION', field='Scheduler'))
+
+
+def _map_dask(func, args_list, nproc, scheduler):
+    """Helper function for map_tasks() to execute the tasks on a Dask cluster. If 'scheduler' is empty, a LocalCluster
+    with 'nproc' single-threaded worker processes is started for the duration of the call, otherwise the client
+    connects to the scheduler at this address (e.g. 'tcp://10.0.0.1:8786')."""
+
+    try:
+        from dask.distributed import Client, LocalCluster
+    except ImportError as e:
+        raise RuntimeError("The 'dask' backend requires Dask to be installed, e.g. with 'pip install "
+                           "ARDCube[dask]' or 'pip install dask[distributed]'.") from e
+
+    cluster = None
+    if len(scheduler) == 0:
+        cluster = LocalCluster(n_workers=nproc, threads_per_worker=1, processes=True)
+        client = Client(cluster)
+    else:
+        client = Client(scheduler)
+
+    try:
+        ## pure=False, as the tasks write files and identical arguments must not be merged into a single task
+        futures = client.map(func, *zip(*args_list), pure=False)
+        return client.gather(futures)
+    finally:
+        client.close()
+        if cluster is not None:
+            cluster.close()
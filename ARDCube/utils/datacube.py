@@ -0,0 +1,452 @@
+from ARDCube.config import PROJ_DIR
+import ARDCube.utils.general as utils
+import ARDCube.utils.raster as raster
+
+import os
+import re
+import glob
+import math
+import shutil
+import multiprocessing as mp
+from pathlib import Path
+import xml.etree.ElementTree as ET
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.warp import transform, transform_bounds, reproject
+from rasterio.windows import Window, from_bounds
+
+## Data types as named by GDAL, which are needed for the VRT files
+GDAL_DTYPES = {'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16', 'int16': 'Int16', 'uint32': 'UInt32',
+               'int32': 'Int32', 'float32': 'Float32', 'float64': 'Float64'}
+
+TILE_PATTERN = re.compile(r'^X(\d{4})_Y(\d{4})$')
+
+
+def read_datacube_prj(prj_path):
+    """Reads a 'datacube-definition.prj' file as created by FORCE and returns its content as a dictionary. The file
+    contains (one entry per line): projection (WKT), origin longitude, origin latitude, origin X, origin Y (both in
+    projection units), tile size and block size (both in projection units).
+    https://force-eo.readthedocs.io/en/latest/howto/datacube.html#the-datacube-definition-file"""
+
+    with open(prj_path, 'r') as file:
+        lines = [line.strip() for line in file.readlines() if len(line.strip()) > 0]
+
+    if len(lines) != 7:
+        raise RuntimeError(f"{prj_path} is expected to contain 7 lines, but {len(lines)} were found.")
+
+    return {'wkt': lines[0],
+            'origin_lon': float(lines[1]),
+            'origin_lat': float(lines[2]),
+            'origin_x': float(lines[3]),
+            'origin_y': float(lines[4]),
+            'tile_size': float(lines[5]),
+            'block_size': float(lines[6])}
+
+
+def tile_name(tile_x, tile_y):
+    """Returns the FORCE tile ID (e.g. 'X0001_Y0002') of a tile index."""
+
+    return f"X{tile_x:04d}_Y{tile_y:04d}"
+
+
+def parse_tile_name(name):
+    """Returns the tile index (tile_x, tile_y) of a FORCE tile ID (e.g. 'X0001_Y0002') or None if the name is not a
+    valid tile ID."""
+
+    match = TILE_PATTERN.match(name)
+    if match is None:
+        return None
+    else:
+        return int(match.group(1)), int(match.group(2))
+
+
+def tile_bounds(prj, tile_x, tile_y):
+    """Returns the bounds (left, bottom, right, top) of a tile in projection units. 'prj' is a dictionary created by
+    read_datacube_prj()."""
+
+    left = prj['origin_x'] + tile_x * prj['tile_size']
+    top = prj['origin_y'] - tile_y * prj['tile_size']
+
+    return left, top - prj['tile_size'], left + prj['tile_size'], top
+
+
+def tile_index(prj, x, y):
+    """Returns the index (tile_x, tile_y) of the tile that contains the coordinate (x, y) in projection units."""
+
+    tile_x = int(math.floor((x - prj['origin_x']) / prj['tile_size']))
+    tile_y = int(math.floor((prj['origin_y'] - y) / prj['tile_size']))
+
+    return tile_x, tile_y
+
+
+def tiles_in_bounds(prj, bounds):
+    """Returns a list of all tile indices (tile_x, tile_y) that intersect the given bounds (left, bottom, right, top)
+    in projection units."""
+
+    x_min, y_min = tile_index(prj=prj, x=bounds[0], y=bounds[3])
+    x_max, y_max = tile_index(prj=prj, x=bounds[2], y=bounds[1])
+
+    ## Exclude the next tile if the bounds end exactly on a tile border
+    if math.isclose(prj['origin_x'] + x_max * prj['tile_size'], bounds[2]) and x_max > x_min:
+        x_max -= 1
+    if math.isclose(prj['origin_y'] - y_max * prj['tile_size'], bounds[1]) and y_max > y_min:
+        y_max -= 1
+
+    return [(tx, ty) for ty in range(y_min, y_max + 1) for tx in range(x_min, x_max + 1)]
+
+
+def walk_tiles(directory, pattern='.tif'):
+    """Walks the tile subdirectories (X*_Y*) of a level-2 directory once and returns a dictionary of the form
+    {'X0001_Y0001': ['file_1.tif', 'file_2.tif', ...]} with all filenames ending with 'pattern'."""
+
+    tiles = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir() and parse_tile_name(entry.name) is not None:
+                with os.scandir(entry.path) as files:
+                    tiles[entry.name] = sorted([f.name for f in files if f.name.endswith(pattern)])
+
+    return tiles
+
+
+def create_mosaics(directory, tiles=None):
+    """Creates a mosaic (VRT file) for each product of a level-2 directory in the subdirectory /mosaic, equivalent to
+    'force-mosaic'. Existing mosaics are only recreated if the tiles that contain the product have changed, so that
+    only new dates are added when the function is executed after each processing run.
+
+    Parameters
+    ----------
+    directory: string
+        Level-2 directory that contains the tile subdirectories and a 'datacube-definition.prj' file.
+    tiles: dictionary (optional)
+        Dictionary created by walk_tiles(). If not provided, the tile subdirectories will be searched.
+    """
+
+    prj = read_datacube_prj(prj_path=os.path.join(_get_datacubeprj_dir(directory=directory),
+                                                  'datacube-definition.prj'))
+    if tiles is None:
+        tiles = walk_tiles(directory=directory)
+
+    mosaic_dir = os.path.join(directory, 'mosaic')
+    if not os.path.isdir(mosaic_dir):
+        os.mkdir(mosaic_dir)
+
+    ## Invert tile dictionary to get all tiles per product (= filename)
+    products = {}
+    for tile, files in tiles.items():
+        for file in files:
+            products.setdefault(file, []).append(tile)
+
+    n_new = 0
+    for product, product_tiles in products.items():
+        vrt_path = os.path.join(mosaic_dir, product.replace('.tif', '.vrt'))
+        sources = [f"../{tile}/{product}" for tile in sorted(product_tiles)]
+
+        if os.path.isfile(vrt_path) and _get_vrt_sources(vrt_path=vrt_path) == sources:
+            continue
+
+        _write_mosaic_vrt(directory=directory, vrt_path=vrt_path, prj=prj, sources=sources)
+        n_new += 1
+
+    print(f"{n_new} of {len(products)} mosaics were created or updated in {mosaic_dir}")
+
+
+def create_kml_grid(directory, tiles=None):
+    """Creates the KML file 'datacube-grid.kml' next to 'datacube-definition.prj', which contains the outlines of all
+    tiles of a level-2 directory in WGS84, equivalent to 'force-tabulate-grid'.
+
+    Parameters
+    ----------
+    directory: string
+        Level-2 directory that contains the tile subdirectories and a 'datacube-definition.prj' file.
+    tiles: dictionary (optional)
+        Dictionary created by walk_tiles(). If not provided, the tile subdirectories will be searched.
+    """
+
+    prj_dir = _get_datacubeprj_dir(directory=directory)
+    prj = read_datacube_prj(prj_path=os.path.join(prj_dir, 'datacube-definition.prj'))
+    if tiles is None:
+        tiles = walk_tiles(directory=directory)
+
+    src_crs = CRS.from_wkt(prj['wkt'])
+    dst_crs = CRS.from_epsg(4326)
+
+    placemarks = []
+    for tile in sorted(tiles.keys()):
+        left, bottom, right, top = tile_bounds(prj, *parse_tile_name(tile))
+
+        ## Densify the tile outline, as straight lines in the datacube projection are curved in WGS84
+        n = 10
+        xs = [left + (right - left) * i / n for i in range(n)] + [right] * n + \
+             [right - (right - left) * i / n for i in range(n)] + [left] * (n + 1)
+        ys = [top] * n + [top - (top - bottom) * i / n for i in range(n)] + \
+             [bottom] * n + [bottom + (top - bottom) * i / n for i in range(n)] + [top]
+        lons, lats = transform(src_crs, dst_crs, xs, ys)
+        coordinates = ' '.join([f"{lon:.6f},{lat:.6f},0" for lon, lat in zip(lons, lats)])
+
+        placemarks.append(f"    <Placemark>\n"
+                          f"      <name>{tile}</name>\n"
+                          f"      <styleUrl>#grid</styleUrl>\n"
+                          f"      <Polygon><outerBoundaryIs><LinearRing><coordinates>{coordinates}</coordinates>"
+                          f"</LinearRing></outerBoundaryIs></Polygon>\n"
+                          f"    </Placemark>\n")
+
+    kml_path = os.path.join(prj_dir, 'datacube-grid.kml')
+    with open(kml_path, 'w') as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+                   '  <Document>\n'
+                   '    <name>datacube-grid</name>\n'
+                   '    <Style id="grid"><LineStyle><color>ff0000ff</color><width>2</width></LineStyle>'
+                   '<PolyStyle><fill>0</fill></PolyStyle></Style>\n')
+        file.writelines(placemarks)
+        file.write('  </Document>\n'
+                   '</kml>\n')
+
+    return kml_path
+
+
+def cube_dataset(directory, prj_file=None, resample='bilinear', resolution=20, nproc=1, profile=None, env=None):
+    """In-process alternative to 'force-cube'. Reprojects all GeoTIFF files located in the top level of a directory
+    into the datacube grid defined by 'datacube-definition.prj' and writes each output tile directly into the tile
+    subdirectories (/X*_Y*/) using the same layout and naming as 'force-cube'. Tiles that would only contain no data
+    values are not written. Each pair of input file and tile is processed as a separate task in a multiprocessing pool
+    and input files are removed after all of their tiles have been written successfully or skipped because they would
+    only contain no data values.
+
+    Parameters
+    ----------
+    directory: string
+        Directory containing the GeoTIFF files that should be tiled. Output tiles are written to the same directory.
+    prj_file: string (optional)
+        Path to a 'datacube-definition.prj' file that will be copied to the directory. If not provided, the file is
+        expected to exist in the directory already. If it doesn't, the file located in
+        /{ProjectDirectory}/management/settings/pyrosar is used.
+    resample: string (optional)
+        Resampling method as named in rasterio.enums.Resampling. Default is 'bilinear'.
+    resolution: int or float (optional)
+        Output resolution in projection units. Default is 20.
+    nproc: int (optional)
+        Number of processes. Default is 1.
+    profile: dictionary (optional)
+        Output profile created by ARDCube.utils.raster.get_output_profile(). Only the compression and block size are
+        used here, as the tiles are written window by window.
+    env: dictionary (optional)
+        GDAL configuration options created by ARDCube.utils.raster.get_gdal_env(), which are applied in each process.
+
+    Returns
+    -------
+    results: list
+        List of (file, tile, result) tuples for logging.
+    """
+
+    prj_path = os.path.join(directory, 'datacube-definition.prj')
+    if prj_file is not None:
+        shutil.copyfile(prj_file, prj_path)
+    elif not os.path.isfile(prj_path):
+        prj_fallback = os.path.join(PROJ_DIR, 'management', 'settings', 'pyrosar', 'datacube-definition.prj')
+        if not os.path.isfile(prj_fallback):
+            raise FileNotFoundError(f"{prj_path} does not exist.")
+        shutil.copyfile(prj_fallback, prj_path)
+
+    prj = read_datacube_prj(prj_path=prj_path)
+    file_list = sorted(glob.glob(os.path.join(directory, '*.tif')))
+
+    ## Get intersecting tiles of each file
+    tasks = []
+    for file in file_list:
+        for tile in _get_file_tiles(file=file, prj=prj):
+            tasks.append((file, tile))
+
+    pool = mp.Pool(int(nproc))
+    result_objects = [pool.apply_async(raster.run_with_env, args=(env, _cube_tile, file, tile, prj, directory,
+                                                                  resample, resolution, profile))
+                      for file, tile in tasks]
+
+    results = []
+    total = len(result_objects)
+    for i, r in enumerate(result_objects):
+        results.append(r.get())
+        utils.progress(i + 1, total, status=f"Tiling {len(file_list)} files into {total} tiles")
+
+    pool.close()
+    pool.join()
+
+    ## Remove input files of which all tiles were written successfully. Tiles that only contain no data (fail 1) are
+    ## expected for most files, as tiles are selected by the bounding box of a file, and are not counted as failures
+    failed = set([file for file, _, result in results if result.startswith('fail 2')])
+    for file in file_list:
+        if file not in failed:
+            os.remove(file)
+
+    return results
+
+
+def _get_file_tiles(file, prj):
+    """Helper function for cube_dataset() to return the IDs of all tiles that intersect a raster file."""
+
+    with rasterio.open(file) as src:
+        bounds = transform_bounds(src.crs, CRS.from_wkt(prj['wkt']), *src.bounds, densify_pts=21)
+
+    return [tile_name(tx, ty) for tx, ty in tiles_in_bounds(prj=prj, bounds=bounds)]
+
+
+def _cube_tile(file, tile, prj, directory, resample, resolution, profile):
+    """Helper function executed in cube_dataset() which reprojects the part of a file that intersects a tile. Only the
+    window of the tile covered by the file is warped and written."""
+
+    try:
+        dst_crs = CRS.from_wkt(prj['wkt'])
+        left, bottom, right, top = tile_bounds(prj, *parse_tile_name(tile))
+        size = int(round(prj['tile_size'] / resolution))
+        tile_transform = Affine(resolution, 0.0, left, 0.0, -resolution, top)
+
+        with rasterio.open(file) as src:
+            nodata = src.nodata if src.nodata is not None else 0
+            src_bounds = transform_bounds(src.crs, dst_crs, *src.bounds, densify_pts=21)
+
+            ## Window of the tile that is covered by the source file
+            window = from_bounds(max(left, src_bounds[0]), max(bottom, src_bounds[1]),
+                                 min(right, src_bounds[2]), min(top, src_bounds[3]), transform=tile_transform)
+            col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+            window = Window(col_off, row_off, math.ceil(window.col_off + window.width) - col_off,
+                            math.ceil(window.row_off + window.height) - row_off)
+            window = window.intersection(Window(0, 0, size, size))
+            if window.width < 1 or window.height < 1:
+                return file, tile, "fail 1: Only nodata inside tile"
+
+            data = np.full((src.count, window.height, window.width), nodata, dtype=src.dtypes[0])
+            reproject(source=rasterio.band(src, list(range(1, src.count + 1))), destination=data,
+                      src_nodata=nodata, dst_nodata=nodata, dst_crs=dst_crs,
+                      dst_transform=rasterio.windows.transform(window, tile_transform),
+                      resampling=Resampling[resample])
+
+            if np.all(_nodata_mask(data=data, nodata=nodata)):
+                return file, tile, "fail 1: Only nodata inside tile"
+
+            meta = src.meta.copy()
+
+        tile_dir = os.path.join(directory, tile)
+        if not os.path.isdir(tile_dir):
+            os.makedirs(tile_dir, exist_ok=True)
+        out_tif = os.path.join(tile_dir, os.path.basename(file))
+
+        if os.path.isfile(out_tif):
+            ## Fill no data values of an existing tile
+            with rasterio.open(out_tif, 'r+') as dst:
+                existing = dst.read(window=window)
+                data = np.where(_nodata_mask(data=existing, nodata=nodata), data, existing)
+                dst.write(data, window=window)
+        else:
+            meta.update({'driver': 'GTiff',
+                         'crs': dst_crs,
+                         'transform': tile_transform,
+                         'width': size,
+                         'height': size,
+                         'nodata': nodata,
+                         'sparse_ok': True})
+            if profile is not None:
+                meta.update(raster.gtiff_options(profile=profile, dtype=meta['dtype']))
+            else:
+                meta.update({'tiled': True, 'compress': 'LZW'})
+
+            with rasterio.open(out_tif, 'w', **meta) as dst:
+                dst.write(data, window=window)
+
+        return file, tile, "success"
+
+    except Exception as e:
+        return file, tile, f"fail 2: {e}"
+
+
+def _nodata_mask(data, nodata):
+    """Helper function for _cube_tile() to return a boolean array which is True where 'data' is no data. NaN is
+    handled separately, as it never compares equal to itself."""
+
+    if isinstance(nodata, float) and math.isnan(nodata):
+        return np.isnan(data)
+    else:
+        return data == nodata
+
+
+def _write_mosaic_vrt(directory, vrt_path, prj, sources):
+    """Helper function for create_mosaics() to write a VRT file for a list of relative source paths. The datacube tiles
+    are assumed to cover the full tile extent (as done by FORCE), so only the header of the first source file is read
+    and the position of each source in the mosaic is derived from its tile ID."""
+
+    with rasterio.open(os.path.join(directory, 'mosaic', sources[0])) as src:
+        count = src.count
+        dtype = GDAL_DTYPES[src.dtypes[0]]
+        nodata = src.nodata
+        res = src.res[0]
+        width, height = src.width, src.height
+        block_x, block_y = src.block_shapes[0][1], src.block_shapes[0][0]
+
+    tile_ids = [parse_tile_name(os.path.basename(os.path.dirname(s))) for s in sources]
+    x_min = min([t[0] for t in tile_ids])
+    y_min = min([t[1] for t in tile_ids])
+    x_max = max([t[0] for t in tile_ids])
+    y_max = max([t[1] for t in tile_ids])
+
+    left, _, _, top = tile_bounds(prj, x_min, y_min)
+
+    vrt = ET.Element('VRTDataset', rasterXSize=str((x_max - x_min + 1) * width),
+                     rasterYSize=str((y_max - y_min + 1) * height))
+    ET.SubElement(vrt, 'SRS').text = prj['wkt']
+    ET.SubElement(vrt, 'GeoTransform').text = f"{left}, {res}, 0.0, {top}, 0.0, {-res}"
+
+    for band in range(1, count + 1):
+        vrt_band = ET.SubElement(vrt, 'VRTRasterBand', dataType=dtype, band=str(band))
+        if nodata is not None:
+            ET.SubElement(vrt_band, 'NoDataValue').text = repr(nodata)
+
+        for source, (tx, ty) in zip(sources, tile_ids):
+            src_el = ET.SubElement(vrt_band, 'ComplexSource')
+            ET.SubElement(src_el, 'SourceFilename', relativeToVRT='1').text = source
+            ET.SubElement(src_el, 'SourceBand').text = str(band)
+            ET.SubElement(src_el, 'SourceProperties', RasterXSize=str(width), RasterYSize=str(height),
+                          DataType=dtype, BlockXSize=str(block_x), BlockYSize=str(block_y))
+            ET.SubElement(src_el, 'SrcRect', xOff='0', yOff='0', xSize=str(width), ySize=str(height))
+            ET.SubElement(src_el, 'DstRect', xOff=str((tx - x_min) * width), yOff=str((ty - y_min) * height),
+                          xSize=str(width), ySize=str(height))
+            if nodata is not None:
+                ET.SubElement(src_el, 'NODATA').text = repr(nodata)
+
+    ET.ElementTree(vrt).write(vrt_path)
+
+
+def _get_vrt_sources(vrt_path):
+    """Helper function for create_mosaics() to return the (sorted) source files of the first band of a VRT file."""
+
+    try:
+        root = ET.parse(vrt_path).getroot()
+    except ET.ParseError:
+        return None
+
+    band = root.find('VRTRasterBand')
+    if band is None:
+        return None
+
+    return sorted([el.text for el in band.iter('SourceFilename')])
+
+
+def _get_datacubeprj_dir(directory):
+    """Searches for 'datacube-definition.prj' in a level-2 directory and returns its parent directory. The top level of
+    the directory is checked first, before searching recursively."""
+
+    if os.path.isfile(os.path.join(directory, 'datacube-definition.prj')):
+        return Path(directory)
+
+    prj_path = []
+    for path in Path(directory).rglob('datacube-definition.prj'):
+        prj_path.append(path)
+
+    if len(prj_path) < 1:
+        raise FileNotFoundError(f"'datacube-definition.prj' not found in {directory}")
+    elif len(prj_path) > 1:
+        raise RuntimeError(f"'datacube-definition.prj' multiple copies found in {directory}")
+    else:
+        return prj_path[0].parent
@@ -0,0 +1,227 @@
+from ARDCube.config import get_settings, PROJ_DIR, FORCE_PATH, PYROSAR_PATH, get_setting, get_setting_bool
+
+import os
+import json
+import time
+import signal
+import threading
+import subprocess as sp
+from datetime import datetime
+from spython.main import Client
+
+## Tools (Singularity containers) that can be executed with execute()
+TOOLS = {'force': FORCE_PATH,
+         'pyrosar': PYROSAR_PATH}
+
+BACKENDS = ['singularity', 'native', 'replay']
+
+## Recorded calls that were not replayed yet (only used by the 'replay' backend)
+_replay = {'path': None, 'calls': None}
+
+
+def execute(tool, args, binds=None, stream=False, quiet=True, debug=False, backend=None, timeout=None, check=False):
+    """Executes a command of one of the supported tools (see TOOLS) with the execution backend defined in the
+    [EXECUTION] section of 'settings.prm'. Each call is timed and logged to /{ProjectDirectory}/data/log/executor.log ,
+    so the overhead of the backends can be compared (see also measure_overhead()).
+
+    Parameters
+    ----------
+    tool: string
+        Name of the tool, e.g. 'force' or 'pyrosar'.
+    args: list of strings
+        Command and arguments, e.g. ["force-cube", file, directory, "bilinear", "20"].
+    binds: list of strings (optional)
+        Additional bind paths of the form 'src:dst'. Only relevant for the 'singularity' backend.
+    stream: boolean (optional)
+        If True, a generator yielding the output line by line is returned. Otherwise the output is returned as a
+        string once the command finished.
+    quiet: boolean (optional)
+        Passed to spython for the 'singularity' backend.
+    debug: boolean (optional)
+        Print Singularity debugging information.
+    backend: string (optional)
+        Overrides the 'Backend' field in 'settings.prm'. Valid options:
+        'singularity' (execute inside the Singularity container of the tool),
+        'native' (execute the command directly on the host, e.g. with FORCE or pyroSAR installed locally),
+        'replay' (don't execute anything and return the output recorded for the same command instead)
+    timeout: float (optional)
+        Seconds after which the command (including all processes it started) is killed and a TimeoutError is raised.
+        Not applied by the 'replay' backend.
+    check: boolean (optional)
+        If True, a RuntimeError is raised if the command fails. This is always the case for the 'native' backend. For
+        the 'singularity' backend, the container is then executed directly instead of via spython, which is also the
+        case if a timeout is set.
+    """
+
+    if tool not in TOOLS:
+        raise ValueError(f"{tool} not recognized. Valid options are: {list(TOOLS.keys())}")
+
+    settings = get_settings()
+    if backend is None:
+        backend = get_setting(settings=settings, section='EXECUTION', field='Backend')
+    if backend not in BACKENDS:
+        raise ValueError(f"{backend} not recognized. Valid options for 'Backend' are: {BACKENDS}")
+
+    call = {'backend': backend, 'tool': tool, 'args': [str(a) for a in args],
+            'record': backend != 'replay' and get_setting_bool(settings=settings, section='EXECUTION', field='Record'),
+            'record_file': _get_record_file(settings=settings), 't0': time.time()}
+
+    if backend == 'singularity':
+        Client.debug = debug
+        options = ["--cleanenv"]
+        for bind in binds or []:
+            options.extend(["--bind", bind])
+        if timeout is None and not check:
+            out = Client.execute(TOOLS[tool], call['args'], options=options, quiet=quiet, stream=stream)
+        else:
+            out = _execute_native(args=["singularity", "exec"] + options + [TOOLS[tool]] + call['args'],
+                                  stream=stream, timeout=timeout)
+    elif backend == 'native':
+        out = _execute_native(args=call['args'], stream=stream, timeout=timeout)
+    else:
+        out = _execute_replay(record_file=call['record_file'], tool=tool, args=call['args'], stream=stream)
+
+    if stream:
+        return _stream(out=out, call=call)
+    else:
+        _finish(call=call, output=out)
+        return out
+
+
+def measure_overhead(tool, backends=None, n=5):
+    """Measures the overhead of each backend by executing a no-op command ('true') 'n' times. Returns a dictionary of
+    the form {'singularity': 0.8, 'native': 0.002} (mean seconds per call)."""
+
+    if backends is None:
+        backends = ['singularity', 'native']
+
+    overhead = {}
+    for backend in backends:
+        t0 = time.time()
+        for _ in range(n):
+            execute(tool=tool, args=["true"], backend=backend)
+        overhead[backend] = (time.time() - t0) / n
+
+    return overhead
+
+
+def _execute_native(args, stream, timeout=None):
+    """Helper function for execute() to run a command directly on the host. The command is started in a new session,
+    so that it can be killed together with all processes it started (e.g. gpt started by pyroSAR) once 'timeout'
+    seconds have passed."""
+
+    proc = sp.Popen(args, stdout=sp.PIPE, stderr=sp.STDOUT, universal_newlines=True, start_new_session=True)
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, _kill_session, args=(proc,))
+        timer.start()
+
+    if stream:
+        return _stream_native(proc=proc, args=args, timer=timer, timeout=timeout)
+
+    try:
+        out, _ = proc.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    _check_returncode(proc=proc, args=args, timeout=timeout, out=out)
+
+    return out
+
+
+def _stream_native(proc, args, timer=None, timeout=None):
+    """Helper function for _execute_native() to yield the output of a running process line by line."""
+
+    try:
+        for line in proc.stdout:
+            yield line
+        proc.stdout.close()
+        proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    _check_returncode(proc=proc, args=args, timeout=timeout)
+
+
+def _kill_session(proc):
+    """Helper function for _execute_native() to kill a process and all processes of its session."""
+
+    proc.timed_out = True
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _check_returncode(proc, args, timeout, out=None):
+    """Helper function for _execute_native() to raise an error if a process was killed after the timeout or failed."""
+
+    if getattr(proc, 'timed_out', False):
+        raise TimeoutError(f"{' '.join(args)} timed out after {timeout} s")
+    if proc.returncode != 0:
+        message = f"{' '.join(args)} failed with return code {proc.returncode}"
+        raise RuntimeError(message if out is None else f"{message}:\n{out}")
+
+
+def _execute_replay(record_file, tool, args, stream):
+    """Helper function for execute() to return the output of a recorded call of the same tool and arguments. Calls are
+    replayed in the order they were recorded, so repeated commands return their outputs in sequence."""
+
+    if _replay['path'] != record_file:
+        if not os.path.isfile(record_file):
+            raise FileNotFoundError(f"{record_file} does not exist. Record calls first with 'Record = True'.")
+        with open(record_file, 'r') as f:
+            _replay['calls'] = [json.loads(line) for line in f if len(line.strip()) > 0]
+        _replay['path'] = record_file
+
+    for i, recorded in enumerate(_replay['calls']):
+        if recorded['tool'] == tool and recorded['args'] == args:
+            del _replay['calls'][i]
+            if stream:
+                return iter(recorded['output'].splitlines(keepends=True))
+            else:
+                return recorded['output']
+
+    raise RuntimeError(f"No recorded call found for {tool}: {' '.join(args)}")
+
+
+def _stream(out, call):
+    """Helper function for execute() to pass through the output of a streamed call, which is timed and logged once the
+    command finished."""
+
+    lines = []
+    for line in out:
+        lines.append(line)
+        yield line
+
+    _finish(call=call, output=''.join(lines))
+
+
+def _finish(call, output):
+    """Helper function for execute() to log the duration of a call and record its output if necessary."""
+
+    seconds = time.time() - call['t0']
+
+    log_dir = os.path.join(PROJ_DIR, 'data', 'log')
+    if os.path.isdir(log_dir):
+        with open(os.path.join(log_dir, 'executor.log'), 'a') as f:
+            f.write(f"{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}\t{call['backend']}\t{call['tool']}\t"
+                    f"{seconds:.3f}\t{' '.join(call['args'])}\n")
+
+    if call['record']:
+        if isinstance(output, list):
+            output = '\n'.join([str(line) for line in output])
+        with open(call['record_file'], 'a') as f:
+            f.write(json.dumps({'tool': call['tool'], 'args': call['args'], 'output': str(output or ''),
+                                'seconds': seconds, 'backend': call['backend']}) + '\n')
+
+
+def _get_record_file(settings):
+    """Helper function for execute() to get the path of the file that calls are recorded to and replayed from."""
+
+    record_file = get_setting(settings=settings, section='EXECUTION', field='RecordFile')
+    if record_file is None or len(record_file) == 0:
+        record_file = os.path.join(PROJ_DIR, 'data', 'meta', 'executor_record.jsonl')
+
+    return record_file
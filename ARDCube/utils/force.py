@@ -1,13 +1,28 @@
-from ARDCube.config import get_settings, FORCE_PATH
+from ARDCube.config import get_settings
 import ARDCube.utils.general as utils
+import ARDCube.utils.executor as executor
+import ARDCube.utils.tasks as tasks
 
 import os
 import sys
 import glob
 import shutil
-from pathlib import Path
-from spython.main import Client
-import fiona
+import numpy as np
+
+## Position and length of each flag of the FORCE Quality Assurance Information (QAI) band
+## https://force-eo.readthedocs.io/en/latest/howto/qai.html#quality-bits-in-force
+QAI_FLAGS = {'valid_data': (0, 1),
+             'cloud_state': (1, 2),
+             'cloud_shadow': (3, 1),
+             'snow': (4, 1),
+             'water': (5, 1),
+             'aerosol_state': (6, 2),
+             'subzero': (8, 1),
+             'saturation': (9, 1),
+             'high_sun_zenith': (10, 1),
+             'illumination_state': (11, 2),
+             'slope': (13, 1),
+             'water_vapor': (14, 1)}
 
 
 def download_catalogues(directory):
@@ -23,8 +38,7 @@ def download_catalogues(directory):
             print("\n#### Starting download of metadata catalogues...")
             utils.isdir_mkdir(directory)
 
-            out = Client.execute(FORCE_PATH, ["force-level1-csd", "-u", directory],
-                                 options=["--cleanenv"], stream=True)
+            out = executor.execute(tool='force', args=["force-level1-csd", "-u", directory], stream=True)
             for line in out:
                 print(line, end='')
 
@@ -36,34 +50,9 @@ def download_catalogues(directory):
             continue
 
 
-def create_kml_grid(directory):
-    """Wrapper for 'force-tabulate-grid'."""
-
-    aoi_path = utils.get_aoi_path(settings=get_settings())
-    prj_dir = _get_datacubeprj_dir(directory=directory)
-
-    ## Get AOI bounds and add a buffer of 1°
-    with fiona.open(aoi_path) as f:
-        bottom = f.bounds[1] - 1
-        top = f.bounds[3] + 1
-        left = f.bounds[0] - 1
-        right = f.bounds[2] + 1
-
-    Client.execute(FORCE_PATH, ["force-tabulate-grid", prj_dir, str(bottom), str(top), str(left), str(right), "kml"],
-                   options=["--cleanenv"])
-
-
-def create_mosaics(directory):
-    """Wrapper for 'force-mosaic'."""
-
-    prj_dir = _get_datacubeprj_dir(directory=directory)
-
-    Client.execute(FORCE_PATH, ["force-mosaic", prj_dir],
-                   options=["--cleanenv"])
-
-
-def cube_dataset(directory, prj_file=None, resample='bilinear', resolution=20):
-    """Wrapper for 'force-cube'."""
+def cube_dataset(directory, prj_file=None, resample='bilinear', resolution=20, settings=None):
+    """Wrapper for 'force-cube'. Each call is retried based on the [EXECUTION] section of 'settings.prm' (see
+    ARDCube.utils.tasks.run_task()). Files that still fail are kept and added to the dead-letter list."""
 
     ##TODO: Fallback datacube.prj file in /settings/pyrosar !
 
@@ -76,10 +65,13 @@ def cube_dataset(directory, prj_file=None, resample='bilinear', resolution=20):
     else:
         shutil.copyfile(prj_file, os.path.join(directory, os.path.basename(prj_file)))
 
-    ## Get list of all GeoTIFF files
-    file_paths = []
-    for file in glob.iglob(os.path.join(directory, "**/*.tif"), recursive=True):
-        file_paths.append(file)
+    ## Get list of all GeoTIFF files in the top level of the directory. Tiles that were already written to the
+    ## subdirectories (/X*_Y*/) by previous calls are not processed again
+    file_paths = sorted(glob.glob(os.path.join(directory, '*.tif')))
+
+    if settings is None:
+        settings = get_settings()
+    timeout = tasks.get_timeout(settings=settings)
 
     ## Execute FORCE command sequentially for each file
     ## Relevant: https://github.com/davidfrantz/force/issues/63
@@ -89,22 +81,20 @@ def cube_dataset(directory, prj_file=None, resample='bilinear', resolution=20):
         for file in file_paths:
             i += 1
             utils.progress(i, total, status=f"Running force-cube on {total} files")
-            Client.execute(FORCE_PATH, ["force-cube", file, directory, resample, str(resolution)],
-                           options=["--cleanenv"])
-
-            os.remove(file)
+            success, _ = tasks.run_task(func=executor.execute,
+                                        kwargs={'tool': 'force', 'args': ["force-cube", file, directory, resample,
+                                                                          str(resolution)],
+                                                'timeout': timeout, 'check': True},
+                                        sensor=os.path.basename(directory), stage='cubed',
+                                        scene=os.path.basename(file), settings=settings)
+            if success:
+                os.remove(file)
 
 
-def _get_datacubeprj_dir(directory):
-    """Recursively searches for 'datacube-definition.prj' in a level-2 directory and returns its parent directory."""
+def decode_qai(qai, flag):
+    """Decodes a flag (see QAI_FLAGS) from an array of FORCE QAI values and returns an array of the same shape with
+    the flag values, e.g. 0-3 for 'cloud_state' (0: clear, 1: less confident, 2: confident, 3: cirrus)."""
 
-    prj_path = []
-    for path in Path(directory).rglob('datacube-definition.prj'):
-        prj_path.append(path)
+    bit, length = QAI_FLAGS[flag]
 
-    if len(prj_path) < 1:
-        raise FileNotFoundError(f"'datacube-definition.prj' not found in {directory}")
-    elif len(prj_path) > 1:
-        raise RuntimeError(f"'datacube-definition.prj' multiple copies found in {directory}")
-    else:
-        return prj_path[0].parent
+    return (qai.astype(np.uint16) >> bit) & ((1 << length) - 1)
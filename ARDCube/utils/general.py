@@ -1,9 +1,20 @@
 from ARDCube import ROOT_DIR
-from ARDCube.config import PROJ_DIR, PYROSAR_PATH, DEM_TYPES
+from ARDCube.config import PROJ_DIR, DEM_TYPES
+import ARDCube.utils.executor as executor
+import ARDCube.utils.tasks as tasks
 
 import os
+import re
 import shutil
 import sys
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing as mp
+from datetime import datetime
+import yaml
+import pyarrow as pa
+import pyarrow.parquet as pq
 from spython.main import Client
 import geopandas as gpd
 import rasterio
@@ -32,19 +43,140 @@ def setup_project(directory, build_containers=False):
     ## Build Singularity containers
     if build_containers:
         print('#### Building Singularity containers...')
-        singularity_dir = os.path.join(directory, 'management', 'singularity')
-        cookbook = ['force.def', 'postgres.def', 'pyrosar.def']
+        build_containers_parallel(singularity_dir=os.path.join(directory, 'management', 'singularity'),
+                                  cookbook=['force.def', 'postgres.def', 'pyrosar.def'])
+
+
+def build_containers_parallel(singularity_dir, cookbook, rebuild=False):
+    """Builds the Singularity containers of all recipes in 'cookbook' (located in the 'recipes' subdirectory of
+    'singularity_dir') concurrently, with one process per container. Output lines of all builds are streamed and
+    prefixed with the name of the container.
+    A hash of each recipe and the local files it copies in its %files section (see _recipe_hash()) is saved next to
+    the image (e.g. 'force.sif.sha1') after a successful build. A container is only built again if this hash changed,
+    the image is missing or 'rebuild' is True. Existing images are overwritten."""
+
+    to_build = []
+    for recipe in cookbook:
+        recipe_path = os.path.join(singularity_dir, 'recipes', recipe)
+        image = os.path.join(singularity_dir, f"{os.path.basename(recipe).split('.')[0]}.sif")
+        recipe_hash = _recipe_hash(recipe_path=recipe_path, build_dir=singularity_dir)
+
+        hash_file = f"{image}.sha1"
+        if not rebuild and os.path.isfile(image) and os.path.isfile(hash_file):
+            with open(hash_file, 'r') as f:
+                if f.read().strip() == recipe_hash:
+                    print(f"{image} is up to date. Skipping build.")
+                    continue
+
+        to_build.append((recipe_path, image, recipe_hash))
+
+    if len(to_build) == 0:
+        return
+
+    ## Builds require sudo privileges. Ask for the password once, before the builds are started in parallel.
+    subprocess.run(['sudo', '-v'], check=True)
+
+    pool = mp.Pool(len(to_build))
+    result_objects = [pool.apply_async(_build_container, args=(recipe_path, image, recipe_hash, singularity_dir))
+                      for recipe_path, image, recipe_hash in to_build]
+    results = [r.get() for r in result_objects]
+    pool.close()
+    pool.join()
+
+    failed = [image for image, error in results if error is not None]
+    for image, error in results:
+        if error is None:
+            print(f'Finished building {image}')
+        else:
+            print(f'Building {image} failed: {error}')
+
+    if len(failed) > 0:
+        raise RuntimeError(f"{len(failed)} of {len(results)} Singularity containers could not be built.")
+
+
+def _build_container(recipe_path, image, recipe_hash, build_dir):
+    """Helper function executed in build_containers_parallel() which builds a single container and saves the hash of
+    its recipe afterwards. An existing image is overwritten. Returns the path of the image and None or the error
+    message if the build failed."""
+
+    name = os.path.splitext(os.path.basename(image))[0]
+
+    ## Relative paths in the %files section of the recipes refer to the 'singularity' directory. They are resolved in a
+    ## temporary copy of the recipe, so the working directory of the process doesn't need to be changed.
+    with open(recipe_path, 'r') as f:
+        recipe = f.read()
+    with tempfile.NamedTemporaryFile(mode='w', prefix=f"{name}_", suffix='.def', delete=False) as f:
+        f.write(_resolve_recipe_files(recipe=recipe, build_dir=build_dir))
+        tmp_recipe = f.name
+
+    try:
+        _, out = Client.build(recipe=tmp_recipe, image=image, stream=True, force=os.path.isfile(image))
+        for line in out:
+            print(f"[{name}] {line}", end='', flush=True)
+    except Exception as e:
+        return image, f"{type(e).__name__}: {e}"
+    finally:
+        os.remove(tmp_recipe)
+
+    with open(f"{image}.sha1", 'w') as f:
+        f.write(recipe_hash)
+
+    return image, None
+
+
+def _recipe_hash(recipe_path, build_dir):
+    """Helper function for build_containers_parallel() to return a SHA-1 hash of a recipe and all local files and
+    directories that are copied into the container in its %files section (paths relative to 'build_dir')."""
+
+    h = hashlib.sha1()
+    with open(recipe_path, 'rb') as f:
+        recipe = f.read()
+    h.update(recipe)
+
+    ## Collect the source paths listed in the %files section
+    sources = []
+    section = None
+    for line in recipe.decode('utf-8').splitlines():
+        line = line.strip()
+        if line.startswith('%'):
+            section = line.split()[0]
+            continue
+        if section == '%files' and len(line) > 0 and not line.startswith('#'):
+            sources.append(os.path.normpath(os.path.join(build_dir, line.split()[0])))
+
+    for source in sources:
+        if os.path.isdir(source):
+            files = sorted([os.path.join(root, file) for root, _, file_list in os.walk(source) for file in file_list])
+        else:
+            files = [source]
+        for file in files:
+            if not os.path.isfile(file):
+                continue
+            h.update(os.path.relpath(file, build_dir).encode('utf-8'))
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                    h.update(chunk)
 
-        for recipe in cookbook:
-            image, out = Client.build(recipe=os.path.join(singularity_dir, 'recipes', recipe),
-                                      image=os.path.join(singularity_dir,
-                                                         f"{os.path.basename(recipe).split('.')[0]}.sif"),
-                                      stream=True)
+    return h.hexdigest()
 
-            for line in out:
-                print(line, end='')
 
-            print(f'Finished building {image}')
+def _resolve_recipe_files(recipe, build_dir):
+    """Helper function for _build_container() to return the content of a recipe in which the relative source paths of
+    its %files section are replaced by absolute paths (relative to 'build_dir')."""
+
+    lines = []
+    section = None
+    for line in recipe.splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped.startswith('%'):
+            section = stripped.split()[0]
+        elif section == '%files' and len(stripped) > 0 and not stripped.startswith('#'):
+            source = stripped.split()[0]
+            if not os.path.isabs(source):
+                line = line.replace(source, os.path.normpath(os.path.join(build_dir, source)), 1)
+        lines.append(line)
+
+    return ''.join(lines)
 
 
 def _copytree(src, dst, symlinks=False, ignore=None):
@@ -83,24 +215,71 @@ def _save_projdir(project_directory):
 
 
 def get_aoi_path(settings):
-    """Returns the full path of the AOI file based on what was provided in the 'AOI' field in 'settings.prm'"""
+    """Returns the full path of the AOI file based on what was provided in the 'AOI' field in 'settings.prm'. If more
+    than one AOI is provided (comma-separated), the path of a file containing the union of all AOIs is returned instead
+    (see get_aoi_paths() to get the path of each AOI)."""
+
+    aoi_paths = get_aoi_paths(settings=settings)
+
+    if len(aoi_paths) == 1:
+        return aoi_paths[0]
+    else:
+        return _union_aoi(aoi_paths=aoi_paths)
+
+
+def get_aoi_paths(settings):
+    """Returns a list of the full paths of all AOI files provided (comma-separated) in the 'AOI' field in
+    'settings.prm'."""
 
     aoi_field = settings['GENERAL']['AOI']
 
     if len(aoi_field) == 0:
         raise RuntimeError("Field 'AOI': Input missing!")
 
-    ## Field can be filename (assumed to be located in the directory /{ProjectDirectory}/data/misc/aoi ) or full path
-    if not os.path.isfile(aoi_field):
-        aoi_path = os.path.join(PROJ_DIR, 'data', 'misc', 'aoi', aoi_field)
-    else:
-        aoi_path = aoi_field
+    aoi_paths = []
+    for aoi in [a.strip() for a in aoi_field.split(',') if len(a.strip()) > 0]:
+
+        ## Field can be filename (assumed to be located in the directory /{ProjectDirectory}/data/misc/aoi ) or full
+        ## path
+        if not os.path.isfile(aoi):
+            aoi_path = os.path.join(PROJ_DIR, 'data', 'misc', 'aoi', aoi)
+        else:
+            aoi_path = aoi
+
+        if not os.path.isfile(aoi_path):
+            raise FileNotFoundError(f"{aoi_path} does not exist! \n"
+                                    f"Please check your settings.prm for correct input of field 'AOI'!")
+
+        aoi_paths.append(aoi_path)
 
-    if not os.path.isfile(aoi_path):
-        raise FileNotFoundError(f"{aoi_path} does not exist! \n"
-                                f"Please check your settings.prm for correct input of field 'AOI'!")
+    names = [get_aoi_name(aoi_path=aoi_path) for aoi_path in aoi_paths]
+    if len(set(names)) < len(names):
+        raise ValueError(f"Field 'AOI': The filenames of all AOIs need to be unique, but got {names}")
 
-    return aoi_path
+    return aoi_paths
+
+
+def get_aoi_name(aoi_path):
+    """Returns the name of an AOI (filename without suffix), which is used to name AOI-specific outputs."""
+
+    return os.path.splitext(os.path.basename(aoi_path))[0]
+
+
+def _union_aoi(aoi_paths):
+    """Helper function for get_aoi_path() to create a GeoJSON file (WGS84) containing the union of multiple AOIs in the
+    directory /{ProjectDirectory}/data/misc/aoi . The file is only created again if any of the AOI files is newer."""
+
+    names = [get_aoi_name(aoi_path=aoi_path) for aoi_path in aoi_paths]
+    out_path = os.path.join(PROJ_DIR, 'data', 'misc', 'aoi', f"union__{'__'.join(sorted(names))}.geojson")
+
+    if os.path.isfile(out_path) and \
+            os.path.getmtime(out_path) >= max([os.path.getmtime(aoi_path) for aoi_path in aoi_paths]):
+        return out_path
+
+    aoi = gpd.GeoSeries([gpd.read_file(aoi_path).to_crs(4326).unary_union for aoi_path in aoi_paths], crs=4326)
+    gpd.GeoDataFrame(geometry=[aoi.unary_union], crs=4326).to_file(out_path, driver='GeoJSON')
+
+    return out_path
 
 
 def get_dem_path(settings):
@@ -132,7 +311,8 @@ def get_dem_path(settings):
 
 
 def create_dem(settings, dem_type):
-    """Creates a Digital Elevation Model for the AOI using the pyroSAR Singularity container."""
+    """Creates a Digital Elevation Model for the AOI using the pyroSAR Singularity container. The container call is
+    retried based on the [EXECUTION] section of 'settings.prm' (see ARDCube.utils.tasks.run_task())."""
 
     out_dir = os.path.join(PROJ_DIR, 'data', 'misc', 'dem')
     isdir_mkdir(out_dir)
@@ -146,11 +326,11 @@ def create_dem(settings, dem_type):
     if os.path.isfile(dem_path):
         while True:
             answer = input(f"{dem_path} already exist.\n"
-                           f"Do you want to create a new {dem_type} DEM for your AOI and overwrite the existing file? \n"
+                           f"Do you want to create a new {dem_type} DEM for your AOI and overwrite the existing "
+                           f"file? \n"
                            f"If not, the existing file will be used for processing! (y/n)")
             if answer in ['y', 'yes']:
-                Client.execute(PYROSAR_PATH, ["python", dem_py_path, aoi_path, dem_path, dem_type],
-                               options=["--cleanenv"])
+                _run_dem_py(settings=settings, args=["python", dem_py_path, aoi_path, dem_path, dem_type])
                 break
             elif answer in ['n', 'no']:
                 break
@@ -158,8 +338,7 @@ def create_dem(settings, dem_type):
                 print(f"{answer} is not a valid answer!")
                 continue
     else:
-        Client.execute(PYROSAR_PATH, ["python", dem_py_path, aoi_path, dem_path, dem_type],
-                       options=["--cleanenv"])
+        _run_dem_py(settings=settings, args=["python", dem_py_path, aoi_path, dem_path, dem_type])
 
     with rasterio.open(dem_path) as dem:
         dem_nodata = dem.nodata
@@ -167,6 +346,17 @@ def create_dem(settings, dem_type):
     return dem_path, dem_nodata
 
 
+def _run_dem_py(settings, args):
+    """Helper function for create_dem() to execute dem.py inside the pyroSAR Singularity container."""
+
+    success, result = tasks.run_task(func=executor.execute,
+                                     kwargs={'tool': 'pyrosar', 'args': args, 'check': True,
+                                             'timeout': tasks.get_timeout(settings=settings)},
+                                     sensor='dem', stage='dem', scene=os.path.basename(args[3]), settings=settings)
+    if not success:
+        raise RuntimeError(f"{args[3]} could not be created: {result['error']}")
+
+
 def _aoi_wgs84(aoi_path):
     """Helper function for create_dem() to convert AOI to WGS84 if necessary. Otherwise DEM creation fails."""
 
@@ -200,6 +390,110 @@ def _get_driver(suffix):
         raise RuntimeError(f"{suffix} is not a supported format for the AOI file.")
 
 
+def read_product_yaml(sensor):
+    """Returns information from the Product Definition YAML file(s) of a sensor located in the /settings/odc directory
+    as a dictionary of the form {'sentinel1_asc.yaml': {'name': ..., 'crs': ..., 'res': ..., 'band_names': [...]}}.
+    Sentinel-1 has a Product Definition per orbit direction."""
+
+    odc_dir = os.path.join(PROJ_DIR, 'management', 'settings', 'odc')
+
+    if sensor == 'sentinel1':
+        product_path = [os.path.join(odc_dir,  f"{sensor}_asc.yaml"),
+                        os.path.join(odc_dir, f"{sensor}_desc.yaml")]
+    else:
+        product_path = [os.path.join(odc_dir, f"{sensor}.yaml")]
+
+    dict_out = {}
+    for path in product_path:
+        with open(path) as f:
+            yaml_dict = yaml.safe_load(f)
+
+            name = yaml_dict['name']
+            crs = yaml_dict['storage']['crs']
+            res = yaml_dict['storage']['resolution']['x']
+            band_names = [yaml_dict['measurements'][i]['name'] for i in range(len(yaml_dict['measurements']))]
+
+        dict_out[os.path.basename(path)] = {'name': name, 'crs': crs, 'res': res, 'band_names': band_names}
+
+    return dict_out
+
+
+def s1_is_asc_or_desc(file_path):
+    """Returns the orbit direction ('asc' or 'desc') of a Sentinel-1 file based on pyroSAR's naming convention."""
+
+    file = os.path.basename(file_path)
+
+    if file[10:11] == 'A':
+        return 'asc'
+    elif file[10:11] == 'D':
+        return 'desc'
+    else:
+        raise RuntimeError(f"Can't determine orbit direction of {file_path}")
+
+
+def date_key(date, default):
+    """Converts a date string of the format 'YYYY-mm-dd' into the format used in filenames and the catalogue
+    (YYYYmmdd). Returns 'default' if 'date' is None."""
+
+    if date is None:
+        return default
+
+    try:
+        return datetime.strptime(date, '%Y-%m-%d').strftime('%Y%m%d')
+    except ValueError:
+        raise ValueError(f"{date} is not a valid date. The expected format is 'YYYY-mm-dd'.")
+
+
+def get_date_string(file_path, sensor=None, do_format=False):
+    """Extracts the date (YYYYmmdd or YYYYmmddTHHMMSS) from a file name. If 'do_format' is True, it is formatted
+    with format_date_string()."""
+
+    f_base = os.path.basename(file_path)
+
+    ## Search either for the 8 digit pattern (YYYYmmdd) used in files that were processed with FORCE.
+    ## Or the 15 digit pattern (YYYYmmddTHHMMSS) used in files that were processed with pyroSAR. The underscore is
+    ## necessary, because otherwise only the former pattern is found.
+    rs = re.search(r'\d{8}|_\d{8}T\d{6}', f_base)
+    date = rs.group()
+    date = date.replace("_", "")
+
+    if do_format:
+        return format_date_string(date=date, sensor=sensor)
+    else:
+        return date
+
+
+def format_date_string(date, sensor):
+    """Formats a date string from either YYYYmmdd or YYYYmmddTHHMMSS to YYYY-mm-ddTHH:MM:SS.000Z."""
+
+    if len(date) == 8:
+        if sensor.startswith('landsat'):
+            date = datetime.strptime(date, '%Y%m%d').strftime('%Y-%m-%dT10:00:00.000Z')  # Landsat
+        else:
+            date = datetime.strptime(date, '%Y%m%d').strftime('%Y-%m-%dT10:30:00.000Z')  # Sentinel-2
+    elif len(date) == 15:
+        date = datetime.strptime(date, '%Y%m%dT%H%M%S').strftime('%Y-%m-%dT%H:%M:%S.000Z')  # Sentinel-1
+    else:
+        raise RuntimeError("Length of date string is expected to be of length 8 or 15 based on existing file naming "
+                           "conventions used by pyroSAR and FORCE.")
+
+    return date
+
+
+def write_parquet(writer, out_path, frame):
+    """Appends a DataFrame to a Parquet file as a new row group. The writer is created with the schema of the first
+    DataFrame and returned, so it can be reused for the following ones. The writer needs to be closed by the caller."""
+
+    if writer is None:
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        writer = pq.ParquetWriter(out_path, schema=table.schema)
+    else:
+        table = pa.Table.from_pandas(frame, schema=writer.schema, preserve_index=False)
+    writer.write_table(table)
+
+    return writer
+
+
 def isdir_mkdir(directory):
     """Create a directory (or each directory in a list) if it doesn't exist already."""
 
@@ -0,0 +1,163 @@
+from ARDCube.config import PROJ_DIR
+
+import os
+import re
+import json
+import sqlite3
+import hashlib
+from datetime import datetime
+
+## Processing stages in the order in which they are usually reached
+STAGES = ['downloaded', 'geocoded', 'cropped', 'cubed', 'documented', 'indexed']
+
+## Fields of 'settings.prm' that affect the result of each stage. If any of them change, the stage is repeated.
+STAGE_SETTINGS = {'downloaded': [],
+                  'geocoded': [('GENERAL', 'AOI'), ('PROCESSING', 'DEM'), ('PROCESSING', 'TargetResolution'),
+                               ('PROCESSING', 'Polarizations'), ('PROCESSING', 'SpeckleFilter'),
+                               ('PROCESSING', 'RefArea'), ('PROCESSING', 'AssembleSlices')],
+                  'cropped': [('GENERAL', 'AOI'), ('PROCESSING', 'Scaling'), ('OUTPUT', 'Format'),
+                              ('OUTPUT', 'Compression'), ('OUTPUT', 'Predictor'), ('OUTPUT', 'BlockSize'),
+                              ('OUTPUT', 'Overviews')],
+                  'cubed': [('PROCESSING', 'TargetResolution'), ('PROCESSING', 'CubeEngine')],
+                  'documented': [],
+                  'indexed': []}
+
+
+def connect():
+    """Opens (and creates if necessary) the state journal located in /{ProjectDirectory}/data/meta/journal.sqlite and
+    returns the sqlite3 connection. The journal contains one row per sensor, scene and stage that was completed, as
+    well as a cache of the AOI overlap of Sentinel-1 level-1 scenes (see get_overlap())."""
+
+    meta_dir = os.path.join(PROJ_DIR, 'data', 'meta')
+    if not os.path.isdir(meta_dir):
+        os.makedirs(meta_dir)
+
+    conn = sqlite3.connect(os.path.join(meta_dir, 'journal.sqlite'))
+    conn.execute("CREATE TABLE IF NOT EXISTS journal ("
+                 "sensor TEXT NOT NULL, "
+                 "scene TEXT NOT NULL, "
+                 "stage TEXT NOT NULL, "
+                 "input_hash TEXT, "
+                 "settings_hash TEXT, "
+                 "updated TEXT, "
+                 "PRIMARY KEY (sensor, scene, stage))")
+    conn.execute("CREATE TABLE IF NOT EXISTS overlap ("
+                 "scene TEXT PRIMARY KEY, "
+                 "input_hash TEXT, "
+                 "aoi_hash TEXT, "
+                 "overlap REAL)")
+    conn.commit()
+
+    return conn
+
+
+def needs_update(conn, sensor, scene, stage, input_hash, settings_hash):
+    """Returns True if a stage has not been completed for a scene yet, or if it was completed with a different input
+    or different settings."""
+
+    row = conn.execute("SELECT input_hash, settings_hash FROM journal WHERE sensor=? AND scene=? AND stage=?",
+                       (sensor, scene, stage)).fetchone()
+
+    return row is None or row[0] != input_hash or row[1] != settings_hash
+
+
+def record(conn, sensor, scene, stage, input_hash, settings_hash):
+    """Records that a stage was completed for a scene."""
+
+    if stage not in STAGES:
+        raise ValueError(f"{stage} not recognized. Valid options are: {STAGES}")
+
+    conn.execute("INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?, ?)",
+                 (sensor, scene, stage, input_hash, settings_hash, datetime.now().strftime('%Y-%m-%dT%H:%M:%S')))
+    conn.commit()
+
+
+def get_overlap(conn, scene, input_hash, aoi_hash):
+    """Returns the cached AOI overlap (0 - 1) of a scene, or None if it was not recorded for the same input and AOI
+    yet (see record_overlap())."""
+
+    row = conn.execute("SELECT overlap FROM overlap WHERE scene=? AND input_hash=? AND aoi_hash=?",
+                       (scene, input_hash, aoi_hash)).fetchone()
+
+    return None if row is None else row[0]
+
+
+def record_overlap(conn, scene, input_hash, aoi_hash, overlap):
+    """Records the AOI overlap (0 - 1) of a scene, so it doesn't need to be read from the scene again."""
+
+    conn.execute("INSERT OR REPLACE INTO overlap VALUES (?, ?, ?, ?)", (scene, input_hash, aoi_hash, overlap))
+    conn.commit()
+
+
+def summarize(conn, sensor=None):
+    """Returns a list of (sensor, stage, number of scenes, last update) tuples."""
+
+    query = "SELECT sensor, stage, COUNT(*), MAX(updated) FROM journal"
+    params = ()
+    if sensor is not None:
+        query += " WHERE sensor=?"
+        params = (sensor,)
+    rows = conn.execute(query + " GROUP BY sensor, stage", params).fetchall()
+
+    return sorted(rows, key=lambda r: (r[0], STAGES.index(r[1]) if r[1] in STAGES else len(STAGES)))
+
+
+def print_status(sensor=None):
+    """Prints a summary of the state journal: the number of scenes that completed each stage per sensor."""
+
+    conn = connect()
+    rows = summarize(conn=conn, sensor=sensor)
+    conn.close()
+
+    if len(rows) == 0:
+        print("The state journal is empty.")
+        return
+
+    print(f"{'Sensor':<12}{'Stage':<12}{'Scenes':>8}  Last update")
+    for r in rows:
+        print(f"{r[0]:<12}{r[1]:<12}{r[2]:>8}  {r[3]}")
+
+
+def file_fingerprint(paths, quick=False):
+    """Returns a fingerprint of one or more files. It is based on file size and modification time, as well as on the
+    content of the first and last MB of each file (unless 'quick' is True). This is much faster than hashing the
+    whole file, which would be too slow for Sentinel-1 scenes of several GB."""
+
+    if isinstance(paths, str):
+        paths = [paths]
+
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        h.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        if not quick and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                h.update(f.read(2**20))
+                if stat.st_size > 2**20:
+                    f.seek(max(2**20, stat.st_size - 2**20))
+                    h.update(f.read(2**20))
+
+    return h.hexdigest()
+
+
+def settings_fingerprint(settings, stage, extra=None):
+    """Returns a fingerprint of all fields of 'settings.prm' that affect the result of a stage (see STAGE_SETTINGS).
+    Additional values that affect the stage can be provided with 'extra'."""
+
+    values = [settings.get(section, field, fallback=None) for section, field in STAGE_SETTINGS[stage]]
+    if extra is not None:
+        values.append(extra)
+
+    return hashlib.sha1(json.dumps(values, default=str).encode()).hexdigest()
+
+
+def s1_scene_id(file_path):
+    """Returns a scene ID of the form 'S1A_20200501T171519' (sensor and acquisition start) for a Sentinel-1 level-1 zip
+    file or a file processed with pyroSAR, so that all processing stages of a scene share the same ID."""
+
+    f_base = os.path.basename(file_path)
+    date = re.search(r'\d{8}T\d{6}', f_base)
+    if date is None:
+        raise RuntimeError(f"Can't determine acquisition start of {file_path}")
+
+    return f"{f_base[:3]}_{date.group()}"
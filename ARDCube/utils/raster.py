@@ -0,0 +1,427 @@
+from ARDCube.config import PROJ_DIR, DEFAULTS, get_setting
+import ARDCube.utils.cluster as cluster
+
+import os
+import glob
+import json
+import shutil
+import multiprocessing as mp
+from datetime import datetime
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+
+
+def get_output_profile(settings):
+    """Returns the raster output profile defined in the [OUTPUT] section of 'settings.prm' as a dictionary. The profile
+    is used for cropped SAR rasters as well as for post-processed level-2 tiles."""
+
+    output = {field: get_setting(settings=settings, section='OUTPUT', field=field) for field in DEFAULTS['OUTPUT']}
+
+    fmt = output['Format'].upper()
+    if fmt not in ['COG', 'GTIFF']:
+        raise ValueError(f"Field 'Format': {output['Format']} not recognized. Valid options are 'COG' or 'GTiff'!")
+
+    compress = output['Compression'].upper()
+    if compress not in ['ZSTD', 'DEFLATE', 'LZW', 'NONE']:
+        raise ValueError(f"Field 'Compression': {output['Compression']} not recognized. Valid options are 'ZSTD', "
+                         f"'DEFLATE', 'LZW' or 'NONE'!")
+
+    predictor = output['Predictor'].lower()
+    if predictor not in ['auto', 'none']:
+        raise ValueError(f"Field 'Predictor': {output['Predictor']} not recognized. Valid options are 'auto' or "
+                         f"'none'!")
+
+    block_size = int(output['BlockSize'])
+    if block_size % 16 != 0:
+        raise ValueError(f"Field 'BlockSize': {block_size} is not a multiple of 16!")
+
+    return {'format': fmt,
+            'compress': compress,
+            'predictor': predictor,
+            'block_size': block_size,
+            'overviews': output['Overviews'] in ['True', 'true', 'yes'],
+            'resampling': output['OverviewResampling'].lower(),
+            'num_threads': _threads_per_process(settings=settings, value=output['NumThreads'])}
+
+
+def get_gdal_env(settings, stage):
+    """Returns the GDAL configuration options of a processing stage as a dictionary, which can be passed to
+    rasterio.Env() or run_with_env(). The options are defined in the sections [GDAL_HEADERSCAN], [GDAL_CROP] and
+    [GDAL_WRITE] of 'settings.prm'.
+
+    Parameters
+    ----------
+    settings: ConfigParser object
+        A dictionary-like object created by ARDCube.config.get_settings
+    stage: string
+        'headerscan' (many small reads of file headers, e.g. prepare_odc), 'crop' (large reads, e.g. cropping SAR
+        scenes) or 'write' (e.g. tiling and compressing level-2 tiles).
+    """
+
+    if stage not in ['headerscan', 'crop', 'write']:
+        raise ValueError(f"{stage} not recognized. Valid options are 'headerscan', 'crop' or 'write'!")
+
+    section = f"GDAL_{stage.upper()}"
+    if not settings.has_section(section):
+        return {}
+
+    ## ConfigParser converts all keys to lowercase, GDAL expects uppercase
+    env = {key.upper(): value for key, value in settings[section].items() if value is not None and len(value) > 0}
+    if 'GDAL_NUM_THREADS' in env:
+        env['GDAL_NUM_THREADS'] = _threads_per_process(settings=settings, value=env['GDAL_NUM_THREADS'])
+
+    return env
+
+
+def _threads_per_process(settings, value):
+    """Helper function for get_output_profile() and get_gdal_env() to resolve a thread count of 'ALL_CPUS'. The
+    profile and options are applied in each of the 'NPROC' processes of a pool, so the CPUs are divided between them
+    instead of starting 'NPROC' x CPU count threads. Other values are returned as they are."""
+
+    if value.upper() != 'ALL_CPUS':
+        return value
+
+    return str(max(1, mp.cpu_count() // int(settings['PROCESSING']['NPROC'])))
+
+
+def run_with_env(env, func, *args):
+    """Executes func(*args) inside a rasterio.Env() with the GDAL configuration options created by get_gdal_env().
+    This is used to apply the options inside each worker of a multiprocessing pool."""
+
+    if env is None:
+        env = {}
+
+    with rasterio.Env(**env):
+        return func(*args)
+
+
+def write_raster(path, array, meta, profile):
+    """Writes an array (bands, rows, cols) to a GeoTIFF file using the output profile created by get_output_profile().
+    'meta' is expected to be a rasterio metadata dictionary (e.g. src.meta) describing the array."""
+
+    meta = meta.copy()
+    meta.update({'driver': 'GTiff',
+                 'count': array.shape[0],
+                 'height': array.shape[1],
+                 'width': array.shape[2]})
+
+    if profile['format'] == 'COG':
+        ## The COG driver can only be used with CreateCopy(), so the array is written to a temporary GeoTIFF first
+        tmp_path = path.replace('.tif', '_cog_tmp.tif')
+        with rasterio.open(tmp_path, 'w', **meta) as dst:
+            dst.write(array)
+        convert_raster(src_path=tmp_path, dst_path=path, profile=profile)
+        os.remove(tmp_path)
+    else:
+        meta.update(gtiff_options(profile=profile, dtype=meta['dtype']))
+        with rasterio.open(path, 'w', **meta) as dst:
+            dst.write(array)
+            if profile['overviews']:
+                _build_overviews(dataset=dst, profile=profile)
+
+
+def convert_raster(src_path, dst_path, profile):
+    """Copies an existing raster file to 'dst_path' using the output profile created by get_output_profile()."""
+
+    with rasterio.open(src_path) as src:
+        if profile['format'] == 'COG':
+            rasterio.shutil.copy(src, dst_path, driver='COG', **_cog_options(profile=profile, dtype=src.dtypes[0]))
+        else:
+            meta = src.meta.copy()
+            meta.update(gtiff_options(profile=profile, dtype=src.dtypes[0]))
+            with rasterio.open(dst_path, 'w', **meta) as dst:
+                for _, window in src.block_windows(1):
+                    dst.write(src.read(window=window), window=window)
+                if profile['overviews']:
+                    _build_overviews(dataset=dst, profile=profile)
+
+
+def gtiff_options(profile, dtype):
+    """Returns the rasterio creation options for the GTiff driver (tiled and compressed as defined in the profile)."""
+
+    options = {'driver': 'GTiff',
+               'tiled': True,
+               'blockxsize': profile['block_size'],
+               'blockysize': profile['block_size'],
+               'bigtiff': 'IF_SAFER',
+               'num_threads': profile['num_threads']}
+
+    if profile['compress'] != 'NONE':
+        options['compress'] = profile['compress']
+        options['predictor'] = _predictor(profile=profile, dtype=dtype)
+
+    return options
+
+
+def optimize_tiles(directory, profile, nproc=1, env=None):
+    """Rewrites all level-2 tiles (/X*_Y*/*.tif) in a directory in place using the output profile created by
+    get_output_profile(). Files that already match the profile (layout, compression, predictor, tiling and overviews)
+    are skipped, so only new or changed tiles are rewritten.
+    The change in file size is printed and written to a log file in /{ProjectDirectory}/data/log .
+    'env' are optional GDAL configuration options created by get_gdal_env()."""
+
+    file_list = glob.glob(os.path.join(directory, 'X*_Y*', '*.tif'))
+
+    pool = mp.Pool(int(nproc))
+    result_objects = [pool.apply_async(run_with_env, args=(env, _optimize_file, file, profile)) for file in file_list]
+    results = [r.get() for r in result_objects]
+    pool.close()
+    pool.join()
+
+    results = [r for r in results if r is not None]
+    size_before = sum([r[1] for r in results])
+    size_after = sum([r[2] for r in results])
+
+    if len(results) > 0:
+        log_dir = os.path.join(PROJ_DIR, 'data', 'log')
+        log_file = os.path.join(log_dir, f"{datetime.now().strftime('%Y%m%dT%H%M%S')}__"
+                                         f"{os.path.basename(directory.rstrip('/'))}__optimize_tiles.log")
+        if os.path.isdir(log_dir):
+            with open(log_file, 'w') as f:
+                for file, before, after in results:
+                    f.write(f"{file} - {before / 10e5:.2f} MB -> {after / 10e5:.2f} MB\n")
+
+        print(f"{len(results)} tiles rewritten as {profile['format']} ({profile['compress']}): "
+              f"{size_before / 10e5:.1f} MB -> {size_after / 10e5:.1f} MB "
+              f"({100 * (1 - size_after / max(size_before, 1)):.1f}% smaller)")
+
+    return results
+
+
+def find_empty_tiles(directory, file_list=None, nproc=1, env=None):
+    """Checks all level-2 tiles (/X*_Y*/*.tif) of a directory, or only the files in 'file_list', for files that
+    contain only no data values using is_empty(). The checks run in a multiprocessing pool or on a Dask cluster (see
+    ARDCube.utils.cluster.map_tasks()) and the verdicts are cached in /{ProjectDirectory}/data/meta , so that unchanged
+    files are not read again. Returns a list of all empty files. 'env' are optional GDAL configuration options created
+    by get_gdal_env()."""
+
+    if file_list is None:
+        file_list = glob.glob(os.path.join(directory, 'X*_Y*', '*.tif'))
+
+    cache_path = os.path.join(PROJ_DIR, 'data', 'meta',
+                              f"emptiness_cache__{os.path.basename(directory.rstrip('/'))}.json")
+    cache = {}
+    if os.path.isfile(cache_path):
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+
+    verdicts = {}
+    unknown = []
+    for file in file_list:
+        stat = os.stat(file)
+        entry = cache.get(file)
+        if entry is not None and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+            verdicts[file] = entry[2]
+        else:
+            unknown.append(file)
+
+    if len(unknown) > 0:
+        results = cluster.map_tasks(func=run_with_env, args_list=[(env, is_empty, file) for file in unknown],
+                                    nproc=nproc)
+
+        for file, empty in zip(unknown, results):
+            stat = os.stat(file)
+            cache[file] = [stat.st_mtime, stat.st_size, empty]
+            verdicts[file] = empty
+
+        if os.path.isdir(os.path.dirname(cache_path)):
+            ## Remove entries of files that don't exist anymore before saving
+            cache = {k: v for k, v in cache.items() if os.path.isfile(k)}
+            with open(cache_path, 'w') as f:
+                json.dump(cache, f)
+
+    return [file for file in file_list if verdicts[file]]
+
+
+def handle_empty_tiles(directory, action='quarantine', nproc=1, env=None):
+    """Finds empty level-2 tiles with find_empty_tiles() and either keeps, deletes or quarantines them. Quarantined
+    files are moved to /{ProjectDirectory}/data/temp/quarantine/{directory name}/{tile ID}/ ."""
+
+    if action not in ['keep', 'delete', 'quarantine']:
+        raise ValueError(f"{action} not recognized. Valid options are 'keep', 'delete' or 'quarantine'!")
+
+    empty_files = find_empty_tiles(directory=directory, nproc=nproc, env=env)
+
+    for file in empty_files:
+        if action == 'delete':
+            os.remove(file)
+        elif action == 'quarantine':
+            tile = os.path.basename(os.path.dirname(file))
+            q_dir = os.path.join(PROJ_DIR, 'data', 'temp', 'quarantine', os.path.basename(directory.rstrip('/')),
+                                 tile)
+            os.makedirs(q_dir, exist_ok=True)
+            shutil.move(file, os.path.join(q_dir, os.path.basename(file)))
+
+    print(f"{len(empty_files)} empty tiles found in {directory} ({action})")
+
+    return empty_files
+
+
+def is_empty(file):
+    """Returns True if a raster file only contains no data values. The check stops as soon as valid data is found:
+    1. If the file has internal overviews, the smallest overview is read first.
+    2. Blocks that are not stored in the file at all (sparse files) are skipped.
+    3. All other blocks are read in the order of their compressed size, largest first, as blocks that only contain no
+       data values compress very well and are therefore the least likely to contain valid data."""
+
+    with rasterio.open(file) as src:
+        nodata = src.nodata
+        if nodata is None:
+            return False
+
+        overviews = src.overviews(1)
+        if len(overviews) > 0:
+            factor = overviews[-1]
+            data = src.read(out_shape=(src.count, max(1, src.height // factor), max(1, src.width // factor)))
+            if _has_valid_data(data=data, nodata=nodata):
+                return False
+
+        blocks = []
+        for ij, window in src.block_windows(1):
+            try:
+                size = src.block_size(1, *ij)
+            except Exception:
+                size = 1
+            if size > 0:
+                blocks.append((size, window))
+
+        for _, window in sorted(blocks, key=lambda b: b[0], reverse=True):
+            if _has_valid_data(data=src.read(window=window), nodata=nodata):
+                return False
+
+    return True
+
+
+def open_band_sources(paths, sensor, band_names):
+    """Opens all files of a file dictionary entry (see ARDCube.prepare_odc.create_file_dict()) and returns a dictionary
+    of the form {'band_name': (dataset, band_index)}. Sentinel-1 bands are stored as separate files, while optical
+    bands are stored in a single multiband file (BOA) plus the quality band (QAI)."""
+
+    sources = {}
+    if sensor == 'sentinel1':
+        for band in band_names:
+            path = [path for path in paths if band in os.path.basename(path)][0]
+            sources[band] = (rasterio.open(path), 1)
+    else:
+        boa = rasterio.open(paths[0])
+        for i, band in enumerate([b for b in band_names if b != 'pixel_qa']):
+            sources[band] = (boa, i + 1)
+        if 'pixel_qa' in band_names:
+            sources['pixel_qa'] = (rasterio.open(paths[0].replace('BOA', 'QAI')), 1)
+
+    return sources
+
+
+def close_band_sources(sources):
+    """Closes all datasets opened by open_band_sources()."""
+
+    for dataset in set([s[0] for s in sources.values()]):
+        dataset.close()
+
+
+def rows_per_window(bytes_per_row, memory_limit, block_size):
+    """Returns the number of full-width rows per window, so that a window of 'bytes_per_row' bytes per row fits into
+    'memory_limit' (MB). The number is rounded down to a multiple of the output block size (if possible) to keep
+    writes aligned with the output blocks."""
+
+    n_rows = max(1, int(memory_limit * 10e5 // bytes_per_row))
+
+    if n_rows >= block_size:
+        n_rows = n_rows // block_size * block_size
+
+    return n_rows
+
+
+def _has_valid_data(data, nodata):
+    """Helper function for is_empty() to check if an array contains any valid (finite and not no data) values."""
+
+    if np.issubdtype(data.dtype, np.floating):
+        return bool(np.any(np.isfinite(data) & (data != nodata)))
+    else:
+        return bool(np.any(data != nodata))
+
+
+def _optimize_file(file, profile):
+    """Helper function for optimize_tiles() which rewrites a single file. Returns None if the file was skipped."""
+
+    with rasterio.open(file) as src:
+        if _matches_profile(src=src, profile=profile):
+            return None
+
+    size_before = os.path.getsize(file)
+    tmp_path = file.replace('.tif', '_opt_tmp.tif')
+    convert_raster(src_path=file, dst_path=tmp_path, profile=profile)
+    os.replace(tmp_path, file)
+
+    return file, size_before, os.path.getsize(file)
+
+
+def _matches_profile(src, profile):
+    """Helper function for _optimize_file() to check if an opened file already has the layout of the output profile
+    (COG layout if the format is 'COG', compression, predictor, tiling and overviews), so it doesn't need to be
+    rewritten."""
+
+    structure = src.tags(ns='IMAGE_STRUCTURE')
+
+    if profile['format'] == 'COG' and structure.get('LAYOUT', '').upper() != 'COG':
+        return False
+
+    compress = src.compression.name.upper() if src.compression is not None else 'NONE'
+    if compress != profile['compress']:
+        return False
+
+    if int(structure.get('PREDICTOR', 1)) != _predictor(profile=profile, dtype=src.dtypes[0]):
+        return False
+
+    if src.block_shapes[0] != (profile['block_size'], profile['block_size']):
+        return False
+
+    ## Overviews are only built if the file is larger than a block (see _build_overviews())
+    needs_overviews = profile['overviews'] and max(src.height, src.width) / 2 > profile['block_size'] / 2
+    if needs_overviews != (len(src.overviews(1)) > 0):
+        return False
+
+    return True
+
+
+def _predictor(profile, dtype):
+    """Helper function to select the GeoTIFF predictor based on the data type: 3 (floating point) for float rasters,
+    2 (horizontal differencing) for integer rasters or 1 (none)."""
+
+    if profile['predictor'] == 'none' or profile['compress'] == 'NONE':
+        return 1
+    elif np.issubdtype(np.dtype(dtype), np.floating):
+        return 3
+    else:
+        return 2
+
+
+def _cog_options(profile, dtype):
+    """Helper function to create the rasterio creation options for the COG driver (GDAL >= 3.1)."""
+
+    predictor = {1: 'NO', 2: 'STANDARD', 3: 'FLOATING_POINT'}
+
+    return {'COMPRESS': profile['compress'],
+            'PREDICTOR': predictor[_predictor(profile=profile, dtype=dtype)],
+            'BLOCKSIZE': profile['block_size'],
+            'OVERVIEWS': 'AUTO' if profile['overviews'] else 'NONE',
+            'RESAMPLING': profile['resampling'].upper(),
+            'NUM_THREADS': profile['num_threads'],
+            'BIGTIFF': 'IF_SAFER'}
+
+
+def _build_overviews(dataset, profile):
+    """Helper function to build internal overviews for a dataset opened in write mode. Overview levels are added until
+    the overview fits into a single block."""
+
+    factors = []
+    factor = 2
+    while max(dataset.height, dataset.width) / factor > profile['block_size'] / 2:
+        factors.append(factor)
+        factor *= 2
+
+    if len(factors) > 0:
+        dataset.build_overviews(factors, Resampling[profile['resampling']])
+        dataset.update_tags(ns='rio_overview', resampling=profile['resampling'])
@@ -0,0 +1,95 @@
+import os
+import shutil
+
+## Initial estimate of the disk space needed per byte of level-1 input until the geocoded outputs of a scene have been
+## cropped. It is replaced by the ratio measured after each batch (see update_ratio()).
+DEFAULT_RATIO = 2.0
+
+## Factor applied to the measured ratio, as the size of the outputs varies between scenes
+SAFETY_MARGIN = 1.2
+
+
+def dir_size(directory):
+    """Returns the size (bytes) of all files located in a directory and its subdirectories. Returns 0 if the directory
+    doesn't exist."""
+
+    if not os.path.isdir(directory):
+        return 0
+
+    size = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                size += dir_size(directory=entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                size += entry.stat().st_size
+
+    return size
+
+
+def group_size(group):
+    """Returns the size (bytes) of all level-1 scenes of a group (list of paths)."""
+
+    return sum([os.path.getsize(scene) for scene in group])
+
+
+def available_space(directory, budget):
+    """Returns the space (bytes) that can still be used in 'directory' without exceeding 'budget' (bytes), which is
+    additionally limited by the free space of the volume the directory is located on."""
+
+    return min(budget - dir_size(directory=directory), shutil.disk_usage(directory).free)
+
+
+def next_batch(groups, directory, budget, ratio):
+    """Admits groups of level-1 scenes (in the given order) into the next batch as long as their estimated space
+    (size of the scenes multiplied by 'ratio') fits into the space that is still available in 'directory'. If not even
+    the first group fits, it is admitted anyway if the directory is empty, as no space can be released by waiting.
+    Returns a tuple of the admitted groups, the remaining groups and the estimated space (bytes) of the batch."""
+
+    available = available_space(directory=directory, budget=budget)
+
+    batch = []
+    estimate = 0
+    for group in groups:
+        size = group_size(group=group) * ratio
+        if estimate + size > available:
+            break
+        batch.append(group)
+        estimate += size
+
+    if len(batch) == 0 and len(groups) > 0 and dir_size(directory=directory) == 0:
+        batch = [groups[0]]
+        estimate = group_size(group=groups[0]) * ratio
+        print(f"WARNING: The estimated space of {os.path.basename(groups[0][0])} ({estimate / 1024 ** 3:.1f} GB) "
+              f"exceeds the disk budget or free space ({available / 1024 ** 3:.1f} GB). Processing it anyway.")
+
+    return batch, groups[len(batch):], estimate
+
+
+def update_ratio(ratio, groups, used):
+    """Returns the ratio of disk space used by the outputs of a batch ('used', bytes) to the size of its level-1 scenes
+    multiplied by SAFETY_MARGIN, which is used to estimate the space of the next batch. The previous ratio is kept if
+    nothing was written."""
+
+    size = sum([group_size(group=group) for group in groups])
+    if size == 0 or used <= 0:
+        return ratio
+
+    return used / size * SAFETY_MARGIN
+
+
+def release_level1(groups, cold_dir):
+    """Moves all level-1 scenes of the given groups to 'cold_dir' (e.g. a slower or archival volume), so they no longer
+    take up space in the level-1 directory. Returns the number of moved scenes."""
+
+    if not os.path.isdir(cold_dir):
+        os.makedirs(cold_dir)
+
+    n_moved = 0
+    for group in groups:
+        for scene in group:
+            if os.path.isfile(scene):
+                shutil.move(scene, os.path.join(cold_dir, os.path.basename(scene)))
+                n_moved += 1
+
+    return n_moved
@@ -0,0 +1,293 @@
+import os
+import re
+import shutil
+import zipfile
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from urllib.request import urlopen
+from urllib.error import HTTPError, URLError
+import numpy as np
+from shapely.geometry import Polygon, MultiPoint
+
+## Scalings of SAR backscatter that can be derived from linear backscatter with convert_scaling(). 'suffix' is appended
+## to the filename (the same suffix pyroSAR uses for dB), 'nodata' None means the no data value of the input is kept.
+SCALINGS = {'linear': {'suffix': '', 'dtype': 'float32', 'nodata': None},
+            'dB': {'suffix': '_db', 'dtype': 'float32', 'nodata': -99},
+            'amplitude': {'suffix': '_amp', 'dtype': 'float32', 'nodata': None},
+            'dB_int16': {'suffix': '_db_int16', 'dtype': 'int16', 'nodata': -32768}}
+
+
+def read_footprint(zip_path):
+    """Reads the footprint of a Sentinel-1 level-1 scene directly from the zip file, without extracting it. Only the
+    central directory of the zip file and the small 'manifest.safe' member are read. If the manifest doesn't contain a
+    footprint, the convex hull of the geolocation grid points of the first annotation file is used instead.
+    Returns a shapely Polygon in WGS84 (longitude, latitude)."""
+
+    with zipfile.ZipFile(zip_path, 'r') as zf:
+        names = zf.namelist()
+
+        manifest = [n for n in names if n.endswith('manifest.safe')]
+        if len(manifest) > 0:
+            text = zf.read(manifest[0]).decode('utf-8', errors='ignore')
+            coords = re.search(r'<gml:coordinates>(.*?)</gml:coordinates>', text, re.DOTALL)
+            if coords is not None:
+                ## Coordinates are stored as 'lat,lon lat,lon ...'
+                points = [pair.split(',') for pair in coords.group(1).split()]
+                return Polygon([(float(lon), float(lat)) for lat, lon in points])
+
+        annotation = sorted([n for n in names if re.search(r'/annotation/s1[ab].*\.xml$', n)])
+        if len(annotation) > 0:
+            text = zf.read(annotation[0]).decode('utf-8', errors='ignore')
+            lats = re.findall(r'<latitude>(.*?)</latitude>', text)
+            lons = re.findall(r'<longitude>(.*?)</longitude>', text)
+            if len(lats) > 2 and len(lats) == len(lons):
+                return MultiPoint([(float(lon), float(lat)) for lat, lon in zip(lats, lons)]).convex_hull
+
+    raise RuntimeError(f"Footprint of {os.path.basename(zip_path)} could not be read from manifest or annotation.")
+
+
+def aoi_overlap(zip_path, aoi):
+    """Computes the fraction (0 - 1) of the AOI (shapely geometry in WGS84) that is covered by the footprint of a
+    Sentinel-1 level-1 scene and returns it together with the path of the scene, so it can be used with
+    Pool.apply_async(). The fraction is None if the footprint could not be read."""
+
+    try:
+        footprint = read_footprint(zip_path=zip_path)
+    except (RuntimeError, zipfile.BadZipFile, ValueError):
+        return zip_path, None
+
+    return zip_path, footprint.intersection(aoi).area / aoi.area
+
+
+def prefetch_osv(scenes, osv_dir, server, osv_type='POEORB', nproc=4):
+    """Downloads the orbit state vector (OSV) files needed for a list of Sentinel-1 level-1 scenes into 'osv_dir',
+    using the same directory layout as SNAP ({osv_dir}/{osv_type}/{S1A|S1B}/{YYYY}/{MM}/). Scenes that are already
+    covered by a file in 'osv_dir' are skipped. The directory listings of the server are requested once per month and
+    mission, and all missing files are downloaded in parallel afterwards.
+    'server' can be any URL with the same layout and HTML directory listings, e.g.
+    https://step.esa.int/auxdata/orbits/Sentinel-1 or a local stand-in (python -m http.server).
+    The prefetch is best-effort: scenes whose filename can't be parsed, whose listing can't be requested or whose
+    download fails (e.g. network errors or timeouts) are set to None, so that SNAP falls back to its own OSV lookup.
+    Returns a dictionary of the form {'path_to_scene.zip': 'path_to_osv_file'} (None if no matching file was found)."""
+
+    listings = {}
+    downloads = {}
+    result = {}
+    for scene in scenes:
+        try:
+            mission, start, stop = _scene_times(zip_path=scene)
+        except RuntimeError:
+            result[scene] = None
+            continue
+
+        ## Orbit files are filed by the start of their validity, which can be up to a day before the scene
+        months = sorted(set([(start - timedelta(days=1)).strftime('%Y/%m'), start.strftime('%Y/%m')]))
+
+        match = None
+        for month in months:
+            local_dir = os.path.join(osv_dir, osv_type, mission, month)
+            local = os.listdir(local_dir) if os.path.isdir(local_dir) else []
+            match = _match_osv(names=local, start=start, stop=stop)
+            if match is not None:
+                result[scene] = os.path.join(local_dir, match)
+                break
+
+        if match is not None:
+            continue
+
+        for month in months:
+            key = (mission, month)
+            if key not in listings:
+                listings[key] = _list_osv(url=f"{server.rstrip('/')}/{osv_type}/{mission}/{month}/")
+            match = _match_osv(names=listings[key] or [], start=start, stop=stop)
+            if match is not None:
+                local_path = os.path.join(osv_dir, osv_type, mission, month, match)
+                downloads[local_path] = f"{server.rstrip('/')}/{osv_type}/{mission}/{month}/{match}"
+                result[scene] = local_path
+                break
+
+        if match is None:
+            result[scene] = None
+
+    if len(downloads) > 0:
+        pool = ThreadPool(nproc)
+        success = pool.starmap(_download_osv, downloads.items())
+        pool.close()
+        pool.join()
+
+        failed = set([local_path for local_path, ok in zip(downloads.keys(), success) if not ok])
+        result = {scene: None if osv_file in failed else osv_file for scene, osv_file in result.items()}
+
+    return result
+
+
+def _scene_times(zip_path):
+    """Helper function for prefetch_osv() to return mission (e.g. 'S1A'), start and stop time of a Sentinel-1 scene
+    based on its filename."""
+
+    f_base = os.path.basename(zip_path)
+    dates = re.findall(r'\d{8}T\d{6}', f_base)
+    if len(dates) < 2:
+        raise RuntimeError(f"Can't determine acquisition start and stop of {zip_path}")
+
+    return f_base[:3], datetime.strptime(dates[0], '%Y%m%dT%H%M%S'), datetime.strptime(dates[1], '%Y%m%dT%H%M%S')
+
+
+def _match_osv(names, start, stop):
+    """Helper function for prefetch_osv() to return the most recently produced OSV file of a list of filenames whose
+    validity covers the time range (start, stop) plus a margin of 60 seconds. Returns None if there is no match."""
+
+    matches = []
+    for name in names:
+        rs = re.search(r'_(\d{8}T\d{6})_V(\d{8}T\d{6})_(\d{8}T\d{6})\.EOF(\.zip)?$', name)
+        if rs is None:
+            continue
+        valid_start = datetime.strptime(rs.group(2), '%Y%m%dT%H%M%S')
+        valid_stop = datetime.strptime(rs.group(3), '%Y%m%dT%H%M%S')
+        if valid_start <= start - timedelta(seconds=60) and valid_stop >= stop + timedelta(seconds=60):
+            matches.append((rs.group(1), name))
+
+    if len(matches) == 0:
+        return None
+    else:
+        return sorted(matches)[-1][1]
+
+
+def _list_osv(url):
+    """Helper function for prefetch_osv() to return the names of all OSV files of an HTML directory listing. Returns an
+    empty list if the directory doesn't exist and None if the listing can't be requested (e.g. network errors)."""
+
+    try:
+        with urlopen(url, timeout=60) as response:
+            html = response.read().decode('utf-8', errors='ignore')
+    except HTTPError as e:
+        if e.code == 404:
+            return []
+        print(f"WARNING: Listing {url} failed: {e}")
+        return None
+    except (URLError, OSError) as e:
+        print(f"WARNING: Listing {url} failed: {e}")
+        return None
+
+    return sorted(set(re.findall(r'href="(?:[^"]*/)?(S1[AB]_OPER_AUX_\w+?_OPOD_[\w.]+?\.EOF(?:\.zip)?)"', html)))
+
+
+def _download_osv(local_path, url):
+    """Helper function for prefetch_osv() to download a single OSV file. The file is first written to a temporary file,
+    so that incomplete downloads are never used. Returns False if the download failed."""
+
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    tmp_path = f"{local_path}.part"
+    try:
+        with urlopen(url, timeout=300) as response, open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(response, f)
+        os.replace(tmp_path, local_path)
+    except (URLError, OSError) as e:
+        print(f"WARNING: Downloading {url} failed: {e}")
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+    return True
+
+
+def group_slices(scenes):
+    """Groups Sentinel-1 level-1 scenes into consecutive slices of the same datatake, which can be assembled before
+    geocoding. Slices are considered consecutive if mission, product type, absolute orbit and datatake ID (all taken
+    from the filename) are the same and their slice numbers (read from 'manifest.safe') are consecutive. If the slice
+    number can't be read, slices whose start and stop time are less than 5 seconds apart are considered consecutive.
+    Returns a list of lists of scene paths sorted by acquisition start. Single scenes form a group of their own."""
+
+    datatakes = {}
+    for scene in scenes:
+        f_base = os.path.basename(scene)
+        parts = f_base.split('_')
+        ## e.g. S1A_IW_GRDH_1SDV_20200501T171519_20200501T171544_032362_03BF1B_6B7D.zip
+        if len(parts) < 9:
+            datatakes[f_base] = [scene]
+            continue
+        key = '_'.join([parts[0], parts[1], parts[2], parts[3], parts[6], parts[7]])
+        datatakes.setdefault(key, []).append(scene)
+
+    groups = []
+    for slices in datatakes.values():
+        slices = sorted(slices, key=lambda s: _scene_times(zip_path=s)[1])
+        group = [slices[0]]
+        for prev, scene in zip(slices[:-1], slices[1:]):
+            if _is_consecutive(prev=prev, scene=scene):
+                group.append(scene)
+            else:
+                groups.append(group)
+                group = [scene]
+        groups.append(group)
+
+    return sorted(groups, key=lambda g: _scene_times(zip_path=g[0])[1])
+
+
+def read_slice_number(zip_path):
+    """Reads the slice number of a Sentinel-1 level-1 scene from 'manifest.safe' without extracting the zip file.
+    Returns None if it can't be read."""
+
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zf:
+            manifest = [n for n in zf.namelist() if n.endswith('manifest.safe')]
+            if len(manifest) == 0:
+                return None
+            text = zf.read(manifest[0]).decode('utf-8', errors='ignore')
+    except (zipfile.BadZipFile, OSError):
+        return None
+
+    rs = re.search(r'<s1sarl1:sliceNumber>(\d+)</s1sarl1:sliceNumber>', text)
+
+    return int(rs.group(1)) if rs is not None else None
+
+
+def _is_consecutive(prev, scene):
+    """Helper function for group_slices() to check if 'scene' directly follows 'prev' within the same datatake."""
+
+    prev_number = read_slice_number(zip_path=prev)
+    number = read_slice_number(zip_path=scene)
+    if prev_number is not None and number is not None:
+        return number == prev_number + 1
+
+    _, _, prev_stop = _scene_times(zip_path=prev)
+    _, start, _ = _scene_times(zip_path=scene)
+
+    return abs((start - prev_stop).total_seconds()) < 5
+
+
+def convert_scaling(data, scaling, nodata):
+    """Converts an array of linear backscatter (e.g. gamma0) into another scaling. Pixels that equal 'nodata', are not
+    finite or (for logarithmic scalings) not positive are set to the no data value of the output.
+    Returns a tuple of the converted array, its no data value and its data type. Valid scalings (see SCALINGS):
+    - 'linear': unchanged (float32)
+    - 'dB': 10 * log10(x) (float32, no data: -99)
+    - 'amplitude': sqrt(x) (float32)
+    - 'dB_int16': dB multiplied by 100 and rounded (int16, no data: -32768), i.e. a precision of 0.01 dB"""
+
+    if scaling not in SCALINGS:
+        raise ValueError(f"{scaling} not recognized. Valid options are: {list(SCALINGS.keys())}")
+
+    valid = np.isfinite(data)
+    if nodata is not None:
+        valid &= data != nodata
+    out_nodata = SCALINGS[scaling]['nodata'] if SCALINGS[scaling]['nodata'] is not None else nodata
+    dtype = SCALINGS[scaling]['dtype']
+
+    if scaling == 'linear':
+        return data.astype(dtype), out_nodata, dtype
+
+    if scaling == 'amplitude':
+        valid &= data >= 0
+        out = np.sqrt(data, where=valid, out=np.zeros(data.shape, dtype='float32'))
+    else:
+        valid &= data > 0
+        out = np.log10(data, where=valid, out=np.zeros(data.shape, dtype='float32'))
+        out *= 10
+        if scaling == 'dB_int16':
+            out = np.clip(np.round(out * 100), -32767, 32767)
+
+    out = out.astype(dtype)
+    out[~valid] = out_nodata if out_nodata is not None else 0
+
+    return out, out_nodata, dtype
@@ -0,0 +1,164 @@
+from ARDCube.config import PROJ_DIR, get_setting
+
+import os
+import re
+import json
+import time
+from datetime import datetime
+
+## Patterns (matched against the type and message of an error) used to classify failures. Classes are checked in this
+## order, errors that don't match any pattern are classified as 'unknown'.
+FAILURE_PATTERNS = {'input': [r'BadZipFile', r'not a zip file', r'CRC', r'EOFException', r'corrupt',
+                              r'Cannot construct DataProduct', r'No reader found', r'does not exist'],
+                    'resource': [r'No space left on device', r'OutOfMemoryError', r'MemoryError',
+                                 r'Cannot allocate memory'],
+                    'transient': [r'TimeoutError', r'timed out', r'Connection', r'Temporary failure',
+                                  r'HTTP Error 5\d\d', r'Resource temporarily unavailable', r'URLError']}
+
+## Failure classes that are retried. Broken input and missing resources fail the same way every time.
+RETRY_CLASSES = ['transient', 'unknown']
+
+
+def run_task(func, kwargs, sensor, stage, scene, settings, input_hash=None):
+    """Runs a scene-level step (e.g. a single container call) with the retry policy defined in the [EXECUTION] section
+    of 'settings.prm'. Failures are classified (see classify()) and 'transient' or 'unknown' failures are retried up
+    to 'Retries' times, waiting 'Backoff' seconds before the first retry and twice as long before each following one.
+    If the step still fails, it is added to the dead-letter list (see dead_letter()) instead of raising, so that the
+    remaining scenes of a batch can be processed. If it succeeds, earlier entries of the scene and stage are resolved
+    (see resolve_dead_letters()).
+    The timeout ('Timeout' field) is not applied here, but needs to be passed to the step itself, e.g. as the
+    'timeout' argument of ARDCube.utils.executor.execute() (see get_timeout()).
+    Returns a tuple (success, result), where result is the return value of 'func' or the dead-letter entry."""
+
+    retries, backoff = get_retry_policy(settings=settings)
+
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            result = func(**kwargs)
+        except Exception as e:
+            error_class = classify(error=e)
+            if error_class not in RETRY_CLASSES or attempt > retries:
+                entry = dead_letter(sensor=sensor, stage=stage, scene=scene, error_class=error_class,
+                                    message=f"{type(e).__name__}: {e}", attempts=attempt, input_hash=input_hash)
+                print(f"\n{scene} failed at stage '{stage}' ({error_class}, {attempt} attempts): {e}")
+                return False, entry
+
+            wait = backoff * 2 ** (attempt - 1)
+            print(f"\n{scene} failed at stage '{stage}' ({error_class}): {e}\nRetrying in {wait:.0f} s...")
+            time.sleep(wait)
+            continue
+
+        resolve_dead_letters(sensor=sensor, stage=stage, scenes=[scene])
+        return True, result
+
+
+def get_retry_policy(settings):
+    """Returns the maximum number of retries and the waiting time (seconds) before the first retry, as defined in the
+    'Retries' and 'Backoff' fields of 'settings.prm'."""
+
+    retries = int(get_setting(settings=settings, section='EXECUTION', field='Retries'))
+    backoff = float(get_setting(settings=settings, section='EXECUTION', field='Backoff'))
+
+    return retries, backoff
+
+
+def get_timeout(settings):
+    """Returns the timeout (seconds) of a scene-level step defined in the 'Timeout' field of 'settings.prm', or None if
+    it is 0."""
+
+    timeout = float(get_setting(settings=settings, section='EXECUTION', field='Timeout'))
+
+    return timeout if timeout > 0 else None
+
+
+def classify(error=None, message=None):
+    """Classifies a failure based on the type and message of an exception (or only a message, e.g. read from the log
+    of a container call) as 'input' (broken or missing input), 'resource' (disk or memory), 'transient' (timeouts,
+    network) or 'unknown'."""
+
+    if error is not None:
+        message = f"{type(error).__name__}: {error}"
+
+    for error_class, patterns in FAILURE_PATTERNS.items():
+        for pattern in patterns:
+            if re.search(pattern, message, re.IGNORECASE):
+                return error_class
+
+    return 'unknown'
+
+
+def dead_letter(sensor, stage, scene, error_class, message, attempts, input_hash=None):
+    """Appends a failed step to the dead-letter list /{ProjectDirectory}/data/meta/dead_letter.jsonl and returns the
+    entry. Each line is a JSON object with the time, sensor, stage, scene, failure class, error message, number of
+    attempts and (optional) fingerprint of the input."""
+
+    entry = {'time': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'), 'sensor': sensor, 'stage': stage, 'scene': scene,
+             'class': error_class, 'error': message, 'attempts': attempts, 'input_hash': input_hash}
+
+    with open(get_dead_letter_path(), 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+    return entry
+
+
+def resolve_dead_letters(sensor, stage, scenes):
+    """Appends a success marker to the dead-letter list for each scene of 'scenes' (list of scene IDs) that has an
+    unresolved entry at this stage, so that it is no longer returned by read_dead_letters(). Scenes without entries
+    are ignored, so the list only grows with actual failures."""
+
+    failed = set([e['scene'] for e in read_dead_letters(sensor=sensor, stage=stage)])
+    resolved = [scene for scene in scenes if scene in failed]
+    if len(resolved) == 0:
+        return
+
+    time_now = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    with open(get_dead_letter_path(), 'a') as f:
+        for scene in resolved:
+            f.write(json.dumps({'time': time_now, 'sensor': sensor, 'stage': stage, 'scene': scene,
+                                'resolved': True}) + '\n')
+
+
+def read_dead_letters(sensor=None, stage=None):
+    """Returns all unresolved entries of the dead-letter list, optionally filtered by sensor and stage. If a scene
+    failed more than once, only its latest entry per stage is returned. Scenes of which the latest entry is a success
+    marker (see resolve_dead_letters()) are not returned."""
+
+    path = get_dead_letter_path()
+    if not os.path.isfile(path):
+        return []
+
+    entries = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+            entry = json.loads(line)
+            if (sensor is None or entry['sensor'] == sensor) and (stage is None or entry['stage'] == stage):
+                entries[(entry['sensor'], entry['stage'], entry['scene'])] = entry
+
+    return [entry for entry in entries.values() if not entry.get('resolved', False)]
+
+
+def print_dead_letters(sensor=None):
+    """Prints all entries of the dead-letter list."""
+
+    entries = read_dead_letters(sensor=sensor)
+    if len(entries) == 0:
+        return
+
+    print(f"\n{len(entries)} failed steps in {get_dead_letter_path()}:")
+    print(f"{'Sensor':<12}{'Stage':<12}{'Scene':<28}{'Class':<11}Error")
+    for e in entries:
+        print(f"{e['sensor']:<12}{e['stage']:<12}{e['scene']:<28}{e['class']:<11}{e['error'][:80]}")
+
+
+def get_dead_letter_path():
+    """Returns the path of the dead-letter list /{ProjectDirectory}/data/meta/dead_letter.jsonl."""
+
+    meta_dir = os.path.join(PROJ_DIR, 'data', 'meta')
+    if not os.path.isdir(meta_dir):
+        os.makedirs(meta_dir)
+
+    return os.path.join(meta_dir, 'dead_letter.jsonl')
@@ -0,0 +1,361 @@
+from ARDCube.config import get_settings, SAT_DICT, get_setting
+from ARDCube.prepare_odc import create_file_dict
+import ARDCube.utils.general as utils
+import ARDCube.utils.datacube as datacube
+import ARDCube.utils.raster as raster
+import ARDCube.utils.force as force
+
+import os
+import re
+import hashlib
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box
+from rasterio.features import rasterize
+from rasterio.windows import Window
+
+## Statistics that can be used in the 'Stats' field. Percentiles are selected with 'p' + percentile, e.g. 'p10'.
+STATS = ['count', 'mean', 'std', 'min', 'max', 'median']
+
+
+def zonal_stats(sensor, polygons, id_field=None, stats=None, out_path=None, start=None, end=None, nproc=None):
+    """Main function of this module, which computes statistics of all level-2 bands per polygon and date. The polygons
+    are rasterized once per datacube tile into a grid of integer labels (pixel centers), which is cached in
+    /{ProjectDirectory}/data/meta/zonal and reused as long as the polygons don't change. Each date is then reduced
+    with grouped NumPy operations over the labels (np.bincount and a single sort per date and band), independent of the
+    number of polygons. Tiles are processed in parallel.
+    Polygons that intersect more than one tile are merged exactly: their valid pixel values are collected from all
+    tiles and reduced as soon as all tiles of a date have been processed, so only the values of dates in progress are
+    kept in memory. Overlapping polygons are not supported, pixels covered by more than
+    one polygon are assigned to only one of them.
+    Observations containing no data and (optical only) flagged in the QAI band (see 'MaskFlags' in the [COMPOSITE]
+    section of 'settings.prm') are excluded. Results are written to a Parquet file with one row per polygon, date and
+    band and one column per statistic. Rows without any valid pixel are dropped.
+
+    Parameters
+    ----------
+    sensor: string
+        Name of the sensor/dataset.
+        Example: 'sentinel1'
+    polygons: string
+        Path to a vector file (e.g. GeoJSON, GPKG or Shapefile) containing (multi-)polygon geometries.
+    id_field: string (optional)
+        Attribute of the vector file that is used as 'polygon_id'. If not provided, the index of each feature is used.
+    stats: list of strings (optional)
+        Statistics that should be computed. If not provided, the 'Stats' field in 'settings.prm' is used.
+        Valid options: 'count' (number of valid pixels), 'mean', 'std', 'min', 'max', 'median' and percentiles,
+        e.g. 'p10' or 'p90'.
+    out_path: string (optional)
+        Path of the output Parquet file. If not provided, the table is written to
+        /{ProjectDirectory}/data/zonal/{polygons}__{sensor}.parquet
+    start: string (optional)
+        Start of the time range in the format 'YYYY-mm-dd' (inclusive). If not provided, the time range is open.
+    end: string (optional)
+        End of the time range in the format 'YYYY-mm-dd' (inclusive). If not provided, the time range is open.
+    nproc: int (optional)
+        Number of processes. If not provided, the 'NPROC' field in 'settings.prm' is used.
+    """
+
+    settings = get_settings()
+
+    if sensor not in list(SAT_DICT.keys()):
+        raise ValueError(f"{sensor} is not supported!")
+
+    if nproc is None:
+        nproc = int(settings['PROCESSING']['NPROC'])
+    if stats is None:
+        stats = get_setting(settings=settings, section='ZONAL', field='Stats')
+        stats = [s.strip() for s in stats.split(',') if len(s.strip()) > 0]
+    for stat in stats:
+        rs = re.fullmatch(r'p(\d{1,3}(\.\d+)?)', stat)
+        if stat not in STATS and (rs is None or float(rs.group(1)) > 100):
+            raise ValueError(f"{stat} not recognized. Valid options are: {STATS} or percentiles, e.g. 'p10'")
+    if 'count' not in stats:
+        stats = ['count'] + stats
+
+    mask_flags = get_setting(settings=settings, section='COMPOSITE', field='MaskFlags')
+    mask_flags = [f.strip() for f in mask_flags.split(',') if len(f.strip()) > 0]
+
+    data_dir = os.path.join(settings['GENERAL']['ProjectDirectory'], 'data')
+    if out_path is None:
+        utils.isdir_mkdir(directory=os.path.join(data_dir, 'zonal'))
+        out_path = os.path.join(data_dir, 'zonal',
+                                f"{os.path.splitext(os.path.basename(polygons))[0]}__{sensor}.parquet")
+    cache_dir = os.path.join(data_dir, 'meta', 'zonal')
+    utils.isdir_mkdir(directory=cache_dir)
+
+    start = utils.date_key(date=start, default='00000000')
+    end = utils.date_key(date=end, default='99999999')
+
+    level2_dir = os.path.join(data_dir, 'level2', sensor)
+    prj = datacube.read_datacube_prj(prj_path=os.path.join(datacube._get_datacubeprj_dir(directory=level2_dir),
+                                                           'datacube-definition.prj'))
+
+    gdf = gpd.read_file(polygons)
+    if not all(gdf.geometry.geom_type.isin(['Polygon', 'MultiPolygon'])):
+        raise ValueError(f"{polygons} may only contain polygon geometries.")
+    gdf = gdf.to_crs(prj['wkt'])
+    ids = gdf[id_field].values if id_field is not None else gdf.index.values
+
+    ## The label grids only need to be created again if the geometries (or their order) change
+    layer_hash = hashlib.sha1(b''.join(gdf.geometry.to_wkb().values)).hexdigest()[:16]
+
+    file_dict = create_file_dict(sensor=sensor, overwrite=True)
+    product_dict = utils.read_product_yaml(sensor=sensor)
+
+    ## Sort file dictionary entries by product and tile: {product: {tile: [(date, paths), ...]}}
+    products = {}
+    for key, paths in file_dict.items():
+        tile, date = key.split('__')
+        if not start <= date[:8] <= end:
+            continue
+        if sensor == 'sentinel1':
+            prod_key = f"{sensor}_{utils.s1_is_asc_or_desc(file_path=paths[0])}.yaml"
+        else:
+            prod_key = f"{sensor}.yaml"
+        products.setdefault(prod_key, {}).setdefault(tile, []).append((date, paths))
+
+    ## Polygons per tile and polygons that intersect more than one tile
+    tile_polygons = {}
+    for tile in set([tile for tiles in products.values() for tile in tiles.keys()]):
+        tile_x, tile_y = datacube.parse_tile_name(tile)
+        index = gdf.sindex.query(box(*datacube.tile_bounds(prj=prj, tile_x=tile_x, tile_y=tile_y)),
+                                 predicate='intersects')
+        if len(index) > 0:
+            tile_polygons[tile] = np.sort(index)
+    if len(tile_polygons) == 0:
+        print(f"No level-2 files of {sensor} found for the polygons in {polygons} between {start} and {end}.")
+        return
+    shared = np.bincount(np.concatenate(list(tile_polygons.values())), minlength=len(gdf)) > 1
+
+    writer = None
+    n_rows = 0
+    try:
+        for prod_key, tiles in products.items():
+            name = product_dict[prod_key]['name']
+            tiles = {tile: entries for tile, entries in tiles.items() if tile in tile_polygons}
+            print(f"\n#### Zonal statistics of {name} for {len(gdf)} polygons in {len(tiles)} tiles")
+
+            pool = mp.Pool(nproc)
+            result_objects = [pool.apply_async(_zonal_tile, args=(tile, sorted(entries), sensor,
+                                                                  product_dict[prod_key]['band_names'], name,
+                                                                  list(gdf.geometry.values[tile_polygons[tile]]),
+                                                                  tile_polygons[tile], ids[tile_polygons[tile]],
+                                                                  shared[tile_polygons[tile]], stats, mask_flags,
+                                                                  os.path.join(cache_dir,
+                                                                               f"{layer_hash}__{tile}.npz")))
+                              for tile, entries in tiles.items()]
+
+            ## Tiles with polygons that intersect other tiles, per date: {date: {tile, ...}}
+            pending = {}
+            for tile, entries in tiles.items():
+                if shared[tile_polygons[tile]].any():
+                    for date, _ in entries:
+                        pending.setdefault(_to_timestamp(date=date), set()).add(tile)
+
+            ## Values of polygons that intersect more than one tile: {(date, band): [(labels, values), ...]}
+            parts = {}
+            total = len(result_objects)
+            for i, r in enumerate(result_objects):
+                tile, frame, tile_parts = r.get()
+                utils.progress(i + 1, total, status=f"{tile}: {len(frame)} rows")
+                for key, part in tile_parts.items():
+                    parts.setdefault(key, []).append(part)
+                frames = [frame]
+
+                ## Dates of which all tiles have been processed are reduced and released right away
+                for date in [date for date, tiles_left in pending.items() if tile in tiles_left]:
+                    pending[date].discard(tile)
+                    if len(pending[date]) > 0:
+                        continue
+                    del pending[date]
+                    for key in [key for key in parts.keys() if key[0] == date]:
+                        frames.append(_reduce_shared(part=parts.pop(key), ids=ids, stats=stats, product=name,
+                                                     date=date, band=key[1]))
+
+                for frame in frames:
+                    if len(frame) > 0:
+                        writer = utils.write_parquet(writer=writer, out_path=out_path, frame=frame)
+                        n_rows += len(frame)
+
+            pool.close()
+            pool.join()
+    finally:
+        if writer is not None:
+            writer.close()
+
+    print(f"\n{n_rows} rows written to {out_path}")
+
+
+def _zonal_tile(tile, entries, sensor, band_names, product, geometries, labels, ids, shared, stats, mask_flags,
+                cache_path):
+    """Helper function executed in zonal_stats() which computes the statistics of all polygons of a single tile.
+    Polygons are labelled 1 to n in the order of 'labels' (their position in the vector file). Only the window of the
+    tile that contains polygons is read. Returns the tile ID, a DataFrame with the statistics of all polygons that are
+    located in this tile only, and a dictionary of the form {(date, band): (labels, values)} with the valid pixel
+    values of all polygons that intersect other tiles as well."""
+
+    bands = [band for band in band_names if band != 'pixel_qa']
+    frames = []
+    parts = {}
+    grid = None
+    for date, paths in entries:
+        sources = raster.open_band_sources(paths=paths, sensor=sensor, band_names=band_names)
+        try:
+            if grid is None:
+                grid, window = _get_label_grid(cache_path=cache_path, geometries=geometries,
+                                               dataset=sources[bands[0]][0])
+                inside = grid > 0
+                local = grid[inside].astype('int64')
+            if window is None:
+                break
+
+            masked = np.zeros(local.shape, dtype=bool)
+            if 'pixel_qa' in sources:
+                qai = sources['pixel_qa'][0].read(1, window=window)[inside]
+                for flag in mask_flags:
+                    masked |= force.decode_qai(qai=qai, flag=flag) > 0
+
+            timestamp = _to_timestamp(date=date)
+            for band in bands:
+                dataset, index = sources[band]
+                values = dataset.read(index, window=window)[inside].astype('float32')
+                valid = np.isfinite(values) & ~masked
+                if dataset.nodatavals[index - 1] is not None:
+                    valid &= values != dataset.nodatavals[index - 1]
+
+                band_labels = local[valid]
+                band_values = values[valid]
+                is_shared = shared[band_labels - 1]
+
+                result = _grouped_stats(labels=band_labels[~is_shared], values=band_values[~is_shared],
+                                        n_labels=len(labels), stats=stats)
+                frames.append(_stats_frame(result=result, ids=ids, product=product, date=timestamp, band=band,
+                                           select=~shared))
+                if is_shared.any():
+                    parts[(timestamp, band)] = (labels[band_labels[is_shared] - 1], band_values[is_shared])
+        finally:
+            raster.close_band_sources(sources=sources)
+
+    frame = pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame()
+
+    return tile, frame, parts
+
+
+def _get_label_grid(cache_path, geometries, dataset):
+    """Helper function for _zonal_tile() to return the label grid of a tile (0: no polygon, 1 to n: polygons in the
+    order of 'geometries') cropped to the extent of all polygons, and the window of the tile it covers. The grid is
+    loaded from 'cache_path' if it was created for the same tile grid (transform and shape) before, otherwise it is
+    rasterized and cached. The window is None if no pixel center is covered by a polygon."""
+
+    if os.path.isfile(cache_path):
+        with np.load(cache_path) as cached:
+            if np.allclose(cached['transform'], tuple(dataset.transform)) and tuple(cached['shape']) == dataset.shape:
+                window = Window(*cached['window']) if cached['window'].size > 0 else None
+                return cached['grid'], window
+
+    grid = rasterize(zip(geometries, range(1, len(geometries) + 1)), out_shape=dataset.shape,
+                     transform=dataset.transform, fill=0, dtype='uint32')
+
+    rows = np.flatnonzero(grid.any(axis=1))
+    cols = np.flatnonzero(grid.any(axis=0))
+    if len(rows) == 0:
+        window = None
+        grid = np.zeros((0, 0), dtype='uint32')
+    else:
+        window = Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+        grid = grid[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+    ## Write to a temporary file first, so that parallel or interrupted runs never leave an incomplete cache file
+    with open(f"{cache_path}.tmp", 'wb') as f:
+        np.savez_compressed(f, grid=grid, transform=np.array(tuple(dataset.transform)),
+                            shape=np.array(dataset.shape),
+                            window=np.array([] if window is None else [window.col_off, window.row_off,
+                                                                       window.width, window.height]))
+    os.replace(f"{cache_path}.tmp", cache_path)
+
+    return grid, window
+
+
+def _reduce_shared(part, ids, stats, product, date, band):
+    """Helper function for zonal_stats() to compute the statistics of polygons that intersect more than one tile from
+    the valid pixel values collected from all tiles ('part' is a list of (labels, values) tuples) of a single date and
+    band. Returns a DataFrame with one row per polygon."""
+
+    labels, inverse = np.unique(np.concatenate([p[0] for p in part]), return_inverse=True)
+    values = np.concatenate([p[1] for p in part])
+    result = _grouped_stats(labels=inverse.ravel() + 1, values=values, n_labels=len(labels), stats=stats)
+
+    return _stats_frame(result=result, ids=ids[labels], product=product, date=date, band=band,
+                        select=np.ones(len(labels), dtype=bool))
+
+
+def _to_timestamp(date):
+    """Helper function to convert a date string of a file dictionary key (YYYYmmdd or YYYYmmddTHHMMSS) into a pandas
+    Timestamp."""
+
+    return pd.to_datetime(date, format='%Y%m%dT%H%M%S' if 'T' in date else '%Y%m%d')
+
+
+def _grouped_stats(labels, values, n_labels, stats):
+    """Helper function to compute statistics of 'values' grouped by 'labels' (1 to n_labels) without iterating over
+    the groups. Counts, means and standard deviations are computed with np.bincount. Minimum, maximum, median and
+    percentiles are read from the values sorted by label and value, using the same linear interpolation as
+    np.percentile. Returns a dictionary of the form {'count': array, 'mean': array, ...} with one value per label
+    (index 0 is unused), which is NaN for labels without values."""
+
+    count = np.bincount(labels, minlength=n_labels + 1)
+    out = {'count': count}
+    empty = count == 0
+
+    if 'mean' in stats or 'std' in stats:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(labels, weights=values, minlength=n_labels + 1) / count
+            if 'std' in stats:
+                mean_sq = np.bincount(labels, weights=values.astype('float64') ** 2, minlength=n_labels + 1) / count
+                out['std'] = np.sqrt(np.maximum(mean_sq - mean ** 2, 0))
+        if 'mean' in stats:
+            out['mean'] = mean
+
+    order_stats = [stat for stat in stats if stat in ['min', 'max', 'median'] or stat.startswith('p')]
+    if len(order_stats) > 0:
+        if len(values) == 0:
+            for stat in order_stats:
+                out[stat] = np.full(n_labels + 1, np.nan)
+        else:
+            sorted_values = values[np.lexsort((values, labels))].astype('float64')
+            starts = np.concatenate([[0], np.cumsum(count)[:-1]])
+            last = np.clip(starts + count - 1, 0, len(values) - 1)
+            for stat in order_stats:
+                if stat == 'min':
+                    out[stat] = sorted_values[np.minimum(starts, len(values) - 1)]
+                elif stat == 'max':
+                    out[stat] = sorted_values[last]
+                else:
+                    q = 50.0 if stat == 'median' else float(stat[1:])
+                    pos = starts + q / 100 * np.maximum(count - 1, 0)
+                    lower = np.clip(np.floor(pos).astype('int64'), 0, len(values) - 1)
+                    upper = np.minimum(lower + 1, last)
+                    fraction = pos - np.floor(pos)
+                    out[stat] = sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * fraction
+                out[stat][empty] = np.nan
+
+    return out
+
+
+def _stats_frame(result, ids, product, date, band, select):
+    """Helper function to convert the result of _grouped_stats() into a DataFrame with one row per polygon. Only
+    polygons selected by the boolean array 'select' (aligned with 'ids') that have at least one valid pixel are kept."""
+
+    select = select & (result['count'][1:] > 0)
+
+    frame = pd.DataFrame({'polygon_id': ids[select],
+                          'product': product,
+                          'date': np.repeat(np.datetime64(date, 'ns'), select.sum()),
+                          'band': band})
+    for stat, values in result.items():
+        frame[stat] = values[1:][select].astype('int64' if stat == 'count' else 'float64')
+
+    return frame
@@ -0,0 +1,31 @@
+"""Benchmark of the execution backends of ARDCube.utils.executor. A no-op command ('true') is executed 'n' times with
+each backend (see executor.measure_overhead()), so the reported time per call is the overhead of the backend itself,
+e.g. the startup of a Singularity container. Requires an ARDCube project set up with the Singularity images of the
+tool for the 'singularity' backend:
+
+    python benchmarks/bench_executor.py --tool pyrosar --backends singularity native -n 10
+"""
+
+import argparse
+
+import ARDCube.utils.executor as executor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the execution backends.")
+    parser.add_argument('--tool', default='pyrosar', choices=list(executor.TOOLS.keys()),
+                        help="Tool whose container is used by the 'singularity' backend (default: pyrosar)")
+    parser.add_argument('--backends', nargs='+', default=['singularity', 'native'],
+                        choices=['singularity', 'native'], help="Backends to measure (default: singularity native)")
+    parser.add_argument('-n', type=int, default=10, help="Number of calls per backend (default: 10)")
+    args = parser.parse_args()
+
+    overhead = executor.measure_overhead(tool=args.tool, backends=args.backends, n=args.n)
+
+    print(f"{'Backend':<14}{'per call':>12}")
+    for backend, seconds in overhead.items():
+        print(f"{backend:<14}{seconds * 1000:>9.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
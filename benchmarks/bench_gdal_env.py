@@ -0,0 +1,157 @@
+"""Benchmark of the per-stage GDAL configuration profiles ([GDAL_HEADERSCAN], [GDAL_CROP] and [GDAL_WRITE] sections of
+'settings.prm'), the output profile ([OUTPUT] section) and the emptiness check of level-2 tiles.
+
+Synthetic level-2 tiles in the FORCE layout (/X*_Y*/*.tif) are written to a temporary directory, so the results can
+be reproduced on any machine with an ARDCube project set up (the settings of the project are used):
+
+    python benchmarks/bench_gdal_env.py --tiles 20 --size 3000 --repeat 3
+
+Each measurement runs in a new process, so the GDAL block cache is empty at the start of each run (the page cache of
+the operating system is not cleared). Reported are:
+- Header scan (open each file and read its metadata) and full reads with the default GDAL configuration and with the
+  profile of the respective stage
+- Size of the tiles before and after optimize_tiles() and the time to read a 512 x 512 window before and after
+- Time of is_empty() compared to reading each file completely
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing as mp
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from ARDCube.config import get_settings
+import ARDCube.utils.raster as raster
+
+NODATA = -9999
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the GDAL configuration and output profiles.")
+    parser.add_argument('--tiles', type=int, default=20, help="Number of synthetic tiles (default: 20)")
+    parser.add_argument('--size', type=int, default=3000, help="Width and height of each tile (default: 3000)")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs per measurement (default: 3)")
+    parser.add_argument('--directory', default=None, help="Directory for the synthetic tiles (default: temporary)")
+    args = parser.parse_args()
+
+    settings = get_settings()
+    directory = tempfile.mkdtemp(prefix='ardcube_bench_', dir=args.directory)
+
+    try:
+        files = write_tiles(directory=directory, n_tiles=args.tiles, size=args.size)
+        print(f"{len(files)} synthetic tiles of {args.size} x {args.size} pixels written to {directory}\n")
+
+        print(f"{'Step':<44}{'default':>12}{'profile':>12}")
+        for name, stage, func in [('Header scan', 'headerscan', _scan_headers),
+                                  ('Full read', 'crop', _read_full)]:
+            env = raster.get_gdal_env(settings=settings, stage=stage)
+            t_default = measure(func=func, files=files, env={}, repeat=args.repeat)
+            t_profile = measure(func=func, files=files, env=env, repeat=args.repeat)
+            print(f"{f'{name} ({stage})':<44}{t_default:>10.3f} s{t_profile:>10.3f} s")
+
+        print(f"\n{'Step':<44}{'before':>12}{'after':>12}")
+        size_before = sum([os.path.getsize(file) for file in files])
+        t_before = measure(func=_read_window, files=files, env={}, repeat=args.repeat)
+
+        profile = raster.get_output_profile(settings=settings)
+        env = raster.get_gdal_env(settings=settings, stage='write')
+        t0 = time.time()
+        raster.optimize_tiles(directory=directory, profile=profile, nproc=settings['PROCESSING']['NPROC'], env=env)
+        t_optimize = time.time() - t0
+
+        size_after = sum([os.path.getsize(file) for file in files])
+        t_after = measure(func=_read_window, files=files, env={}, repeat=args.repeat)
+        print(f"{'Size of all tiles':<44}{size_before / 10e5:>9.1f} MB{size_after / 10e5:>9.1f} MB")
+        print(f"{'Read 512 x 512 window of each tile':<44}{t_before:>10.3f} s{t_after:>10.3f} s")
+        print(f"{'optimize_tiles()':<44}{'':>12}{t_optimize:>10.3f} s")
+
+        print(f"\n{'Step':<44}{'full read':>12}{'is_empty()':>12}")
+        t_full = measure(func=_is_empty_full_read, files=files, env={}, repeat=args.repeat)
+        t_check = measure(func=_is_empty, files=files, env={}, repeat=args.repeat)
+        print(f"{'Emptiness check of all tiles':<44}{t_full:>10.3f} s{t_check:>10.3f} s")
+    finally:
+        shutil.rmtree(directory)
+
+
+def write_tiles(directory, n_tiles, size, seed=0):
+    """Writes synthetic int16 tiles as uncompressed, striped GeoTIFF files. A quarter of the tiles only contains no
+    data values, the others contain a smooth field with noise and a no data margin. Returns the list of files."""
+
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size]
+    field = 1000 + 500 * np.sin(x / 150) * np.cos(y / 200)
+    meta = {'driver': 'GTiff', 'dtype': 'int16', 'count': 1, 'width': size, 'height': size, 'nodata': NODATA,
+            'crs': 'EPSG:3035', 'transform': from_origin(4000000, 3000000, 20, 20)}
+
+    files = []
+    for i in range(n_tiles):
+        tile_dir = os.path.join(directory, f"X{i:04d}_Y0000")
+        os.makedirs(tile_dir, exist_ok=True)
+        if i < n_tiles // 4:
+            data = np.full((size, size), NODATA, dtype='int16')
+        else:
+            data = (field + rng.normal(0, 50, (size, size))).astype('int16')
+            data[:, :size // 5] = NODATA
+
+        file = os.path.join(tile_dir, f"20200501_LEVEL2_SEN2A_BOA_{i:04d}.tif")
+        with rasterio.open(file, 'w', **meta) as dst:
+            dst.write(data, 1)
+        files.append(file)
+
+    return files
+
+
+def measure(func, files, env, repeat):
+    """Returns the mean wall time of func(files) over 'repeat' runs, each executed in a new process with the GDAL
+    configuration options 'env'."""
+
+    seconds = []
+    for _ in range(repeat):
+        with mp.Pool(1) as pool:
+            seconds.append(pool.apply(raster.run_with_env, args=(env, _timed, func, files)))
+
+    return sum(seconds) / len(seconds)
+
+
+def _timed(func, files):
+    t0 = time.time()
+    func(files)
+    return time.time() - t0
+
+
+def _scan_headers(files):
+    for file in files:
+        with rasterio.open(file) as src:
+            _ = src.profile, src.overviews(1), src.bounds
+
+
+def _read_full(files):
+    for file in files:
+        with rasterio.open(file) as src:
+            src.read()
+
+
+def _read_window(files):
+    for file in files:
+        with rasterio.open(file) as src:
+            src.read(window=Window(src.width // 2, src.height // 2, 512, 512))
+
+
+def _is_empty_full_read(files):
+    for file in files:
+        with rasterio.open(file) as src:
+            np.all(src.read() == src.nodata)
+
+
+def _is_empty(files):
+    for file in files:
+        raster.is_empty(file)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,9 @@ setup(
     packages=find_packages(where='.'),
     include_package_data=True,
     install_requires=open("requirements.txt").read().splitlines(),
+    extras_require={
+        'dask': ['dask[distributed]']
+    },
     zip_safe=False,
     entry_points={
         'console_scripts': ['ardcube=ARDCube.cli:cli']